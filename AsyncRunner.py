@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+
+import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import locale
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from Metrics import Metrics
+from ResourceBudget import ResourceBudget
+
+
+class AsyncRunner(object):
+    """Run external programs on an asyncio event loop, so one process can keep many of them in flight.
+
+    The loop runs in a background thread, synchronous code hands calls to it with call() and blocks only its own thread.
+    Each program has a semaphore limiting how many copies run at once, output is read as it arrives and capped in
+    size, and a program that runs past its timeout is killed along with anything it started.
+    """
+
+    """Default number of copies of each program allowed to run at once"""
+    default_limits = {'tesseract': 8, 'kdu_compress': 4, 'opj_compress': 4, 'convert': 16, 'identify': 16, 'gs': 4,
+                      'mogrify': 4}
+    """Limit for programs not listed above"""
+    default_limit = 8
+    """Bytes of stdout and stderr kept from each call, the rest is discarded"""
+    max_output = 1048576
+    """Seconds a killed program has to exit and close its output, before we stop waiting for it"""
+    kill_grace = 5
+
+    """The runner of the current process"""
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, limits=None, max_output=None, budget=None):
+        """Set up the runner, the loop is only started on first use.
+
+        Keyword arguments
+        limits -- dict of program name to how many may run at once, merged over the defaults
+        max_output -- Bytes of stdout and stderr kept from each call
+        budget -- A ResourceBudget every call must be admitted by, or None
+        """
+        self.limits = dict(AsyncRunner.default_limits)
+        if limits is not None:
+            self.limits.update(limits)
+        if max_output is not None:
+            self.max_output = max_output
+        self.budget = budget
+        self._loop = None
+        self._loop_pid = None
+        self._semaphores = dict()
+        self._running = set()
+        self._waiters = None
+        atexit.register(self.kill_all)
+
+    @classmethod
+    def get(cls):
+        """The runner of the current process, created with the defaults if configure wasn't called."""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = AsyncRunner()
+            return cls._instance
+
+    @classmethod
+    def configure(cls, limits=None, max_output=None, budget=None):
+        """Replace the runner of the current process with one using these settings."""
+        with cls._instance_lock:
+            cls._instance = AsyncRunner(limits=limits, max_output=max_output, budget=budget)
+            return cls._instance
+
+    @staticmethod
+    def parse_limits(text):
+        """Parse 'tesseract=8,kdu_compress=4' into a dict, raising ValueError if it is malformed."""
+        limits = dict()
+        for item in [item.strip() for item in text.split(',') if item.strip() != '']:
+            (tool, limit) = item.split('=', 1)
+            limits[tool.strip()] = int(limit)
+            if limits[tool.strip()] < 1:
+                raise ValueError("{} must be at least 1".format(tool))
+        return limits
+
+    def _ensure_loop(self):
+        """Start the loop thread, again in a forked child where the parent's thread doesn't exist."""
+        if self._loop is None or self._loop_pid != os.getpid():
+            self._loop = asyncio.new_event_loop()
+            self._loop_pid = os.getpid()
+            self._semaphores = dict()
+            self._running = set()
+            self._waiters = None
+            thread = threading.Thread(target=self._loop.run_forever, name='async-runner', daemon=True)
+            thread.start()
+        return self._loop
+
+    def call(self, ops, logger=None, return_result=False, timeout=60, fail_on_error=True, cost=None):
+        """Run a program from synchronous code, with the same arguments and results as run().
+
+        The caller's context (ie. the Metrics tags) is carried over to the loop.
+        """
+        loop = self._ensure_loop()
+        context = contextvars.copy_context()
+
+        async def in_context():
+            for (variable, value) in context.items():
+                variable.set(value)
+            return await self.run(ops, logger=logger, return_result=return_result, timeout=timeout,
+                                  fail_on_error=fail_on_error, cost=cost)
+        return asyncio.run_coroutine_threadsafe(in_context(), loop).result()
+
+    def _semaphore(self, tool):
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(self.limits.get(tool, self.default_limit))
+        return self._semaphores[tool]
+
+    async def run(self, ops, logger=None, return_result=False, timeout=60, fail_on_error=True, cost=None):
+        """Execute an external system call
+
+        Keyword arguments
+        ops -- a list of the executable and any arguments.
+        return_result -- return the result of the call if successful.
+        timeout -- Time to wait for the process to complete, it is killed after this.
+        fail_on_error -- return False if the program exits with an error.
+        cost -- dict of the memory and threads the call needs from the resource budget, see ResourceBudget.estimate
+        """
+        tool = os.path.basename(ops[0])
+        env = None
+        if self.budget is not None:
+            if cost is None:
+                cost = ResourceBudget.default_cost(tool)
+            (ops, env) = ResourceBudget.apply(ops, cost)
+        if logger is not None:
+            logger.debug("Running system call - %s" % " ".join(ops))
+        async with self._semaphore(tool):
+            if self.budget is None:
+                result = await self.execute(ops, timeout)
+            else:
+                async with self.budget.admitted(cost):
+                    result = await self.execute(ops, timeout, env=env)
+        if Metrics.active is not None:
+            Metrics.active.record_call(ops, result['wall'], result['rusage'],
+                                       -signal.SIGKILL if result['timed_out'] else result['returncode'])
+        outs = result['stdout']
+        errs = result['stderr']
+        if result['timed_out']:
+            if logger is not None:
+                logger.error("Error executing command: \n{}\nMessage: killed after {}s\nOutput: {}\nError: {}".format(
+                    ' '.join(ops), timeout, outs, errs))
+            return False
+        if not result['returncode'] == 0 and fail_on_error:
+            if logger is not None:
+                logger.error("Error executing command: \n{}\nOutput: {}\nError: {}".format(' '.join(ops), outs, errs))
+            return False
+        if logger is not None:
+            if errs is not None:
+                logger.debug("Command stderr:\n{}".format(errs))
+            logger.debug("Command result:\n{}".format(outs))
+        if return_result:
+            return outs
+        else:
+            return True
+
+    async def execute(self, ops, timeout, env=None):
+        """Run a program, reading its output as it arrives.
+
+        Returns a dict of returncode, stdout, stderr, rusage, wall and timed_out.
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        # Its own process group, so a timeout also kills anything it started (ie. the gs run by convert).
+        process = subprocess.Popen(ops, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True, env=env)
+        self._running.add(process.pid)
+        try:
+            (streams, finishers) = zip(self._read_stream(loop, process.stdout), self._read_stream(loop, process.stderr))
+            waiter = asyncio.ensure_future(self._wait(loop, process))
+            done, not_done = await asyncio.wait([waiter] + list(streams), timeout=timeout)
+            timed_out = len(not_done) > 0
+            rusage = None
+            if timed_out:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # Something that left the process group (or a process stuck in the kernel) can hold the pipes open.
+                done, not_done = await asyncio.wait([waiter] + list(streams), timeout=self.kill_grace)
+                for finish in finishers:
+                    finish()
+                if not waiter.done():
+                    waiter.cancel()
+            if waiter.done() and not waiter.cancelled():
+                rusage = waiter.result()
+        finally:
+            self._running.discard(process.pid)
+            process.stdout.close()
+            process.stderr.close()
+        encoding = locale.getpreferredencoding(False)
+        (outs, errs) = [stream.result().decode(encoding, errors='replace').replace('\r\n', '\n')
+                        for stream in streams]
+        return {'returncode': process.returncode, 'stdout': outs, 'stderr': errs, 'rusage': rusage,
+                'wall': time.perf_counter() - start_time, 'timed_out': timed_out}
+
+    def _read_stream(self, loop, pipe):
+        """Read a pipe until it closes, keeping only the first max_output bytes.
+
+        Returns a future of the output and a function that stops reading and settles the future with what was read.
+        """
+        finished = loop.create_future()
+        buffer = bytearray()
+        dropped = [0]
+        fd = pipe.fileno()
+        os.set_blocking(fd, False)
+
+        def finish():
+            if finished.done():
+                return
+            loop.remove_reader(fd)
+            if dropped[0] > 0:
+                buffer.extend("\n[{} bytes of output discarded]".format(dropped[0]).encode('ascii'))
+            finished.set_result(bytes(buffer))
+
+        def readable():
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                return
+            if len(data) == 0:
+                finish()
+                return
+            keep = max(0, self.max_output - len(buffer))
+            buffer.extend(data[:keep])
+            dropped[0] += len(data) - len(data[:keep])
+        loop.add_reader(fd, readable)
+        return (finished, finish)
+
+    async def _wait(self, loop, process):
+        """Wait for a process to exit and reap it ourselves, so we get its resource usage."""
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is not None:
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+            (pid, status, rusage) = os.wait4(process.pid, 0)
+        else:
+            # No pidfd (older Linux or Python), block a thread of our own on the wait instead.
+            if self._waiters is None:
+                self._waiters = concurrent.futures.ThreadPoolExecutor(max_workers=64,
+                                                                      thread_name_prefix='async-runner-wait')
+            (pid, status, rusage) = await loop.run_in_executor(self._waiters, os.wait4, process.pid, 0)
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        return rusage
+
+    def kill_all(self):
+        """Kill anything still running when we exit."""
+        if self._loop_pid != os.getpid():
+            return
+        for pid in list(self._running):
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
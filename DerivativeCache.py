@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import sqlite3
+import threading
+import time
+
+
+class DerivativeCache(object):
+    """Content addressed cache of generated files, shared across runs, books and output directories.
+
+    Entries are keyed by a hash of the bytes of the files they were generated from, the output name and the settings
+    used. A hit is filled in by hardlink (or a copy when the cache is on another filesystem) and the least recently
+    used entries are evicted once the cache grows past its size limit. Without a cache directory nothing is cached.
+    """
+
+    """Read size when hashing source files."""
+    block_size = 1048576
+
+    def __init__(self, cache_dir, max_size, logger):
+        """Set up the cache.
+
+        Keyword arguments
+        cache_dir -- The directory to keep the cache in, or None to disable it
+        max_size -- The maximum size of the cache in bytes
+        logger -- The logger
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.logger = logger
+        self._local = threading.local()
+        self._digests = dict()
+        if self.enabled() and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def enabled(self):
+        return self.cache_dir is not None
+
+    def _db(self):
+        """Get the index database connection, every process and thread opens its own."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout=120,
+                                         isolation_level=None)
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                               "last_used REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def digest(self, source_file):
+        """Hash the bytes of a file, remembered for as long as its size and modification time don't change."""
+        stat = os.stat(source_file)
+        memo_key = (source_file, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._digests:
+            sha = hashlib.sha256()
+            with open(source_file, 'rb') as fp:
+                for block in iter(lambda: fp.read(self.block_size), b''):
+                    sha.update(block)
+            self._digests[memo_key] = sha.hexdigest()
+        return self._digests[memo_key]
+
+    def key(self, output_file, sources, params):
+        """The cache key of an output.
+
+        Keyword arguments
+        output_file -- The output, only its name is used
+        sources -- list of the files the output is generated from
+        params -- dict of the settings used to generate it
+        """
+        sha = hashlib.sha256()
+        sha.update(os.path.basename(output_file).encode('utf-8'))
+        for source_file in sources:
+            sha.update(self.digest(source_file).encode('ascii'))
+        sha.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key)
+
+    def fetch(self, output_file, sources, params):
+        """Fill an output from the cache.
+
+        Keyword arguments
+        output_file -- The file to create
+        sources -- list of the files the output is generated from
+        params -- dict of the settings used to generate it
+
+        Returns True on a cache hit.
+        """
+        if not self.enabled():
+            return False
+        key = self.key(output_file, sources, params)
+        entry = self._entry_path(key)
+        try:
+            self._link_or_copy(entry, output_file)
+        except FileNotFoundError:
+            return False
+        self._db().execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.logger.debug("Filled {} from the derivative cache".format(output_file))
+        return True
+
+    def store(self, output_file, sources, params):
+        """Add a generated output to the cache.
+
+        Keyword arguments
+        output_file -- The file that was generated
+        sources -- list of the files the output was generated from
+        params -- dict of the settings used to generate it
+        """
+        if not self.enabled() or not os.path.exists(output_file):
+            return
+        key = self.key(output_file, sources, params)
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            self._link_or_copy(output_file, entry)
+        except FileExistsError:
+            pass
+        size = os.path.getsize(entry)
+        self._db().execute("INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)",
+                           (key, size, time.time()))
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is under its size limit."""
+        db = self._db()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_size:
+            row = db.execute("SELECT key, size FROM entries ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            (key, size) = row
+            self.logger.debug("Evicting {} from the derivative cache".format(key))
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    @staticmethod
+    def _link_or_copy(source, destination):
+        """Hardlink source to destination, copying it if they are on different filesystems."""
+        if os.path.exists(destination):
+            raise FileExistsError(destination)
+        try:
+            os.link(source, destination)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            partial_file = destination + '.partial.{}'.format(os.getpid())
+            shutil.copyfile(source, partial_file)
+            os.replace(partial_file, destination)
@@ -3,15 +3,37 @@
 
 import argparse
 import html
+import io
 import logging
 import os
 import os.path
 import re
 import shutil
-import subprocess
-import sys
+import tempfile
+import uuid
+import warnings
+
+from PIL import Image
+try:
+    from PIL import ImageCms
+except ImportError:
+    # Pillow built without littlecms.
+    ImageCms = None
+
+# Masters are our own scans, only the DecompressionBombError for the largest (which go to convert) matters.
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
 
 from hocrpdf import HocrPdf
+from Manifest import Manifest
+from DerivativeCache import DerivativeCache
+from Metrics import Metrics
+from AsyncRunner import AsyncRunner
+from ResourceBudget import ResourceBudget
+from TesseractEngine import TesseractEngine
+from ImageInfo import ImageInfo
+from Jp2Encoder import Jp2Encoder
+from PdfAssembler import PdfAssembler
+from Scratch import Scratch
 
 
 class Derivatives(object):
@@ -21,39 +43,158 @@ class Derivatives(object):
     blanklines = re.compile(r'^[\x01|\x0a|\s]*$', re.MULTILINE)
     """Regex - Match PDF extension"""
     is_pdf = re.compile(r'.*\.pdf$', re.IGNORECASE)
-
-    def __init__(self, options, logger):
+    """Tesseract configs that can be added with --ocr-extra, and the page file each is saved as"""
+    ocr_extra_files = {'alto': 'ALTO.xml', 'tsv': 'OCR.tsv', 'pdf': 'PDF.pdf'}
+    """The extension tesseract gives the output of each config"""
+    tesseract_extensions = {'hocr': '.hocr', 'txt': '.txt', 'alto': '.xml', 'tsv': '.tsv', 'pdf': '.pdf'}
+    """The JPEGs made for each page as (name, height, width), with Pillow each is made from the one before"""
+    jpeg_sizes = [('JPG', 800, 800), ('TN', 110, 110)]
+    """Quality of JPEGs made with Pillow, ImageMagick's default"""
+    jpeg_quality = 92
+    """The page image embedded (as it is) in the page PDF.pdf for each --pdf-image"""
+    pdf_images = {'jp2': 'JP2.jp2', 'jpg': 'JPG.jpg'}
+    """Where Tiffs the JP2 encoder can't read are converted to a PGM/PPM for it, memory backed where possible"""
+    raw_dir = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+    def __init__(self, options, logger, manifest=None, cache=None, scratch=None):
         self.logger = logger
         self.options = options
+        if manifest is None:
+            manifest = Manifest(None, options, logger)
+        self.manifest = manifest
+        if cache is None:
+            cache = DerivativeCache(None, 0, logger)
+        self.cache = cache
+        if scratch is None:
+            scratch = Scratch(None, 0, logger)
+        """Where the files of each step are written before they are published into out_dir"""
+        self.scratch = scratch
+        """In-process OCR with --ocr-engine=tesserocr, otherwise the tesseract program is run"""
+        self.ocr_engine = None
+        if options.ocr_engine == 'tesserocr':
+            self.ocr_engine = TesseractEngine(options.language, logger)
+        self.jp2_encoder = Jp2Encoder.create(options.jp2_encoder, logger)
+
+    def warm_up(self):
+        """Load anything slow to set up before the worker pool is forked, so it is only done once."""
+        # Registers the PDF fonts with reportlab.
+        HocrPdf()
+
+    def get_cost(self, tool, image_file, threads=None):
+        """Estimate the memory and threads a program needs to work on an image, if a resource budget is in use.
+
+        Keyword arguments
+        tool -- The program name, ie. convert
+        image_file -- The image it will read
+        threads -- The threads it will be given, instead of ResourceBudget.threads_per_call
+        """
+        if AsyncRunner.get().budget is None:
+            return None
+        info = self.get_image_info(image_file)
+        cost = ResourceBudget.estimate(tool, info.width, info.height, info.depth)
+        if threads is not None:
+            cost['threads'] = threads
+        return cost
 
     def do_page_derivatives(self, tiff_file, out_dir, input_file=None):
+        # Pages split from a PDF already have their PDF.pdf.
+        page_pdf = input_file is not None and not Derivatives.is_pdf.match(input_file)
         if not self.options.skip_hocr_ocr:
-            self.do_hocr_ocr(tiff_file, out_dir)
+            self.do_hocr_ocr(tiff_file, out_dir, page_pdf=page_pdf)
         self.get_jpegs(tiff_file, out_dir)
-        if input_file is not None and not Derivatives.is_pdf.match(input_file):
-            self.make_pdf(os.path.join(out_dir, 'JP2.jp2'), os.path.join(out_dir, 'HOCR.html'), out_dir)
+        if page_pdf and (self.options.skip_hocr_ocr or 'pdf' not in self.options.ocr_extra):
+            with Metrics.tags(stage='PDF.pdf'):
+                self.make_pdf(os.path.join(out_dir, Derivatives.pdf_images[self.options.pdf_image]),
+                              os.path.join(out_dir, 'HOCR.html'), out_dir, tiff_file=tiff_file)
 
     def do_book_derivatives(self, input_file, out_dir):
+        with Metrics.tags(stage='PDF.pdf'):
+            self._make_book_pdf(input_file, out_dir)
+        if os.path.exists(os.path.join(out_dir, '1', 'TN.jpg')):
+            # Copy the first page thumbnail up to the book.
+            with Metrics.tags(stage='TN.jpg'), Metrics.step('copy', os.path.join(out_dir, 'TN.jpg')):
+                shutil.copy(os.path.join(out_dir, '1', 'TN.jpg'), os.path.join(out_dir, 'TN.jpg'))
+
+    def _make_book_pdf(self, input_file, out_dir):
         if input_file is not None and Derivatives.is_pdf.match(input_file):
             # For our directory scanner, leave this as a manual process for now.
             # Last copy the original PDF to the book level as PDF.pdf
-            shutil.copy(input_file, os.path.join(out_dir, 'PDF.pdf'))
+            with Metrics.step('copy', os.path.join(out_dir, 'PDF.pdf')):
+                shutil.copy(input_file, os.path.join(out_dir, 'PDF.pdf'))
         elif self.has_page_pdfs(out_dir):
-            # Try to make a combined PDF.
-            operations = [
-                "gs", "-dBATCH", "-dNOPAUSE", "-q", "-sDEVICE=pdfwrite", "-dAutoRotatePages=/None",
-                "-sOutputFile={}".format(os.path.join(out_dir, 'PDF.pdf')), "$(", "find", ".", "-type", "f", "-name",
-                "'PDF.pdf'", "-print", "|", "sort", "-t'/'", "-k", "2,2", "-n", ")"
-            ]
-            Derivatives.do_system_call(operations, logger=self.logger)
-        if os.path.exists(os.path.join(out_dir, '1', 'TN.jpg')):
-            # Copy the first page thumbnail up to the book.
-            shutil.copy(os.path.join(out_dir, '1', 'TN.jpg'), os.path.join(out_dir, 'TN.jpg'))
+            # Merge the page PDFs, carrying on from any pages added as they finished.
+            with Metrics.step('pdf-assemble', os.path.join(out_dir, 'PDF.pdf')):
+                PdfAssembler(out_dir, self.logger).finish()
+
+    def do_hocr_ocr(self, tiff_file, out_dir, page_pdf=False):
+        """Generate the HOCR, OCR and any --ocr-extra files of a page with a single tesseract run.
 
-    def do_hocr_ocr(self, tiff_file, out_dir):
-        # Skip HOCR/OCR generation.
-        hocr_file = self.get_hocr(tiff_file, out_dir)
-        self.get_ocr(tiff_file, hocr_file, out_dir)
+        With --use-hocr the OCR is stripped from the HOCR instead of coming from tesseract.
+
+        Keyword arguments
+        tiff_file -- The TIFF image
+        out_dir -- The output directory
+        page_pdf -- Whether tesseract may write the page PDF.pdf
+        """
+        outputs = [('hocr', 'HOCR.html', {'language': self.options.language})]
+        if not self.options.use_hocr:
+            outputs.append(('txt', 'OCR.txt', {'source': 'tesseract', 'language': self.options.language}))
+        for config in self.options.ocr_extra:
+            if config != 'pdf' or page_pdf:
+                outputs.append((config, Derivatives.ocr_extra_files[config],
+                                {'language': self.options.language, 'config': config}))
+        self.run_tesseract(tiff_file, out_dir, outputs)
+        hocr_file = os.path.join(out_dir, 'HOCR.html')
+        if self.options.use_hocr:
+            with Metrics.tags(stage='OCR.txt'):
+                if os.path.isfile(hocr_file):
+                    self.get_ocr_from_hocr(hocr_file, out_dir)
+                else:
+                    self.logger.error("Unable to generate OCR")
+        return hocr_file
+
+    def run_tesseract(self, tiff_file, out_dir, outputs):
+        """Run tesseract once for all the outputs that need generating and save each as its page file.
+
+        Keyword arguments
+        tiff_file -- The TIFF image
+        out_dir -- The output directory
+        outputs -- list of (tesseract config, page file name, params) for each output
+        """
+        needed = list()
+        for (config, name, params) in outputs:
+            output_file = os.path.join(out_dir, name)
+            if self.manifest.needs_output(output_file, input_file=tiff_file, params=params):
+                if self.cache.fetch(output_file, [tiff_file], params):
+                    self.manifest.output_done(output_file)
+                else:
+                    needed.append((config, output_file, params))
+        if len(needed) == 0:
+            return
+        configs = [config for (config, output_file, params) in needed]
+        names = [os.path.basename(output_file) for (config, output_file, params) in needed]
+        with self.scratch.staged(out_dir, names) as work_dir:
+            output_stub = os.path.join(work_dir, 'OCR')
+            with Metrics.tags(stage='+'.join(names)):
+                self.logger.debug("Generating {} with tesseract.".format(", ".join(configs)))
+                if self.ocr_engine is not None and TesseractEngine.can_render(configs):
+                    success = self.ocr_engine.process(tiff_file, output_stub, configs, timeout=600)
+                else:
+                    op = ['tesseract', tiff_file, output_stub, '-l', self.options.language] + configs
+                    success = self.do_system_call(op, timeout=600, logger=self.logger,
+                                                  cost=self.get_cost('tesseract', tiff_file))
+                if not success:
+                    self.logger.error("Problems generating OCR from %s" % tiff_file)
+                    print("Problems generating OCR from %s" % tiff_file)
+                    quit()
+            for (config, output_file, params) in needed:
+                tesseract_file = output_stub + Derivatives.tesseract_extensions[config]
+                work_file = os.path.join(work_dir, os.path.basename(output_file))
+                if tesseract_file != work_file:
+                    os.rename(tesseract_file, work_file)
+        for (config, output_file, params) in needed:
+            self.cache.store(output_file, [tiff_file], params)
+            self.manifest.output_done(output_file, shared=len(needed))
 
     def get_jpegs(self, tiff_file, out_dir):
         """Produce the needed JPEGs for ingest.
@@ -63,102 +204,202 @@ class Derivatives(object):
         out_dir -- The directory to save the images to.
         """
         if not self.options.skip_jp2:
-            self._make_jpeg_2000(tiff_file, out_dir)
-        self._make_jpeg(tiff_file, out_dir, 'JPG', height=800, width=800)
-        self._make_jpeg(tiff_file, out_dir, 'TN', height=110, width=110)
-
-    def _make_jpeg_2000(self, tiff_file, out_dir, second_try=False):
-        size = self.get_image_size(tiff_file)
-        res = self.get_image_resolution(tiff_file)
-        loseless = (size['height'] < 1024 or size['width'] < 1024 or res['x'] < 300 or res['y'] < 300)
-        just_file = os.path.split(tiff_file)[1]
-        output_file = os.path.join(out_dir, 'JP2.jp2')
+            with Metrics.tags(stage='JP2.jp2'):
+                self._make_jpeg_2000(tiff_file, out_dir)
+        if self.options.jpeg_engine == 'pillow' and self._make_jpegs_pillow(tiff_file, out_dir):
+            return
+        for (out_name, height, width) in Derivatives.jpeg_sizes:
+            with Metrics.tags(stage=out_name + '.jpg'):
+                self._make_jpeg(tiff_file, out_dir, out_name, height=height, width=width)
+
+    def _make_jpegs_pillow(self, tiff_file, out_dir):
+        """Make the page JPEGs in-process from a single decode of the Tiff, each from the one before it.
+
+        Returns False if Pillow can't read the Tiff, so they can be made with convert instead.
+        """
+        needed = list()
+        for (out_name, height, width) in Derivatives.jpeg_sizes:
+            output_file = os.path.join(out_dir, out_name + '.jpg')
+            params = {'height': height, 'width': width, 'engine': 'pillow'}
+            if self.manifest.needs_output(output_file, input_file=tiff_file, params=params):
+                if self.cache.fetch(output_file, [tiff_file], params):
+                    self.manifest.output_done(output_file)
+                else:
+                    needed.append((output_file, height, width, params))
+        if len(needed) == 0:
+            return True
+        (first_file, height, width, params) = needed[0]
+        with Metrics.tags(stage=os.path.basename(first_file)), Metrics.step('pillow-decode'):
+            image = self._decode_for_jpeg(tiff_file, width, height)
+        if image is None:
+            return False
+        names = [os.path.basename(output_file) for (output_file, height, width, params) in needed]
+        with self.scratch.staged(out_dir, names) as work_dir:
+            for (output_file, height, width, params) in needed:
+                self.logger.debug("Creating JPEG with size maximum width and height {}x{}".format(width, height))
+                work_file = os.path.join(work_dir, os.path.basename(output_file))
+                with Metrics.tags(stage=os.path.basename(output_file)), Metrics.step('pillow-jpeg', work_file):
+                    image = Derivatives.fit_image(image, width, height)
+                    image.save(work_file, 'JPEG', quality=Derivatives.jpeg_quality)
+        for (output_file, height, width, params) in needed:
+            self.cache.store(output_file, [tiff_file], params)
+            self.manifest.output_done(output_file)
+        return True
+
+    def _decode_for_jpeg(self, image_file, width, height):
+        """Decode an image as small as it can be while still covering width x height, converted to RGB or greyscale.
+
+        Returns None if Pillow can't read it.
+        """
+        try:
+            image = Image.open(image_file)
+            # Only some formats (ie. JPEG) can decode at a reduced size, Tiffs are decoded in full and box reduced.
+            image.draft(None, (width, height))
+            image.load()
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            self.logger.info("Pillow can't read {} ({}), using convert".format(image_file, e))
+            return None
+        if image.mode in ['1', 'P', 'PA'] or image.mode.startswith('I;16'):
+            # Modes reduce can't work on.
+            image = image.convert('I' if image.mode.startswith('I;16') else 'L' if image.mode == '1' else 'RGBA')
+        factor = int(min(image.width / float(width), image.height / float(height)) / 2)
+        if factor > 1:
+            # Throw away most of the pixels before anything else, keeping twice the size needed for resampling.
+            image = image.reduce(factor)
+        return Derivatives.output_colorspace(image)
 
-        if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
-            os.remove(output_file)
-            self.logger.debug("{} exists and we are deleting it.".format(output_file))
-
-        if not os.path.exists(output_file):
-            self.logger.debug("Generating Jpeg2000")
-            # Use Kakadu
-            op = ['kdu_compress', '-i', tiff_file, '-o', output_file]
-            if loseless:
-                # Do loseless
-                op.extend(['-quiet', 'Creversible=yes', '-rate', '-,1,0.5,0.25', 'Clevels=5'])
-            else:
-                op.extend(['-quiet', 'Clayers=5', 'Clevels=7',
-                           'Cprecincts={256,256},{256,256},{256,256},{128,128},{128,128},{64,64},{64,64},{32,32},{16,16}',
-                           'Corder=RPCL', 'ORGgen_plt=yes', 'ORGtparts=R', 'Cblk={32,32}', 'Cuse_sop=yes'])
-            # Temporary filename we might need below.
-            temp_tiff = os.path.join(os.path.dirname(tiff_file),
-                                     os.path.splitext(just_file)[0] + "_tmp" + os.path.splitext(just_file)[1])
-            if not self.do_system_call(op, logger=self.logger):
-                # Remove the JP2.jp2 if it was created, because it will be bad.
+    @staticmethod
+    def output_colorspace(image):
+        """Convert an image to the 8 bit greyscale or sRGB of JPEGs and kdu_compress, using its ICC profile if any."""
+        if image.mode in ['I', 'F']:
+            # 16 bit greyscale.
+            return image.point(lambda value: value * (1 / 256.0)).convert('L')
+        if image.mode in ['1', 'L', 'LA']:
+            return image.convert('L')
+        if image.mode not in ['RGB', 'CMYK']:
+            # Drop any alpha.
+            image = image.convert('RGB')
+        if 'icc_profile' in image.info and ImageCms is not None:
+            try:
+                profile = ImageCms.ImageCmsProfile(io.BytesIO(image.info['icc_profile']))
+                return ImageCms.profileToProfile(image, profile, ImageCms.createProfile('sRGB'), outputMode='RGB')
+            except (OSError, ImageCms.PyCMSError):
+                pass
+        return image.convert('RGB')
+
+    @staticmethod
+    def fit_image(image, width, height):
+        """Resize an image to fit in width x height keeping its aspect ratio, like convert -resize WxH."""
+        scale = min(width / float(image.width), height / float(image.height))
+        size = (max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale))))
+        if size == image.size:
+            return image
+        return image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+    def _make_jpeg_2000(self, tiff_file, out_dir):
+        output_file = os.path.join(out_dir, 'JP2.jp2')
+        params = {'encoder': self.jp2_encoder.name}
+        if self.manifest.needs_output(output_file, input_file=tiff_file, params=params):
+            if not self.cache.fetch(output_file, [tiff_file], params):
+                with self.scratch.staged(out_dir, ['JP2.jp2']) as work_dir:
+                    self._encode_jpeg_2000(tiff_file, os.path.join(work_dir, 'JP2.jp2'))
+                self.cache.store(output_file, [tiff_file], params)
+            self.manifest.output_done(output_file)
+
+    def _encode_jpeg_2000(self, tiff_file, output_file):
+        info = self.get_image_info(tiff_file)
+        lossless = Jp2Encoder.is_lossless(info)
+
+        self.logger.debug("Generating Jpeg2000 with {}".format(self.jp2_encoder.name))
+        if self.jp2_encoder.can_read(info):
+            if self._run_jp2_encoder(tiff_file, tiff_file, output_file, info, lossless):
+                return
+            # Remove the JP2.jp2 if it was created, because it will be bad.
+            if os.path.exists(output_file):
                 os.remove(output_file)
-                if self.is_compressed(tiff_file) and not second_try:
-                    # We failed, the tiff is compressed and we haven't tried with an uncompressed tiff
-                    self.logger.info("Jpeg2000 creation failed. Tiff is compressed, trying with uncompressed tiff")
-                    op = ['convert', tiff_file, '-compress', 'None', temp_tiff]
-                    self.do_system_call(op, timeout=600, logger=self.logger)
-                    self._make_jpeg_2000(temp_tiff, out_dir, second_try=True)
-                elif not second_try and self.get_colorspace(tiff_file).lower()[-3:] != 'rgb':
-                    # We failed and its not a RGB Tiff, need to make one.
-                    self.logger.info("Jpeg2000 creation failed. Tiff has none RGB colorspace, trying with sRGB tiff")
-                    op = ['convert', tiff_file, '-colorspace', 'sRGB', temp_tiff]
-                    self.do_system_call(op, timeout=600, logger=self.logger)
-                    self._make_jpeg_2000(temp_tiff, out_dir, second_try=True)
-                else:
-                    # We failed
-                    self.logger.error("Failed to generate JPEG2000 from %s" % tiff_file)
-                    print("Failed to generate JPEG2000 from %s" % tiff_file)
-                    os.remove(tiff_file)
-                    quit(1)
+            self.logger.info("Jpeg2000 creation failed, trying with the pixels converted for the encoder")
+        if not self._encode_jpeg_2000_raw(tiff_file, info, output_file, lossless):
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            # We failed
+            self.logger.error("Failed to generate JPEG2000 from %s" % tiff_file)
+            print("Failed to generate JPEG2000 from %s" % tiff_file)
+            os.remove(tiff_file)
+            quit(1)
+
+    def _run_jp2_encoder(self, input_file, tiff_file, output_file, info, lossless):
+        """Encode input_file (the page Tiff or its PGM/PPM) with the JP2 encoder, returns True if it succeeded."""
+        cost = None
+        if self.jp2_encoder.program is not None:
+            cost = self.get_cost(self.jp2_encoder.program, tiff_file, threads=self.options.jp2_threads)
+        return self.jp2_encoder.encode(input_file, output_file, info, lossless, threads=self.options.jp2_threads,
+                                       cost=cost)
 
-            if second_try:
-                # If we made an uncompressed copy, delete it.
-                os.remove(tiff_file)
+    def _encode_jpeg_2000_raw(self, tiff_file, info, output_file, lossless):
+        """Encode a Tiff the JP2 encoder can't read, through an uncompressed PGM/PPM of its pixels in memory.
+
+        The buffer is written to /dev/shm (where there is one) by Pillow, or by convert for more than 8 bits or what
+        Pillow can't read, and removed once encoded. Returns True if the JP2 was made.
+        """
+        grey = info.colorspace == 'Gray'
+        raw_file = os.path.join(Derivatives.raw_dir, "multipage2book-{}-{}{}".format(
+            os.getpid(), uuid.uuid4().hex, '.pgm' if grey else '.ppm'))
+        try:
+            if not (info.depth <= 8 and self._write_raw_pillow(tiff_file, raw_file)):
+                op = ['convert', tiff_file + '[0]', '-alpha', 'off', '-colorspace', 'Gray' if grey else 'sRGB',
+                      '-depth', '8' if info.depth <= 8 else '16', raw_file]
+                if not self.do_system_call(op, timeout=600, logger=self.logger,
+                                           cost=self.get_cost('convert', tiff_file)):
+                    return False
+            return self._run_jp2_encoder(raw_file, tiff_file, output_file, info, lossless)
+        finally:
+            if os.path.exists(raw_file):
+                os.remove(raw_file)
+
+    def _write_raw_pillow(self, tiff_file, raw_file):
+        """Decode a Tiff and write its 8 bit greyscale or sRGB pixels as a PGM/PPM, returns False if Pillow can't."""
+        try:
+            with Metrics.step('pillow-raw', raw_file):
+                with Image.open(tiff_file) as image:
+                    image.load()
+                    image = Derivatives.output_colorspace(image)
+                    if image.mode != ('L' if raw_file.endswith('.pgm') else 'RGB'):
+                        return False
+                    image.save(raw_file, 'PPM')
+            return True
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            self.logger.info("Pillow can't convert {} ({}), using convert".format(tiff_file, e))
+            if os.path.exists(raw_file):
+                os.remove(raw_file)
+            return False
 
     def _make_jpeg(self, tiff_file, out_dir, out_name, height=None, width=None):
         """Make a Jpeg of max size height x width"""
 
-        op = ['convert', tiff_file, '-colorspace', 'rgb']
+        op = ['convert', tiff_file]
+        if self.get_image_info(tiff_file).colorspace not in ['sRGB', 'Gray']:
+            # Masters are normally already sRGB or greyscale, see MasterProfile.
+            op.extend(['-colorspace', 'sRGB'])
 
         output_file = os.path.join(out_dir, out_name + '.jpg')
 
-        if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
-            os.remove(output_file)
-            self.logger.debug("{} exists and we are deleting it.".format(output_file))
-
-        if not os.path.exists(output_file):
-            self.logger.debug("Creating JPEG with size maximum width and height {}x{}".format(width, height))
-            if height is not None or width is not None:
-                op.append('-resize')
-                if height is not None and width is not None:
-                    op.append("{}x{}".format(width, height))
-                elif width is not None:
-                    op.append(width)
-                else:
-                    op.append("x{}".format(height))
-            op.append(output_file)
-
-            self.do_system_call(op, logger=self.logger)
-
-    def get_ocr(self, tiff_file, hocr_file, out_dir):
-        """Which way to get OCR.
-
-        Keyword arguments
-        tiff_file -- Tiff file to process from
-        hocr_file -- Hocr file to extract from
-        out_dir -- Directory to write OCR file to.
-        """
-        if tiff_file is not None and os.path.exists(tiff_file) and os.path.isfile(tiff_file) and not \
-                self.options.use_hocr:
-            self.process_ocr(tiff_file, out_dir)
-        elif hocr_file is not None and os.path.exists(hocr_file) and os.path.isfile(hocr_file) and \
-                self.options.use_hocr:
-            self.get_ocr_from_hocr(hocr_file, out_dir)
-        else:
-            self.logger.error("Unable to generate OCR")
+        params = {'height': height, 'width': width}
+        if self.manifest.needs_output(output_file, input_file=tiff_file, params=params):
+            if not self.cache.fetch(output_file, [tiff_file], params):
+                self.logger.debug("Creating JPEG with size maximum width and height {}x{}".format(width, height))
+                if height is not None or width is not None:
+                    op.append('-resize')
+                    if height is not None and width is not None:
+                        op.append("{}x{}".format(width, height))
+                    elif width is not None:
+                        op.append(width)
+                    else:
+                        op.append("x{}".format(height))
+                with self.scratch.staged(out_dir, [out_name + '.jpg']) as work_dir:
+                    op.append(os.path.join(work_dir, out_name + '.jpg'))
+                    self.do_system_call(op, logger=self.logger, cost=self.get_cost('convert', tiff_file))
+                self.cache.store(output_file, [tiff_file], params)
+            self.manifest.output_done(output_file)
 
     def get_ocr_from_hocr(self, hocr_file, out_dir):
         """Extract OCR from the Hocr data
@@ -168,142 +409,75 @@ class Derivatives(object):
         out_dir -- Directory to write OCR file to.
         """
         output_file = os.path.join(out_dir, 'OCR.txt')
-        if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
-            os.remove(output_file)
-            self.logger.debug("{} exists and we are deleting it.".format(output_file))
-        if not os.path.exists(output_file):
-            self.logger.debug("Generating OCR.")
-            data = ''
-            with open(hocr_file, 'r') as fpr:
-                data += fpr.read()
-            data = html.unescape(Derivatives.blanklines.sub('', Derivatives.htmlmatch.sub('\1', data)))
-            with open(output_file, 'w') as fpw:
-                fpw.write(data)
-
-    def process_ocr(self, tiff_file, out_dir):
-        """Get the OCR from a Tiff file.
-
-        Keyword arguments
-        tiff_file -- The TIFF image
-        out_dir -- The output directory"""
-        output_file = os.path.join(out_dir, 'OCR.txt')
-        output_stub = os.path.join(out_dir, 'OCR')
-        if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
-            os.remove(output_file)
-            self.logger.debug("{} exists and we are deleting it.".format(output_file))
-        if not os.path.exists(output_file):
-            self.logger.debug("Generating OCR.")
-            op = ['tesseract', tiff_file, output_stub, '-l', self.options.language]
-            if not self.do_system_call(op, logger=self.logger):
-                quit()
-
-    def get_hocr(self, tiff_file, out_dir):
-        """Get the HOCR from a Tiff file.
-
-        Keyword arguments
-        tiff_file -- The TIFF image
-        out_dir -- The output directory"""
-        output_stub = os.path.join(out_dir, 'HOCR')
-        tmp_file = output_stub + '.hocr'
-        output_file = output_stub + '.html'
-        if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
-            os.remove(output_file)
-            self.logger.debug("{} exists and we are deleting it.".format(output_file))
-        if not os.path.exists(output_file):
-            self.logger.debug("Generating HOCR.")
-            op = ['tesseract', tiff_file, output_stub, '-l', self.options.language, 'hocr']
-            if not self.do_system_call(op, timeout=600, logger=self.logger):
-                self.logger.error("Problems generating HOCR from %s" % tiff_file)
-                print("Problems generating HOCR from %s" % tiff_file)
-                quit()
-            os.rename(tmp_file, output_file)
-            if os.path.exists(output_stub + '.txt') and self.options.use_hocr:
-                # Some tesseracts seem to generate OCR at the same time as HOCR,
-                # so lets move it to OCR if we are going to create OCR from HOCR.
-                os.rename(output_stub + '.txt', os.path.join(out_dir, 'OCR.txt'))
-        return output_file
-
-    def make_pdf(self, jp2_file, hocr_file, out_dir):
-        if os.path.exists(jp2_file) and os.path.exists(hocr_file):
-            """Make PDF out of JP2 and HOCR."""
+        params = {'source': 'hocr'}
+        if self.manifest.needs_output(output_file, input_file=hocr_file, params=params):
+            if not self.cache.fetch(output_file, [hocr_file], params):
+                self.logger.debug("Generating OCR.")
+                data = ''
+                with open(hocr_file, 'r') as fpr:
+                    data += fpr.read()
+                with Metrics.step('hocr2ocr', output_file):
+                    data = html.unescape(Derivatives.blanklines.sub('', Derivatives.htmlmatch.sub('\1', data)))
+                    with self.scratch.staged(out_dir, ['OCR.txt']) as work_dir:
+                        with open(os.path.join(work_dir, 'OCR.txt'), 'w') as fpw:
+                            fpw.write(data)
+                self.cache.store(output_file, [hocr_file], params)
+            self.manifest.output_done(output_file)
+
+    def make_pdf(self, image_file, hocr_file, out_dir, tiff_file=None):
+        """Make PDF out of the JP2 or JPG and HOCR, the image is embedded without decoding it.
+
+        The page resolution, for an image smaller than the one OCRed, is the scan_res of the HOCR or else that of the
+        master tiff_file, --resolution without either.
+        """
+        if os.path.exists(image_file) and os.path.exists(hocr_file):
+            dpi = self.options.resolution
+            if tiff_file is not None:
+                info = ImageInfo.probe(tiff_file, logger=self.logger)
+                if info is not None and info.x_resolution:
+                    dpi = info.x_resolution
             hocr = HocrPdf()
             if self.options.debug_level == 'DEBUG':
                 hocr.enable_debug()
             output_file = os.path.join(out_dir, 'PDF.pdf')
-            if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
-                os.remove(output_file)
-                self.logger.debug("{} exists and we are deleting it.".format(output_file))
-            if not os.path.exists(output_file):
-                self.logger.debug("Generating searchable PDF from tiff and hocr.")
-                hocr.create_pdf(image_file=jp2_file, hocr_file=hocr_file, pdf_filename=output_file,
-                                dpi=self.options.resolution)
-
-    def image_magick_opts(self, lossless=False):
-        """Stores and returns the Kakadu JP2 creation args"""
-        args = list()
-        args.append(" -depth 8")
-        args.append(" -define jp2:tilewidth=1024")
-        args.append(" -define jp2:tileheight=1024")
-        if lossless:
-            args.append(" -define numrlvls=6")
-            args.append(" -define jp2:rate=1.0")
-            args.append(" -define jp2:lazy")
-            args.append(" -define jp2:prg=rlcp")
-            args.append(
-                " -define jp2:ilyrrates='0.015625,0.01858,0.0221,0.025,0.03125,0.03716,0.04419,0.05,0.0625,0.075,0.088"
-                ",0.1,0.125,0.15,0.18,0.21,0.25,0.3,0.35,0.4,0.5,0.6,0.7,0.84'")
-            args.append(" -define jp2:mode=int")
-        else:
-            args.append("-define numrlvls=7")
-            args.append("-define jp2:rate=0.02348")
-            args.append("-define jp2:prg=rpcl")
-            args.append("-define jp2:mode=int")
-            args.append("-define jp2:prcwidth=16383")
-            args.append("-define jp2:prcheight=16383")
-            args.append("-define jp2:cblkwidth=64")
-            args.append("-define jp2:cblkheight=64")
-            args.append("-define jp2:sop")
-        return args
+            image_name = os.path.basename(image_file)
+            if self.manifest.needs_output(output_file, input_file=image_file,
+                                          params={'hocr': self.manifest.fingerprint(hocr_file), 'image': image_name}):
+                params = {'resolution': dpi, 'debug': hocr.get_debug(), 'image': image_name}
+                if not self.cache.fetch(output_file, [image_file, hocr_file], params):
+                    self.logger.debug("Generating searchable PDF from {} and hocr.".format(image_name))
+                    with Metrics.step('hocrpdf', output_file), self.scratch.staged(out_dir, ['PDF.pdf']) as work_dir:
+                        hocr.create_pdf(image_file=image_file, hocr_file=hocr_file,
+                                        pdf_filename=os.path.join(work_dir, 'PDF.pdf'), dpi=dpi)
+                    self.cache.store(output_file, [image_file, hocr_file], params)
+                self.manifest.output_done(output_file)
+
+    def get_image_info(self, image_file):
+        """Return the ImageInfo of the image, quitting if it can't be read"""
+        info = ImageInfo.probe(image_file, logger=self.logger)
+        if info is None or info.width is None:
+            self.logger.error("Problem reading the image headers of %s" % image_file)
+            print("Problem reading the image headers of %s" % image_file)
+            quit(1)
+        return info
 
     def get_bit_depth(self, image_file):
         """Return the bit depth"""
-        op = ['identify', '-format', '%[depth]', image_file]
-        result = self.do_system_call(ops=op, return_result=True, logger=self.logger)
-        result = result.rstrip('\r\n')
-        self.logger.debug("Getting the bit depth ({}) for {}".format(result, image_file))
-        return int(result)
+        return self.get_image_info(image_file).depth
 
     def get_image_size(self, image_file):
         """Return a dict of the height and width of the image"""
-        self.logger.debug("Getting the height and width of {}".format(image_file))
-        op = ['identify', '-format', '%[height]-%[width]', image_file]
-        result = self.do_system_call(ops=op, return_result=True, logger=self.logger)
-        if not result:
-            self.logger.error("Problem getting image size for %s: %s" % (image_file, result))
-            print("Problem getting image size for %s: %s" % (image_file, result))
-            quit(1)
-        res_list = result.rstrip('\r\n').split('-')
-        return {'height': int(res_list[0]), 'width': int(res_list[1])}
+        info = self.get_image_info(image_file)
+        return {'height': info.height, 'width': info.width}
 
     def get_image_resolution(self, image_file):
         """Return a dict of the X and Y resolutions of the image"""
-        self.logger.debug("Getting the resolutions of {}".format(image_file))
-        op = ['identify', '-format', '%x-%y', image_file]
-        result = self.do_system_call(ops=op, return_result=True, logger=self.logger)
-        result = result.rstrip('\r\n')
-        if result.lower().find("undefined"):
-            result = result.lower().replace("undefined", "")
-        res_list = result.split('-')
-        res_list = [int(re.search(r'\d+', value).group(0)) for value in res_list]
-        self.logger.debug("Image resolution is " + str(res_list))
-        return {'x': res_list[0], 'y': res_list[1]}
+        info = self.get_image_info(image_file)
+        return {'x': info.x_resolution, 'y': info.y_resolution}
 
     def is_compressed(self, image_file):
         """Does identify see compression on the file."""
-        self.logger.debug("Checking compression for {}".format(image_file))
-        op = ['identify', '-format', '%[C]', image_file]
-        result = self.do_system_call(ops=op, return_result=True, logger=self.logger)
-        return result.rstrip('\r\n') != "None"
+        return self.get_image_info(image_file).is_compressed()
 
     def has_page_pdfs(self, out_dir):
         self.logger.debug("Checking for PDFs in the page directories of %s" % out_dir)
@@ -316,55 +490,23 @@ class Derivatives(object):
 
     def get_colorspace(self, image_file):
         """Get the colorspace of the image"""
-        self.logger.debug("Getting colorspace of {}".format(image_file))
-        op = ['identify', '-format', '%[colorspace]', image_file]
-        result = self.do_system_call(ops=op, return_result=True, logger=self.logger)
-        return result.rstrip('\r\n')
+        return self.get_image_info(image_file).colorspace
 
     @staticmethod
-    def do_system_call(ops, logger=None, return_result=False, timeout=60, fail_on_error=True):
+    def do_system_call(ops, logger=None, return_result=False, timeout=60, fail_on_error=True, cost=None):
         """Execute an external system call
 
+        The call is run by the AsyncRunner of this process, which limits how many copies of each program run at
+        once, so calls from several threads are in flight together.
+
         Keyword arguments
         ops -- a list of the executable and any arguments.
         return_result -- return the result of the call if successful.
-        timeout -- Time to wait for the process to complete.
+        timeout -- Time to wait for the process to complete, it is killed after this.
+        cost -- The memory and threads the call needs from the resource budget, see get_cost.
         """
-        if logger is not None:
-            logger.debug("Running system call - %s" % " ".join(ops))
-        try:
-            if sys.version_info.major == 3 and sys.version_info.minor < 7:
-                process = subprocess.run(ops, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout,
-                                         universal_newlines=True)
-            else:
-                process = subprocess.run(ops, capture_output=True, timeout=timeout, universal_newlines=True)
-            outs = process.stdout
-            errs = process.stderr
-            if not process.returncode == 0 and fail_on_error:
-                if logger is not None:
-                    logger.error(
-                        "Error executing command: \n{}\nOutput: {}\nError: {}".format(' '.join(ops), outs, errs))
-                return False
-        except TimeoutError as e:
-            if logger is not None:
-                logger.error(
-                    "Error executing command: \n{}\nMessage: {}\nOutput: {}\nSTDOUT: ".format(e.cmd, e.stderr, e.output,
-                                                                                              e.stdout))
-            return False
-        except subprocess.CalledProcessError as e:
-            if logger is not None:
-                logger.error(
-                    "Error executing command: \n{}\nMessage: {}\nOutput: {}\nSTDOUT: ".format(e.cmd, e.stderr, e.output,
-                                                                                              e.stdout))
-            return False
-        if logger is not None:
-            if errs is not None:
-                logger.debug("Command stderr:\n{}".format(errs))
-            logger.debug("Command result:\n{}".format(outs))
-        if return_result:
-            return outs
-        else:
-            return True
+        return AsyncRunner.get().call(ops, logger=logger, return_result=return_result, timeout=timeout,
+                                      fail_on_error=fail_on_error, cost=cost)
 
 
 def setup_log(level):
@@ -388,13 +530,32 @@ if __name__ == '__main__':
                         help="Process as a single page instead of a directory of page directories.")
     parser.add_argument('--overwrite', dest="overwrite", action='store_true', default=False,
                         help='Overwrite any existing Tiff/PDF/OCR/Hocr files with new copies.')
+    parser.add_argument('--language', dest="language", default='eng',
+                        help="Language of the source material, used for OCRing. Defaults to eng.")
     parser.add_argument('--resolution', dest="resolution", type=int, default=300,
                         help="Resolution of the source material, used when generating Tiff. Defaults to 300.")
     parser.add_argument('--use-hocr', dest="use_hocr", action='store_true', default=False,
-                        help='Generate OCR by stripping HTML characters from HOCR, otherwise run tesseract a second '
-                             'time. Defaults to use tesseract.')
+                        help='Generate OCR by stripping HTML characters from HOCR, otherwise it is written by the same '
+                             'tesseract run as the HOCR. Defaults to use tesseract.')
     parser.add_argument('--skip-hocr-ocr', dest="skip_hocr_ocr", action='store_true', default=False,
                         help='Do not generate OCR/HOCR datastreams')
+    parser.add_argument('--ocr-extra', dest="ocr_extra", action='append', choices=['alto', 'tsv'], default=[],
+                        help='Also save this tesseract output, "alto" as ALTO.xml and "tsv" as OCR.tsv. Can be given '
+                             'more than once.')
+    parser.add_argument('--jpeg-engine', dest="jpeg_engine", choices=['convert', 'pillow'], default='convert',
+                        help='Make the JPG and TN with convert, or in-process with Pillow decoding the Tiff once. '
+                             'Defaults to convert.')
+    parser.add_argument('--jp2-encoder', dest="jp2_encoder", choices=sorted(Jp2Encoder.backends.keys()),
+                        default='kakadu', help='Encode the JP2 with kdu_compress (kakadu), opj_compress (openjpeg) or '
+                                               'in-process with Pillow (pillow). Defaults to kakadu')
+    parser.add_argument('--jp2-threads', dest="jp2_threads", type=int, default=None,
+                        help='Threads each JP2 encode uses, defaults to what the encoder does on its own')
+    parser.add_argument('--ocr-engine', dest="ocr_engine", choices=['cli', 'tesserocr'], default='cli',
+                        help='Run the tesseract program for each page, or OCR in-process with tesserocr keeping the '
+                             'language loaded. Defaults to cli.')
+    parser.add_argument('--pdf-image', dest="pdf_image", choices=sorted(Derivatives.pdf_images.keys()), default='jp2',
+                        help='The page image to embed in the page PDF.pdf, the JP2.jp2 (jp2) or the JPG.jpg (jpg). '
+                             'Defaults to jp2.')
     parser.add_argument('--skip-jp2', dest="skip_jp2", action='store_true', default=False,
                         help='Do not generate JP2 datastreams')
     parser.add_argument('-l', '--loglevel', dest="debug_level",
@@ -402,6 +563,13 @@ if __name__ == '__main__':
                         default='ERROR', help='Set logging level, defaults to ERROR.')
 
     args = parser.parse_args()
+    if args.ocr_engine == 'tesserocr' and not TesseractEngine.available():
+        parser.error("--ocr-engine=tesserocr needs the tesserocr module, pip install tesserocr")
+    if not Jp2Encoder.create(args.jp2_encoder, None).available():
+        parser.error("--jp2-encoder={} needs {}".format(args.jp2_encoder,
+                                                        Jp2Encoder.backends[args.jp2_encoder].requirement))
+    if args.jp2_threads is not None and args.jp2_threads < 1:
+        parser.error("--jp2-threads must be at least 1")
     if args.process_dir[0] != '/' and args.process_dir[0] != '~':
         args.process_dir = os.path.join(os.getcwd(), args.process_dir)
     args.process_dir = os.path.realpath(args.process_dir)
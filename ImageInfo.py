@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+
+
+import os
+import os.path
+import re
+import struct
+import threading
+import zlib
+
+import PyPDF2
+from PIL import Image
+
+from AsyncRunner import AsyncRunner
+
+
+class ImageInfo(object):
+    """What the pipeline needs to know about an image or PDF, read from its headers in-process.
+
+    Tiffs are read from their first IFD, other images by Pillow (which only reads the header until pixels are asked
+    for) and PDFs by counting their pages. identify is only run for what neither can read. Probes are remembered by
+    path and modification time for the rest of the run, so all the questions asked about a page's OBJ.tiff cost one
+    read of its header.
+    """
+
+    """Tiff compression tag values, by the names identify reports"""
+    tiff_compressions = {1: 'None', 2: 'RLE', 3: 'Fax', 4: 'Group4', 5: 'LZW', 6: 'JPEG', 7: 'JPEG', 8: 'Zip',
+                         32773: 'RLE', 32946: 'Zip', 34712: 'JPEG2000'}
+    """Tiff photometric interpretation tag values, by the colorspace names identify reports"""
+    tiff_colorspaces = {0: 'Gray', 1: 'Gray', 2: 'sRGB', 3: 'sRGB', 5: 'CMYK', 6: 'sRGB', 8: 'Lab'}
+    """Pillow compression names, by the names identify reports"""
+    pillow_compressions = {'raw': 'None', 'tiff_lzw': 'LZW', 'group4': 'Group4', 'group3': 'Fax', 'jpeg': 'JPEG',
+                           'tiff_deflate': 'Zip', 'tiff_adobe_deflate': 'Zip', 'packbits': 'RLE'}
+    """Pillow modes to (bits per sample, colorspace)"""
+    pillow_modes = {'1': (1, 'Gray'), 'L': (8, 'Gray'), 'LA': (8, 'Gray'), 'P': (8, 'sRGB'), 'RGB': (8, 'sRGB'),
+                    'RGBA': (8, 'sRGB'), 'CMYK': (8, 'CMYK'), 'YCbCr': (8, 'sRGB'), 'LAB': (8, 'Lab'),
+                    'I': (32, 'Gray'), 'F': (32, 'Gray'), 'I;16': (16, 'Gray'), 'I;16B': (16, 'Gray')}
+    """Resolution identify reports when a file has none"""
+    default_resolution = 72
+    """Number of probes remembered"""
+    max_probes = 1024
+
+    """(path, mtime, size) to ImageInfo"""
+    _probes = dict()
+    _probes_lock = threading.Lock()
+
+    def __init__(self, filename, width=None, height=None, x_resolution=None, y_resolution=None, depth=None,
+                 compression=None, colorspace=None, frames=1, reader=None):
+        """Keyword arguments
+        filename -- The file probed
+        width -- Width in pixels of the first frame, None for PDFs
+        height -- Height in pixels of the first frame, None for PDFs
+        x_resolution -- Horizontal pixels per inch
+        y_resolution -- Vertical pixels per inch
+        depth -- Bits per sample
+        compression -- Compression of the first frame, as named by identify (ie. None, LZW, JPEG)
+        colorspace -- Colorspace, as named by identify (ie. sRGB, Gray, CMYK)
+        frames -- Number of pages
+        reader -- The TiffReader of a classic Tiff, with its IFD chain already walked
+        """
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.x_resolution = x_resolution
+        self.y_resolution = y_resolution
+        self.depth = depth
+        self.compression = compression
+        self.colorspace = colorspace
+        self.frames = frames
+        self.reader = reader
+
+    def __repr__(self):
+        return "ImageInfo({}: {}x{} {}x{}dpi {}bit {} {} {} frames)".format(
+            self.filename, self.width, self.height, self.x_resolution, self.y_resolution, self.depth,
+            self.compression, self.colorspace, self.frames)
+
+    def is_compressed(self):
+        return self.compression != 'None'
+
+    @staticmethod
+    def probe(filename, password='', logger=None):
+        """Get the ImageInfo of a file, reading it only if it changed since it was last probed.
+
+        Keyword arguments
+        filename -- The image or PDF
+        password -- Password of an encrypted PDF
+        logger -- The logger
+        Returns None if nothing could read it.
+        """
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        with ImageInfo._probes_lock:
+            info = ImageInfo._probes.get(key)
+        if info is not None:
+            return info
+        info = ImageInfo._read(filename, password, logger)
+        if info is not None:
+            with ImageInfo._probes_lock:
+                if len(ImageInfo._probes) >= ImageInfo.max_probes:
+                    ImageInfo._probes.clear()
+                ImageInfo._probes[key] = info
+        return info
+
+    @staticmethod
+    def _read(filename, password, logger):
+        if re.match(r'.*\.pdf$', filename, re.IGNORECASE):
+            (count, method) = PdfPageCounter(filename, password=password).count()
+            if logger is not None:
+                logger.debug("Counted pages of {} using the {} method".format(filename, method))
+            return ImageInfo(filename, frames=count)
+        for reader in [ImageInfo._read_tiff, ImageInfo._read_pillow, ImageInfo._read_identify]:
+            try:
+                info = reader(filename)
+            except Exception as e:
+                if logger is not None:
+                    logger.debug("Unable to probe {} with {}: {}".format(filename, reader.__name__, repr(e)))
+                continue
+            if logger is not None:
+                logger.debug("Probed {}".format(info))
+            return info
+        return None
+
+    @staticmethod
+    def _read_tiff(filename):
+        """Read the first IFD of a classic Tiff."""
+        reader = TiffReader(filename)
+        offsets = reader.ifd_offsets()
+        with open(filename, 'rb') as fp:
+            entries = reader._read_ifd(fp, offsets[0])
+
+        def value(tag, default=None):
+            if tag not in entries:
+                return default
+            (field_type, value_count, data) = entries[tag]
+            if field_type in [5, 10]:
+                # (S)RATIONAL
+                (numerator, denominator) = struct.unpack(reader.byte_order + ('II' if field_type == 5 else 'ii'),
+                                                         data[0:8])
+                return numerator / float(denominator) if denominator != 0 else None
+            return reader._values((field_type, 1, data[0:TiffReader.type_sizes[field_type]]))[0]
+        x_resolution = value(282)
+        y_resolution = value(283)
+        if value(296, 2) == 3:
+            # Per centimetre.
+            x_resolution = x_resolution * 2.54 if x_resolution is not None else None
+            y_resolution = y_resolution * 2.54 if y_resolution is not None else None
+        return ImageInfo(filename, width=value(256), height=value(257),
+                         x_resolution=ImageInfo._resolution(x_resolution),
+                         y_resolution=ImageInfo._resolution(y_resolution), depth=value(258, 1),
+                         compression=ImageInfo.tiff_compressions.get(value(259, 1), 'Undefined'),
+                         colorspace=ImageInfo.tiff_colorspaces.get(value(262), 'Undefined'), frames=len(offsets),
+                         reader=reader)
+
+    @staticmethod
+    def _read_pillow(filename):
+        """Read an image's header with Pillow, the pixels aren't decoded."""
+        with Image.open(filename) as image:
+            (depth, colorspace) = ImageInfo.pillow_modes.get(image.mode, (8, 'sRGB'))
+            (x_resolution, y_resolution) = image.info.get('dpi', (None, None))
+            compression = image.info.get('compression')
+            if compression is None:
+                compression = 'None' if image.format in ['BMP', 'PPM'] else image.format
+            return ImageInfo(filename, width=image.width, height=image.height,
+                             x_resolution=ImageInfo._resolution(x_resolution),
+                             y_resolution=ImageInfo._resolution(y_resolution), depth=depth,
+                             compression=ImageInfo.pillow_compressions.get(compression, compression),
+                             colorspace=colorspace, frames=getattr(image, 'n_frames', 1))
+
+    @staticmethod
+    def _read_identify(filename):
+        """Ask identify, for formats only ImageMagick can read."""
+        result = AsyncRunner.get().call(['identify', '-ping', '-format', "%w %h %x %y %z %[C] %[colorspace]\\n",
+                                         filename], return_result=True)
+        lines = result.rstrip().split('\n')
+        fields = lines[0].split(' ')
+        (x_resolution, y_resolution) = [re.search(r'[\d.]+', value) for value in fields[2:4]]
+        return ImageInfo(filename, width=int(fields[0]), height=int(fields[1]),
+                         x_resolution=ImageInfo._resolution(float(x_resolution.group(0)) if x_resolution else None),
+                         y_resolution=ImageInfo._resolution(float(y_resolution.group(0)) if y_resolution else None),
+                         depth=int(fields[4]), compression=fields[5], colorspace=fields[6], frames=len(lines))
+
+    @staticmethod
+    def _resolution(value):
+        if value is None or value <= 0:
+            return ImageInfo.default_resolution
+        return int(round(value))
+
+
+class TiffReader(object):
+    """Minimal reader of the IFD chain of a classic (not BigTIFF) Tiff, used to copy pages without decoding them."""
+
+    """Size in bytes of each Tiff field type"""
+    type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+    """Tags pointing at other IFDs or old style JPEG data, these can't be copied to a single page file"""
+    unsupported_tags = [330, 513, 514, 34665, 34853, 40965]
+
+    """Tags that don't make sense on a single page file"""
+    dropped_tags = [297]
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            header = fp.read(8)
+        if len(header) < 8 or header[0:2] not in (b'II', b'MM'):
+            raise ValueError("{} is not a Tiff file".format(filename))
+        self.byte_order = '<' if header[0:2] == b'II' else '>'
+        magic = struct.unpack(self.byte_order + 'H', header[2:4])[0]
+        if magic != 42:
+            raise ValueError("{} is not a classic Tiff (magic {})".format(filename, magic))
+        self.first_ifd = struct.unpack(self.byte_order + 'I', header[4:8])[0]
+        self._offsets = None
+
+    def ifd_offsets(self):
+        """Walk the IFD chain once and return the offset of each page's IFD."""
+        if self._offsets is None:
+            offsets = list()
+            next_ifd = self.first_ifd
+            with open(self.filename, 'rb') as fp:
+                while next_ifd != 0:
+                    if next_ifd in offsets:
+                        raise ValueError("{} has a loop in its IFD chain".format(self.filename))
+                    offsets.append(next_ifd)
+                    fp.seek(next_ifd)
+                    count = struct.unpack(self.byte_order + 'H', fp.read(2))[0]
+                    fp.seek(next_ifd + 2 + count * 12)
+                    next_ifd = struct.unpack(self.byte_order + 'I', fp.read(4))[0]
+            self._offsets = offsets
+        return self._offsets
+
+    def page_count(self):
+        return len(self.ifd_offsets())
+
+    def _read_ifd(self, fp, offset):
+        """Return the entries of an IFD as a dict of tag to (type, count, raw bytes)."""
+        fp.seek(offset)
+        count = struct.unpack(self.byte_order + 'H', fp.read(2))[0]
+        raw_entries = [fp.read(12) for x in range(count)]
+        entries = dict()
+        for raw_entry in raw_entries:
+            (tag, field_type, value_count) = struct.unpack(self.byte_order + 'HHI', raw_entry[0:8])
+            if field_type not in self.type_sizes:
+                raise ValueError("Unknown field type {} for tag {}".format(field_type, tag))
+            size = self.type_sizes[field_type] * value_count
+            if size <= 4:
+                data = raw_entry[8:8 + size]
+            else:
+                fp.seek(struct.unpack(self.byte_order + 'I', raw_entry[8:12])[0])
+                data = fp.read(size)
+            entries[tag] = (field_type, value_count, data)
+        return entries
+
+    def _values(self, entry):
+        """Unpack a SHORT or LONG entry into a list of ints."""
+        (field_type, value_count, data) = entry
+        if field_type == 3:
+            return list(struct.unpack(self.byte_order + '{}H'.format(value_count), data))
+        elif field_type == 4:
+            return list(struct.unpack(self.byte_order + '{}I'.format(value_count), data))
+        raise ValueError("Expected SHORT or LONG values, got type {}".format(field_type))
+
+    def write_page(self, index, output_file):
+        """Copy one page to a new single page Tiff, the (compressed) strips or tiles are copied as-is.
+
+        Keyword arguments
+        index -- The 0 based page to copy
+        output_file -- The file to write
+        """
+        bo = self.byte_order
+        with open(self.filename, 'rb') as fp:
+            entries = self._read_ifd(fp, self.ifd_offsets()[index])
+            if len([tag for tag in entries.keys() if tag in self.unsupported_tags]) > 0:
+                raise ValueError("Page {} has tags that can't be copied as-is".format(index + 1))
+            if 273 in entries and 279 in entries:
+                (offsets_tag, counts_tag) = (273, 279)
+            elif 324 in entries and 325 in entries:
+                (offsets_tag, counts_tag) = (324, 325)
+            else:
+                raise ValueError("Page {} has no strips or tiles".format(index + 1))
+            data_offsets = self._values(entries[offsets_tag])
+            data_counts = self._values(entries[counts_tag])
+            with open(output_file, 'wb') as out:
+                out.write(bo.replace('<', 'II').replace('>', 'MM').encode('ascii'))
+                out.write(struct.pack(bo + 'HI', 42, 0))
+                new_offsets = list()
+                for (data_offset, data_count) in zip(data_offsets, data_counts):
+                    new_offsets.append(out.tell())
+                    fp.seek(data_offset)
+                    remaining = data_count
+                    while remaining > 0:
+                        chunk = fp.read(min(remaining, 1048576))
+                        if len(chunk) == 0:
+                            raise ValueError("Page {} data is truncated".format(index + 1))
+                        out.write(chunk)
+                        remaining -= len(chunk)
+                entries[offsets_tag] = (4, len(new_offsets), struct.pack(bo + '{}I'.format(len(new_offsets)),
+                                                                         *new_offsets))
+                fields = list()
+                for tag in sorted(entries.keys()):
+                    if tag in self.dropped_tags:
+                        continue
+                    (field_type, value_count, data) = entries[tag]
+                    if len(data) <= 4:
+                        value = data.ljust(4, b'\x00')
+                    else:
+                        if out.tell() % 2 == 1:
+                            out.write(b'\x00')
+                        value = struct.pack(bo + 'I', out.tell())
+                        out.write(data)
+                    fields.append(struct.pack(bo + 'HHI', tag, field_type, value_count) + value)
+                if out.tell() % 2 == 1:
+                    out.write(b'\x00')
+                ifd_offset = out.tell()
+                out.write(struct.pack(bo + 'H', len(fields)))
+                out.write(b''.join(fields))
+                out.write(struct.pack(bo + 'I', 0))
+                out.seek(4)
+                out.write(struct.pack(bo + 'I', ifd_offset))
+
+
+class PdfPageCounter(object):
+    """Count the pages of a PDF from its trailer and page tree without reading the whole file into memory."""
+
+    """Regex - Count pages from parsed PDF."""
+    rxcountpages = re.compile(rb"/Type\s*/Page([^s]|$)", re.MULTILINE | re.DOTALL)
+    """Regex - Find the last startxref"""
+    rxstartxref = re.compile(rb"startxref\s+(\d+)")
+    """Regex - Indirect reference values in a dictionary"""
+    rxroot = re.compile(rb"/Root\s+(\d+)\s+(\d+)\s+R")
+    rxpages = re.compile(rb"/Pages\s+(\d+)\s+(\d+)\s+R")
+    rxprev = re.compile(rb"/Prev\s+(\d+)")
+    rxxrefstm = re.compile(rb"/XRefStm\s+(\d+)")
+    rxlength = re.compile(rb"/Length\s+(\d+)(\s+(\d+)\s+R)?")
+    """Regex - The /Count value, direct or an indirect reference"""
+    rxcount = re.compile(rb"/Count\s+(\d+)(\s+(\d+)\s+R)?")
+    rxtype_pages = re.compile(rb"/Type\s*/Pages\b")
+    rxobj = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj")
+
+    """How much to read from the end of the file looking for startxref"""
+    tail_size = 4096
+    """How much to read for a single object or trailer dictionary"""
+    object_size = 65536
+    """Size of the windows for the fallback scan and how much consecutive windows overlap"""
+    window_size = 4194304
+    window_overlap = 1024
+
+    def __init__(self, filename, password=''):
+        self.filename = filename
+        self.password = password
+        self._sections = None
+
+    def count(self):
+        """Count the pages.
+
+        Returns a tuple of the page count and the method that gave the answer (trailer, scan or pypdf2).
+        """
+        with open(self.filename, 'rb') as fp:
+            try:
+                return self._count_from_trailer(fp), 'trailer'
+            except (ValueError, IndexError, KeyError, struct.error, zlib.error):
+                pass
+            count = self._count_from_scan(fp)
+        if count > 0:
+            return count, 'scan'
+        pdf_read = PyPDF2.PdfFileReader(self.filename, strict=False)
+        if pdf_read.isEncrypted:
+            pdf_read.decrypt(self.password)
+        return pdf_read.getNumPages(), 'pypdf2'
+
+    def _count_from_trailer(self, fp):
+        """Follow startxref to the trailer, the /Root catalog and the /Pages /Count."""
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(max(0, size - self.tail_size))
+        matches = list(self.rxstartxref.finditer(fp.read()))
+        if len(matches) == 0:
+            raise ValueError("No startxref")
+        self._sections = list()
+        trailer = self._read_xref(fp, int(matches[-1].group(1)), list())
+        root = self.rxroot.search(trailer)
+        if root is None:
+            raise ValueError("No /Root in trailer")
+        catalog = self._read_object(fp, int(root.group(1)))
+        pages = self.rxpages.search(catalog)
+        if pages is None:
+            raise ValueError("No /Pages in catalog")
+        page_tree = self._read_object(fp, int(pages.group(1)))
+        count = self.rxcount.search(page_tree)
+        if self.rxtype_pages.search(page_tree) is None or count is None:
+            raise ValueError("Pages object has no /Count")
+        if count.group(2) is not None:
+            return int(self._read_object(fp, int(count.group(1))).split()[0])
+        return int(count.group(1))
+
+    def _read_xref(self, fp, offset, seen):
+        """Read an xref section and everything it points at through /XRefStm and /Prev.
+
+        Returns the dictionary of the newest trailer (or xref stream).
+        """
+        if offset in seen:
+            raise ValueError("Loop in xref chain")
+        seen.append(offset)
+        fp.seek(offset)
+        start = fp.read(4)
+        if start == b'xref':
+            trailer = self._read_xref_table(fp)
+            xrefstm = self.rxxrefstm.search(trailer)
+            if xrefstm is not None:
+                # Hybrid files keep the objects in object streams in an extra xref stream.
+                self._read_xref(fp, int(xrefstm.group(1)), seen)
+        else:
+            (trailer, data) = self._read_stream(fp, offset)
+            self._sections.append(('stream', self._parse_xref_stream(trailer, data)))
+        prev = self.rxprev.search(trailer)
+        if prev is not None:
+            self._read_xref(fp, int(prev.group(1)), seen)
+        return trailer
+
+    def _read_xref_table(self, fp):
+        """Note where each subsection of a classic xref table is, without reading the entries."""
+        while True:
+            position = fp.tell()
+            line = fp.readline(256)
+            if line.strip() == b'':
+                continue
+            header = re.match(rb"\s*(\d+)\s+(\d+)\s*$", line)
+            if header is None:
+                fp.seek(position)
+                break
+            (first, count) = (int(header.group(1)), int(header.group(2)))
+            self._sections.append(('table', (first, count, fp.tell())))
+            fp.seek(fp.tell() + count * 20)
+        data = fp.read(self.object_size)
+        trailer_start = data.find(b'trailer')
+        if trailer_start == -1:
+            raise ValueError("No trailer after xref table")
+        trailer_end = data.find(b'startxref', trailer_start)
+        return data[trailer_start:trailer_end if trailer_end != -1 else len(data)]
+
+    def _parse_xref_stream(self, dictionary, data):
+        """Split a decoded xref stream into a dict of object number to (type, field 2, field 3)."""
+        widths = [int(x) for x in re.search(rb"/W\s*\[([\d\s]+)\]", dictionary).group(1).split()]
+        index = re.search(rb"/Index\s*\[([\d\s]+)\]", dictionary)
+        if index is not None:
+            index = [int(x) for x in index.group(1).split()]
+        else:
+            index = [0, int(re.search(rb"/Size\s+(\d+)", dictionary).group(1))]
+        row_size = sum(widths)
+        entries = dict()
+        position = 0
+        for i in range(0, len(index), 2):
+            for number in range(index[i], index[i] + index[i + 1]):
+                row = data[position:position + row_size]
+                position += row_size
+                fields = list()
+                field_start = 0
+                for width in widths:
+                    fields.append(int.from_bytes(row[field_start:field_start + width], 'big') if width > 0 else None)
+                    field_start += width
+                if fields[0] is None:
+                    # Type defaults to 1 when its width is 0.
+                    fields[0] = 1
+                entries[number] = tuple(fields)
+        return entries
+
+    def _lookup(self, fp, number):
+        """Find the newest xref entry for an object, returns ('offset', offset) or ('compressed', stream, index)."""
+        for (kind, section) in self._sections:
+            if kind == 'table':
+                (first, count, position) = section
+                if first <= number < first + count:
+                    fp.seek(position + (number - first) * 20)
+                    entry = re.match(rb"(\d{10}) (\d{5}) ([nf])", fp.read(20))
+                    if entry is None:
+                        raise ValueError("Bad xref entry for object {}".format(number))
+                    if entry.group(3) == b'f':
+                        raise ValueError("Object {} is free".format(number))
+                    return 'offset', int(entry.group(1))
+            elif number in section:
+                entry = section[number]
+                if entry[0] == 1:
+                    return 'offset', entry[1]
+                elif entry[0] == 2:
+                    return 'compressed', entry[1], entry[2]
+                raise ValueError("Object {} is free".format(number))
+        raise ValueError("Object {} not in xref".format(number))
+
+    def _read_object(self, fp, number):
+        """Return the bytes of an object (up to its stream or endobj)."""
+        location = self._lookup(fp, number)
+        if location[0] == 'offset':
+            fp.seek(location[1])
+            data = fp.read(self.object_size)
+            header = self.rxobj.match(data)
+            if header is None or int(header.group(1)) != number:
+                raise ValueError("Object {} is not at its xref offset".format(number))
+            data = data[header.end():]
+            end = [x for x in (data.find(b'endobj'), data.find(b'stream')) if x != -1]
+            return data[:min(end)] if len(end) > 0 else data
+        (stream_dict, stream_data) = self._read_stream(fp, self._lookup(fp, location[1])[1])
+        first = int(re.search(rb"/First\s+(\d+)", stream_dict).group(1))
+        pairs = [int(x) for x in stream_data[:first].split()]
+        offsets = pairs[1::2]
+        index = location[2]
+        if pairs[index * 2] != number:
+            raise ValueError("Object {} is not at its object stream index".format(number))
+        end = first + offsets[index + 1] if index + 1 < len(offsets) else len(stream_data)
+        return stream_data[first + offsets[index]:end]
+
+    def _read_stream(self, fp, offset):
+        """Read and decode the stream object at offset, returns the dictionary and the decoded data."""
+        fp.seek(offset)
+        data = fp.read(self.object_size)
+        if self.rxobj.match(data) is None:
+            raise ValueError("No object at offset {}".format(offset))
+        stream_start = data.find(b'stream')
+        if stream_start == -1:
+            raise ValueError("Object at offset {} is not a stream".format(offset))
+        dictionary = data[:stream_start]
+        data_start = offset + stream_start + 6
+        data_start += 2 if data[stream_start + 6:stream_start + 8] == b'\r\n' else 1
+        length = self.rxlength.search(dictionary)
+        if length is None:
+            raise ValueError("Stream has no /Length")
+        if length.group(2) is not None:
+            length_object = self._read_object(fp, int(length.group(1)))
+            length_value = int(length_object.split()[0])
+        else:
+            length_value = int(length.group(1))
+        fp.seek(data_start)
+        raw = fp.read(length_value)
+        filters = re.search(rb"/Filter\s*(\[[^\]]*\]|/\w+)", dictionary)
+        if filters is not None:
+            names = re.findall(rb"/(\w+)", filters.group(1))
+            if names != [b'FlateDecode']:
+                raise ValueError("Unsupported stream filter {}".format(filters.group(1)))
+            raw = zlib.decompress(raw)
+        predictor = re.search(rb"/Predictor\s+(\d+)", dictionary)
+        if predictor is not None and int(predictor.group(1)) >= 10:
+            columns = re.search(rb"/Columns\s+(\d+)", dictionary)
+            raw = self._undo_png_predictor(raw, int(columns.group(1)) if columns is not None else 1)
+        return dictionary, raw
+
+    @staticmethod
+    def _undo_png_predictor(data, columns):
+        """Reverse PNG row predictors (one byte per pixel, as used by xref streams)."""
+        output = bytearray()
+        previous = bytearray(columns)
+        for row_start in range(0, len(data), columns + 1):
+            filter_type = data[row_start]
+            row = bytearray(data[row_start + 1:row_start + 1 + columns])
+            for i in range(len(row)):
+                left = row[i - 1] if i > 0 else 0
+                up = previous[i]
+                up_left = previous[i - 1] if i > 0 else 0
+                if filter_type == 1:
+                    row[i] = (row[i] + left) & 0xff
+                elif filter_type == 2:
+                    row[i] = (row[i] + up) & 0xff
+                elif filter_type == 3:
+                    row[i] = (row[i] + ((left + up) >> 1)) & 0xff
+                elif filter_type == 4:
+                    p = left + up - up_left
+                    (pa, pb, pc) = (abs(p - left), abs(p - up), abs(p - up_left))
+                    row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else up_left)) & 0xff
+            output.extend(row)
+            previous = row
+        return bytes(output)
+
+    def _count_from_scan(self, fp):
+        """Count /Type /Page markers reading the file in overlapping windows."""
+        fp.seek(0)
+        count = 0
+        carry = b''
+        while True:
+            chunk = fp.read(self.window_size)
+            buffer = carry + chunk
+            if len(chunk) == 0:
+                cutoff = len(buffer)
+            else:
+                # Matches starting in the overlap are counted with the next window.
+                cutoff = max(0, len(buffer) - self.window_overlap)
+            count += len([m for m in self.rxcountpages.finditer(buffer) if m.start() < cutoff])
+            if len(chunk) == 0:
+                break
+            carry = buffer[cutoff:]
+        return count
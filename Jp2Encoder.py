@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+
+import os.path
+
+from PIL import Image, features
+
+from AsyncRunner import AsyncRunner
+from Metrics import Metrics
+
+
+class Jp2Encoder(object):
+    """Encode a page image as the JP2.jp2 datastream, with the program or library chosen by --jp2-encoder.
+
+    Every backend makes the same two profiles. Pages smaller than 1024 pixels or 300 dpi are reversible (lossless) with
+    5 levels and quality layers at 0.25, 0.5 and 1 bits per pixel under the lossless one. Other pages are irreversible
+    with 7 levels, 5 quality layers, the precincts below, 32x32 code blocks, RPCL order, SOP markers and PLT markers
+    with a tile-part per resolution, so viewers can fetch any region at any resolution without reading the whole file.
+    The lossy layers stop at the PSNRs below (kdu_compress picks its own from its quantization), the top one visually
+    lossless, so a page is only given the bits it needs.
+    """
+
+    """The backend classes by --jp2-encoder name"""
+    backends = dict()
+    """The name of the backend"""
+    name = None
+    """The program the backend runs, None if it encodes in-process"""
+    program = None
+    """Arguments to check the program is installed"""
+    check_var = None
+    """What the backend needs on the host, for the error when it isn't available"""
+    requirement = None
+    """Seconds an encode is allowed"""
+    timeout = 600
+    """Tiff compressions the backend reads, None for any"""
+    compressions = ['None']
+    """Bits per pixel of the quality layers below the lossless one"""
+    lossless_rates = [0.25, 0.5, 1]
+    lossless_levels = 5
+    lossy_layers = 5
+    """PSNR in dB of the lossy quality layers, lowest first, ratios would end in a layer of every coefficient"""
+    lossy_psnr = [30, 34, 38, 42, 46]
+    lossy_levels = 7
+    """Precinct sizes of the lossy profile, from the highest resolution down"""
+    lossy_precincts = [(256, 256), (256, 256), (256, 256), (128, 128), (128, 128), (64, 64), (64, 64), (32, 32),
+                       (16, 16)]
+    lossy_codeblock = (32, 32)
+
+    def __init__(self, logger):
+        """Set up the encoder.
+
+        Keyword arguments
+        logger -- The logger
+        """
+        self.logger = logger
+
+    @staticmethod
+    def create(name, logger):
+        """The encoder of a backend, by its --jp2-encoder name."""
+        return Jp2Encoder.backends[name](logger)
+
+    @staticmethod
+    def is_lossless(info):
+        """Whether a page gets the lossless profile, from its ImageInfo."""
+        return info.height < 1024 or info.width < 1024 or info.x_resolution < 300 or info.y_resolution < 300
+
+    @staticmethod
+    def quality_layers(info, lossless):
+        """The quality layers, for encoders that take compression ratios or PSNRs rather than bit rates.
+
+        Returns 'rates' and the compression ratios, highest first and the last 1 (everything that is left), for the
+        lossless profile, and 'dB' and lossy_psnr for the lossy one.
+        """
+        if lossless:
+            # Pages under 8 bits reach the encoder as 8 bit PGM/PPMs.
+            bits = max(8, info.depth) * (1 if info.colorspace == 'Gray' else 3)
+            return ('rates', [round(bits / rate, 2) for rate in Jp2Encoder.lossless_rates] + [1])
+        return ('dB', list(Jp2Encoder.lossy_psnr))
+
+    def available(self):
+        """Whether the backend can be used on this host."""
+        return True
+
+    def can_read(self, info):
+        """Whether the backend can encode an image directly, from its ImageInfo.
+
+        Images it can't are converted to an uncompressed greyscale or sRGB PGM/PPM for it first.
+        """
+        return (self.compressions is None or info.compression in self.compressions) and \
+            info.colorspace in ['sRGB', 'Gray'] and info.depth in [8, 16]
+
+    def command(self, input_file, output_file, info, lossless):
+        """The command line to encode a file, for backends that run a program."""
+        return None
+
+    def thread_args(self, threads):
+        """Arguments telling the program how many threads to use."""
+        return []
+
+    def encode(self, input_file, output_file, info, lossless, threads=None, cost=None):
+        """Encode an image as a JPEG2000.
+
+        Keyword arguments
+        input_file -- The image, a Tiff or PGM/PPM
+        output_file -- The JPEG2000 to write
+        info -- The ImageInfo of the page, it decides the profile and layer rates
+        lossless -- Use the lossless profile
+        threads -- Threads to encode with, None for the program's default
+        cost -- The memory and threads the call needs from the resource budget, which then sets the threads
+        Returns True if it succeeded.
+        """
+        ops = self.command(input_file, output_file, info, lossless)
+        if cost is None and threads is not None:
+            ops = ops + self.thread_args(threads)
+        return AsyncRunner.get().call(ops, logger=self.logger, timeout=self.timeout, cost=cost)
+
+
+class KakaduEncoder(Jp2Encoder):
+    """Encode with Kakadu's kdu_compress, which needs a licence on every host but is the fastest."""
+
+    name = 'kakadu'
+    program = 'kdu_compress'
+    check_var = '-version'
+    requirement = 'kdu_compress in the PATH'
+    timeout = 60
+    """Tiff compressions kdu_compress reads, it can read others if it was built with libtiff"""
+    compressions = ['None']
+
+    def command(self, input_file, output_file, info, lossless):
+        if lossless:
+            args = ['-quiet', 'Creversible=yes', '-rate', '-,' + ','.join(
+                str(rate) for rate in reversed(Jp2Encoder.lossless_rates)), 'Clevels={}'.format(
+                Jp2Encoder.lossless_levels)]
+        else:
+            args = ['-quiet', 'Clayers={}'.format(Jp2Encoder.lossy_layers),
+                    'Clevels={}'.format(Jp2Encoder.lossy_levels),
+                    'Cprecincts=' + ','.join('{{{},{}}}'.format(*size) for size in Jp2Encoder.lossy_precincts),
+                    'Corder=RPCL', 'ORGgen_plt=yes', 'ORGtparts=R',
+                    'Cblk={{{},{}}}'.format(*Jp2Encoder.lossy_codeblock), 'Cuse_sop=yes']
+        return ['kdu_compress', '-i', input_file, '-o', output_file] + args
+
+    def thread_args(self, threads):
+        return ['-num_threads', str(threads)]
+
+
+class OpenJpegEncoder(Jp2Encoder):
+    """Encode with OpenJPEG's opj_compress, free to install anywhere, -threads needs OpenJPEG 2.5."""
+
+    name = 'openjpeg'
+    program = 'opj_compress'
+    check_var = '-h'
+    requirement = 'opj_compress in the PATH'
+    """Tiff compressions opj_compress reads through libtiff"""
+    compressions = ['None', 'LZW', 'Zip', 'RLE']
+
+    def command(self, input_file, output_file, info, lossless):
+        (mode, layers) = Jp2Encoder.quality_layers(info, lossless)
+        layers = ['-r' if mode == 'rates' else '-q', ','.join('{:g}'.format(layer) for layer in layers)]
+        if lossless:
+            # Reversible is opj_compress's default, -n counts resolutions not levels.
+            args = ['-n', str(Jp2Encoder.lossless_levels + 1)] + layers
+        else:
+            args = ['-I', '-n', str(Jp2Encoder.lossy_levels + 1)] + layers + [
+                    '-c', ','.join('[{},{}]'.format(*size)
+                                   for size in Jp2Encoder.lossy_precincts[:Jp2Encoder.lossy_levels + 1]),
+                    '-p', 'RPCL', '-PLT', '-TP', 'R', '-b', '{},{}'.format(*Jp2Encoder.lossy_codeblock), '-SOP']
+        return ['opj_compress', '-i', input_file, '-o', output_file] + args
+
+    def thread_args(self, threads):
+        return ['-threads', str(threads)]
+
+
+class PillowJp2Encoder(Jp2Encoder):
+    """Encode in-process with Pillow's OpenJPEG, which needs no program on the host.
+
+    Pillow has no SOP markers and one precinct size for every resolution, and encodes with a single thread. It is
+    not admitted by the resource budget.
+    """
+
+    name = 'pillow'
+    requirement = 'Pillow built with OpenJPEG'
+    """Pillow reads every Tiff compression"""
+    compressions = None
+
+    def available(self):
+        return features.check('jpg_2000')
+
+    def encode(self, input_file, output_file, info, lossless, threads=None, cost=None):
+        try:
+            with Metrics.step('pillow-jp2', output_file):
+                with Image.open(input_file) as image:
+                    image.load()
+                    if image.mode in ['LA', 'RGBA']:
+                        image = image.convert(image.mode[:-1])
+                    elif image.mode == '1':
+                        # Bitonal pages stay one channel, as they are for the other backends.
+                        image = image.convert('L')
+                    elif image.mode not in ['L', 'RGB', 'I;16']:
+                        image = image.convert('I;16' if image.mode.startswith('I') else 'RGB')
+                    if lossless:
+                        settings = {'num_resolutions': Jp2Encoder.lossless_levels + 1}
+                    else:
+                        settings = {'num_resolutions': Jp2Encoder.lossy_levels + 1, 'irreversible': True,
+                                    'precinct_size': Jp2Encoder.lossy_precincts[0],
+                                    'codeblock_size': Jp2Encoder.lossy_codeblock, 'progression': 'RPCL',
+                                    'plt': True}
+                    (mode, layers) = Jp2Encoder.quality_layers(info, lossless)
+                    image.save(output_file, 'JPEG2000', quality_mode=mode, quality_layers=layers,
+                               mct=1 if image.mode == 'RGB' else 0, **settings)
+            return True
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            self.logger.info("Pillow can't encode {} ({})".format(input_file, e))
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            return False
+
+
+for backend in [KakaduEncoder, OpenJpegEncoder, PillowJp2Encoder]:
+    Jp2Encoder.backends[backend.name] = backend
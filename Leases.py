@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+
+import json
+import os
+import os.path
+import threading
+import time
+import uuid
+
+
+class Leases(object):
+    """Claim work with lease files on a filesystem shared by several nodes (ie. NFS), without any broker.
+
+    A lease is taken by hard linking a file we wrote to the lease name, which is atomic even over NFS. The holder
+    touches its leases every ttl/3 seconds, a lease that hasn't been touched for ttl seconds (measured by the shared
+    filesystem's clock, not ours) belongs to a dead node and may be broken by renaming it away. Finished work is
+    recorded with .done and .failed marker files next to the leases, a .done marker only counts for the same
+    fingerprint of the work (ie. of its source files). Markers record the run id shared by the nodes of a run, so a
+    node that starts late still sees what the others finished or failed in the same run.
+    """
+
+    def __init__(self, lease_dir, node_id, ttl, logger, overwrite=False, run_id=None):
+        """Set up the leases.
+
+        Keyword arguments
+        lease_dir -- The shared directory to keep the lease files in
+        node_id -- Identifies this node in the lease files
+        ttl -- Seconds without a heartbeat before a lease is considered abandoned
+        logger -- The logger
+        overwrite -- Redo work marked done by another run
+        run_id -- Identifies the run, the same on every node taking part in it
+        """
+        self.lease_dir = lease_dir
+        self.node_id = node_id
+        self.ttl = ttl
+        self.logger = logger
+        self.overwrite = overwrite
+        self.run_id = run_id
+        self.heartbeat_interval = ttl / 3.0
+        """Lease name to the token written in it, for the leases we hold"""
+        self.held = dict()
+        """Leases we held that another node broke"""
+        self.lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self.started = self.server_time()
+
+    def _path(self, name):
+        return os.path.join(self.lease_dir, name + '.lease')
+
+    def server_time(self):
+        """The time on the shared filesystem, so nodes with skewed clocks agree on when a lease is stale."""
+        clock_file = os.path.join(self.lease_dir, '.clock.' + self.node_id)
+        with open(clock_file, 'a'):
+            os.utime(clock_file, None)
+        return os.stat(clock_file).st_mtime
+
+    def start(self):
+        """Start the heartbeat thread."""
+        self._thread = threading.Thread(target=self._heartbeat, name='lease-heartbeat', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the heartbeat thread and release anything still held."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for name in list(self.held.keys()):
+            self.release(name)
+        try:
+            os.remove(os.path.join(self.lease_dir, '.clock.' + self.node_id))
+        except FileNotFoundError:
+            pass
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                for name in list(self.held.keys()):
+                    if self._refresh(name):
+                        continue
+                    # A node that moved it away while it was being refreshed puts it back, look again first.
+                    time.sleep(1)
+                    if not self._refresh(name):
+                        self.logger.error("Lease {} was broken or taken over by another node".format(name))
+                        self.lost.add(name)
+                        del self.held[name]
+
+    def _refresh(self, name):
+        """Touch a lease if it is still ours, returns False if it isn't."""
+        if not self.holds(name):
+            return False
+        try:
+            os.utime(self._path(name), None)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def holds(self, name):
+        """Check the lease file still has our token in it."""
+        token = self.held.get(name)
+        if token is None:
+            return False
+        try:
+            with open(self._path(name), 'r') as fp:
+                return json.load(fp).get('token') == token
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def claim(self, name):
+        """Try to take a lease, breaking it first if its holder stopped heartbeating.
+
+        Returns True if we now hold it.
+        """
+        lease_file = self._path(name)
+        if os.path.exists(lease_file) and not self._break_if_stale(name):
+            return False
+        token = "{}:{}".format(self.node_id, uuid.uuid4().hex)
+        temp_file = os.path.join(self.lease_dir, ".{}.{}".format(name, uuid.uuid4().hex))
+        with open(temp_file, 'w') as fp:
+            json.dump({'node': self.node_id, 'pid': os.getpid(), 'token': token, 'claimed': time.time()}, fp)
+        try:
+            os.link(temp_file, lease_file)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            # Over NFS the link can succeed and still report an error if the reply was lost, the link count below
+            # is what tells us.
+            self.logger.debug("Linking lease {} reported {}".format(name, e))
+        try:
+            claimed = os.stat(temp_file).st_nlink == 2
+        finally:
+            os.remove(temp_file)
+        if claimed:
+            with self._lock:
+                self.held[name] = token
+            self.logger.debug("Claimed lease {}".format(name))
+        return claimed
+
+    def _break_if_stale(self, name):
+        """Break a lease whose holder has stopped heartbeating.
+
+        Returns True if the lease is gone.
+        """
+        lease_file = self._path(name)
+        try:
+            stat = os.stat(lease_file)
+            age = self.server_time() - stat.st_mtime
+        except FileNotFoundError:
+            return True
+        if age <= self.ttl:
+            return False
+        # Only one node's rename can succeed, the holder's next heartbeat will find it gone.
+        stale_file = os.path.join(self.lease_dir, ".{}.stale.{}".format(name, uuid.uuid4().hex))
+        try:
+            os.rename(lease_file, stale_file)
+        except FileNotFoundError:
+            return True
+        try:
+            moved = os.stat(stale_file)
+            if (moved.st_ino, moved.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+                # Since we looked at it the lease was refreshed, or broken and claimed again by another node, so it
+                # isn't stale. Put it back unless yet another node has claimed it meanwhile, then its holder will find
+                # it lost.
+                self.logger.debug("Lease {} changed while breaking it, putting it back".format(name))
+                try:
+                    os.link(stale_file, lease_file)
+                except FileExistsError:
+                    pass
+                return False
+            try:
+                with open(stale_file, 'r') as fp:
+                    holder = json.load(fp).get('node')
+            except ValueError:
+                holder = None
+            self.logger.warning("Broke lease {} held by {}, no heartbeat for {:.0f}s".format(name, holder, age))
+            return True
+        finally:
+            os.remove(stale_file)
+
+    def release(self, name):
+        """Give up a lease we hold."""
+        with self._lock:
+            held = self.holds(name)
+            self.held.pop(name, None)
+            if held:
+                try:
+                    os.remove(self._path(name))
+                except FileNotFoundError:
+                    pass
+                self.logger.debug("Released lease {}".format(name))
+
+    def _write_marker(self, name, suffix, message=None, fingerprint=None):
+        marker_file = os.path.join(self.lease_dir, name + suffix)
+        temp_file = os.path.join(self.lease_dir, ".{}{}.{}".format(name, suffix, uuid.uuid4().hex))
+        with open(temp_file, 'w') as fp:
+            json.dump({'node': self.node_id, 'run': self.run_id, 'time': time.time(), 'message': message,
+                       'fingerprint': fingerprint}, fp)
+        os.replace(temp_file, marker_file)
+
+    def mark_done(self, name, fingerprint=None):
+        self._write_marker(name, '.done', fingerprint=fingerprint)
+
+    def mark_failed(self, name, message):
+        self._write_marker(name, '.failed', message)
+
+    def is_done(self, name, fingerprint=None):
+        """Check some work was finished, with the same fingerprint.
+
+        With overwrite set, work finished by another run is done again.
+        """
+        marker_file = os.path.join(self.lease_dir, name + '.done')
+        try:
+            with open(marker_file, 'r') as fp:
+                marker = json.load(fp)
+            if self.overwrite and marker.get('run') != self.run_id:
+                return False
+            return marker.get('fingerprint') == fingerprint
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def failure(self, name):
+        """The failure message of some work, if it failed during this run.
+
+        Failures from another run, or without a run id from before this node started, are ignored so a rerun retries
+        them.
+        """
+        marker_file = os.path.join(self.lease_dir, name + '.failed')
+        try:
+            if self.run_id is None and os.stat(marker_file).st_mtime < self.started:
+                return None
+            with open(marker_file, 'r') as fp:
+                marker = json.load(fp)
+            if self.run_id is not None and marker.get('run') != self.run_id:
+                return None
+            return marker.get('message') or 'failed'
+        except (FileNotFoundError, ValueError):
+            return None
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+
+import json
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+
+class Manifest(object):
+    """Record the state of every generated file so reruns can skip finished work and redo anything partial or stale.
+
+    Each output is keyed by its book directory, page number (0 for the book level) and stage (the output filename).
+    Without a database file this falls back to the old behaviour of trusting any file that exists.
+    """
+
+    """Status of an output that is being generated, a killed run leaves these behind."""
+    RUNNING = 'running'
+    """Status of a completely generated output."""
+    DONE = 'done'
+    """Status of an output that failed to generate."""
+    FAILED = 'failed'
+
+    """Number of manifest fingerprints remembered"""
+    max_fingerprints = 4096
+
+    def __init__(self, filename, options, logger, read_only=False, adopt=True):
+        """Set up the manifest.
+
+        Keyword arguments
+        filename -- The database file, or None to trust any file that exists
+        options -- The options, overwrite and run_started are used
+        logger -- The logger
+        read_only -- Open the database read only (ie. for --plan)
+        adopt -- Trust files that exist but were never recorded, otherwise they are generated again
+        """
+        self.filename = filename
+        self.options = options
+        self.logger = logger
+        self.read_only = read_only
+        self.adopt = adopt
+        self._local = threading.local()
+        # (path, size, mtime) of inputs we generated to their manifest fingerprint.
+        self._fingerprints = dict()
+
+    def enabled(self):
+        return self.filename is not None
+
+    def _db(self):
+        """Get the database connection, every process (ie. pool workers) and thread opens its own."""
+        if getattr(self._local, 'pid', None) != os.getpid():
+            if self.read_only:
+                connection = sqlite3.connect('file:{}?mode=ro'.format(self.filename), uri=True, timeout=120)
+            else:
+                # Autocommit and the default rollback journal, WAL needs shared memory which NFS doesn't give us.
+                connection = sqlite3.connect(self.filename, timeout=120, isolation_level=None)
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS stages (book TEXT NOT NULL, page INTEGER NOT NULL, "
+                    "stage TEXT NOT NULL, status TEXT NOT NULL, fingerprint TEXT, params TEXT, started REAL, "
+                    "finished REAL, duration REAL, output_size INTEGER, PRIMARY KEY (book, page, stage))")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    @staticmethod
+    def key(output_file):
+        """Split an output path into the book directory, page number and stage."""
+        (parent, stage) = os.path.split(output_file)
+        (book, page) = os.path.split(parent)
+        if page.isdigit():
+            return book, int(page), stage
+        return parent, 0, stage
+
+    @staticmethod
+    def params_string(params):
+        return json.dumps(params, sort_keys=True) if params is not None else ''
+
+    def lookup(self, output_file):
+        """Return the row for an output as a dict or None if it was never recorded."""
+        row = self._db().execute(
+            "SELECT status, fingerprint, params, started, finished, duration, output_size FROM stages "
+            "WHERE book = ? AND page = ? AND stage = ?", Manifest.key(output_file)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['status', 'fingerprint', 'params', 'started', 'finished', 'duration', 'output_size'], row))
+
+    def is_complete(self, output_file):
+        """Check, without changing anything, if an output would be skipped by needs_output."""
+        if self.options.overwrite:
+            return False
+        if self.enabled():
+            row = self.lookup(output_file)
+            if row is not None:
+                return row['status'] == Manifest.DONE
+        return os.path.exists(output_file)
+
+    def stage_statistics(self):
+        """Return a dict of stage to the number, average duration and average size of its completed outputs."""
+        if not self.enabled():
+            return dict()
+        rows = self._db().execute(
+            "SELECT stage, COUNT(*), AVG(duration), AVG(output_size) FROM stages WHERE status = ? AND duration IS NOT "
+            "NULL GROUP BY stage", (Manifest.DONE,)).fetchall()
+        return dict([(row[0], {'count': row[1], 'duration': row[2], 'size': row[3]}) for row in rows])
+
+    def fingerprint(self, input_file):
+        """Fingerprint an input, by its manifest record if we generated it or by its size and modification time.
+
+        The file is looked at on every call, so a source replaced under the same name (ie. in --watch) is seen.
+        """
+        if input_file is None:
+            return ''
+        stat = os.stat(input_file)
+        key = (input_file, stat.st_size, stat.st_mtime_ns)
+        if key in self._fingerprints:
+            return self._fingerprints[key]
+        row = self.lookup(input_file) if self.enabled() else None
+        if row is None or row['status'] != Manifest.DONE:
+            return "s:{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        if len(self._fingerprints) >= Manifest.max_fingerprints:
+            self._fingerprints.clear()
+        self._fingerprints[key] = "m:{}:{}".format(row['finished'], row['output_size'])
+        return self._fingerprints[key]
+
+    def needs_output(self, output_file, input_file=None, params=None):
+        """Check if an output needs to be generated.
+
+        An output that is incomplete, stale or (with --overwrite) exists is deleted first.
+
+        Keyword arguments
+        output_file -- The file to generate
+        input_file -- The file it is generated from, used to detect stale outputs
+        params -- dict of the settings used to generate it
+        """
+        if not self.enabled():
+            if self.options.overwrite and self._made_this_run(output_file, None, None, None):
+                return False
+            if os.path.exists(output_file) and os.path.isfile(output_file) and self.options.overwrite:
+                # Delete the file if it exists AND we set --overwrite
+                os.remove(output_file)
+                self.logger.debug("{} exists and we are deleting it.".format(output_file))
+            return not os.path.exists(output_file)
+        fingerprint = self.fingerprint(input_file)
+        params_string = Manifest.params_string(params)
+        row = self.lookup(output_file)
+        if self.options.overwrite and self._made_this_run(output_file, row, fingerprint, params_string):
+            return False
+        if not self.options.overwrite:
+            if row is not None and row['status'] == Manifest.DONE and row['fingerprint'] == fingerprint and \
+                    row['params'] == params_string:
+                return False
+            if row is None and os.path.exists(output_file) and self.adopt:
+                # Made before we had a manifest, trust it like we used to.
+                self.logger.debug("{} exists but is not in the manifest, adopting it.".format(output_file))
+                self._record(output_file, Manifest.DONE, fingerprint, params_string, None, None,
+                             os.path.getsize(output_file))
+                return False
+        if os.path.exists(output_file) and os.path.isfile(output_file):
+            self.logger.debug("{} exists but is {}, deleting it.".format(
+                output_file, 'being overwritten' if self.options.overwrite else 'incomplete or stale'))
+            os.remove(output_file)
+        self._record(output_file, Manifest.RUNNING, fingerprint, params_string, time.time(), None, None)
+        return True
+
+    def _made_this_run(self, output_file, row, fingerprint, params_string):
+        """Check if an output was already generated by this run (ie. by a one pass split), --overwrite keeps those.
+
+        The run's start is the run_started option, without it nothing counts as made by this run. Without a database
+        the file's modification time is compared to it.
+        """
+        started = getattr(self.options, 'run_started', None)
+        if started is None or not os.path.isfile(output_file):
+            return False
+        if not self.enabled():
+            return os.path.getmtime(output_file) >= started
+        return row is not None and row['status'] == Manifest.DONE and row['finished'] is not None and \
+            row['finished'] >= started and row['fingerprint'] == fingerprint and row['params'] == params_string
+
+    def output_done(self, output_file, shared=1):
+        """Mark an output as completely generated.
+
+        Keyword arguments
+        output_file -- The file that was generated
+        shared -- The number of outputs made by the same call, its time is divided between them
+        """
+        if not self.enabled():
+            return
+        if not os.path.exists(output_file):
+            self.output_failed(output_file)
+            return
+        finished = time.time()
+        self._db().execute(
+            "UPDATE stages SET status = ?, finished = ?, duration = (? - started) / ?, output_size = ? "
+            "WHERE book = ? AND page = ? AND stage = ?",
+            (Manifest.DONE, finished, finished, shared, os.path.getsize(output_file)) + Manifest.key(output_file))
+
+    def output_failed(self, output_file):
+        """Mark an output as failed so the next run generates it again."""
+        if not self.enabled():
+            return
+        self._db().execute("UPDATE stages SET status = ? WHERE book = ? AND page = ? AND stage = ?",
+                           (Manifest.FAILED,) + Manifest.key(output_file))
+
+    def _record(self, output_file, status, fingerprint, params_string, started, duration, output_size):
+        finished = time.time() if status == Manifest.DONE else None
+        self._db().execute(
+            "INSERT OR REPLACE INTO stages (book, page, stage, status, fingerprint, params, started, finished, duration, "
+            "output_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            Manifest.key(output_file) + (status, fingerprint, params_string, started, finished, duration, output_size))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+
+import os
+import os.path
+
+from PIL import Image, ImageChops
+
+from AsyncRunner import AsyncRunner
+from Derivatives import Derivatives
+from ImageInfo import ImageInfo
+from Jp2Encoder import Jp2Encoder
+from Metrics import Metrics
+
+
+class MasterProfile(object):
+    """The colorspace, bit depth and compression the OBJ.tiff masters are kept in.
+
+    With the defaults (auto) it is decided for each page: a page of only black and white is kept as 1 bit Group 4, a
+    greyscale page (including a colour render whose channels are all equal) as 8 bit greyscale and anything else as 8
+    bit sRGB. The compression of the source is kept if the --jp2-encoder reads it (kdu_compress only reads uncompressed
+    Tiffs, opj_compress LZW, Zip and PackBits too), otherwise the master is uncompressed. That is what the derivatives
+    read, the JPGs and tesseract want sRGB or greyscale, so no later stage converts the master again. Any of the three
+    can be fixed instead, ie. --master-colorspace=CMYK --master-depth=8 --master-compression=None as before.
+    """
+
+    colorspaces = ['auto', 'sRGB', 'Gray', 'CMYK']
+    depths = ['auto', '8', '16']
+    """Compressions that can be chosen, Group4 is only for the 1 bit pages of auto"""
+    compression_choices = ['auto', 'None', 'LZW', 'Zip']
+    """Master compressions, and the names Pillow and ImageMagick write each with"""
+    compressions = {'None': ('raw', 'None'), 'LZW': ('tiff_lzw', 'LZW'), 'Zip': ('tiff_adobe_deflate', 'Zip'),
+                    'RLE': ('packbits', 'RLE'), 'JPEG': ('jpeg', 'JPEG'), 'Group4': ('group4', 'Group4')}
+    """Compressions of the source that auto keeps when a page has to be written again, the others are lossy"""
+    lossless = ['LZW', 'Zip', 'RLE']
+    """The side of the blocks a page is averaged in for a first, cheap look for colour"""
+    reduce_factor = 8
+    """The Ghostscript device rendering PDF pages in each colorspace"""
+    gs_devices = {'auto': 'tiff24nc', 'sRGB': 'tiff24nc', 'Gray': 'tiffgray', 'CMYK': 'tiff32nc'}
+    """The ImageMagick -type of each colorspace and depth"""
+    image_types = {('sRGB', 8): 'TrueColor', ('sRGB', 16): 'TrueColor', ('Gray', 1): 'Bilevel',
+                   ('Gray', 8): 'Grayscale', ('Gray', 16): 'Grayscale', ('CMYK', 8): 'ColorSeparation',
+                   ('CMYK', 16): 'ColorSeparation'}
+
+    def __init__(self, options, logger):
+        """Set up the profile.
+
+        Keyword arguments
+        options -- The options, master_colorspace, master_depth and master_compression are used
+        logger -- The logger
+        """
+        self.colorspace = options.master_colorspace
+        self.depth = options.master_depth
+        self.compression = options.master_compression
+        if getattr(options, 'skip_jp2', False):
+            self.readable = None
+        else:
+            self.readable = Jp2Encoder.backends[getattr(options, 'jp2_encoder', 'kakadu')].compressions
+        self.logger = logger
+
+    def settings(self):
+        """The profile as a dict, for the params of the masters."""
+        settings = {'colorspace': self.colorspace, 'depth': self.depth, 'compression': self.compression}
+        if self.compression == 'auto':
+            settings['readable'] = self.readable
+        return settings
+
+    def convert_args(self):
+        """Arguments for convert to render a PDF page in the master colorspace, the rest is done by conform."""
+        if self.colorspace == 'auto':
+            # ImageMagick already writes pages with no colour as greyscale.
+            return ['-colorspace', 'sRGB']
+        return ['-colorspace', self.colorspace, '-type', MasterProfile.image_types[(self.colorspace, 8)]]
+
+    def gs_device(self):
+        """The Ghostscript device to render PDF pages with."""
+        return MasterProfile.gs_devices[self.colorspace]
+
+    def target(self, info, image):
+        """The colorspace, bit depth and compression a page is kept in.
+
+        Keyword arguments
+        info -- The ImageInfo of the page
+        image -- The page decoded by Pillow, or None if it couldn't be
+        """
+        bilevel = info.depth == 1
+        grey = info.colorspace == 'Gray' or bilevel
+        if image is not None and self.colorspace == 'auto' and image.mode == 'RGB':
+            # Averages of grey pixels are grey, so most colour pages are told apart on the reduced page alone.
+            grey = self._is_grey(image.reduce(MasterProfile.reduce_factor)) and self._is_grey(image)
+        if image is not None and self.depth == 'auto' and grey and not bilevel and image.mode in ['L', 'RGB']:
+            histogram = image.histogram()[:256]
+            bilevel = sum(histogram) == histogram[0] + histogram[255]
+        if self.colorspace != 'auto':
+            colorspace = self.colorspace
+        else:
+            colorspace = 'Gray' if grey else 'sRGB'
+        if self.depth != 'auto':
+            depth = int(self.depth)
+        else:
+            depth = 1 if bilevel and colorspace == 'Gray' else 8
+        if self.compression != 'auto':
+            compression = self.compression
+        elif depth == 1:
+            compression = 'Group4'
+        elif self.readable is not None and info.compression not in self.readable:
+            compression = 'None'
+        elif info.colorspace == colorspace and info.depth == depth:
+            compression = info.compression
+        else:
+            # The page is written again anyway, don't compress it lossy a second time.
+            compression = info.compression if info.compression in MasterProfile.lossless else 'None'
+        return (colorspace, depth, compression)
+
+    def needs_pixels(self, info):
+        """Whether deciding the target of a page needs its pixels, not just its headers.
+
+        Only uncompressed pages are decoded to look for colour, compressed ones are taken as their headers say unless
+        they are written again anyway.
+        """
+        return info.compression == 'None' and (
+            (self.colorspace == 'auto' and info.colorspace == 'sRGB') or
+            (self.depth == 'auto' and info.colorspace == 'Gray' and info.depth == 8))
+
+    @staticmethod
+    def _is_grey(image):
+        """Whether the channels of an RGB image are all equal."""
+        (red, green, blue) = image.split()
+        return ImageChops.difference(red, green).getbbox() is None and \
+            ImageChops.difference(green, blue).getbbox() is None
+
+    def conform(self, tiff_file):
+        """Rewrite a master in the profile, unless it already is.
+
+        It is decoded at most once, by Pillow or by convert for what Pillow can't hold (ie. 16 bit colour).
+        Returns True if the file was rewritten.
+        """
+        info = ImageInfo.probe(tiff_file, logger=self.logger)
+        if info is None or info.width is None:
+            self.logger.warning("Unable to read {}, the master is left as it is".format(tiff_file))
+            return False
+        image = None
+        partial_file = tiff_file + '.conform'
+        try:
+            with Metrics.step('master', tiff_file):
+                if self.needs_pixels(info) or not self._matches(info, self.target(info, None)):
+                    image = self._open(tiff_file)
+                (colorspace, depth, compression) = self.target(info, image)
+                if self._matches(info, (colorspace, depth, compression)):
+                    return False
+                self.logger.debug("Keeping {} as {} {} bit {}".format(tiff_file, colorspace, depth, compression))
+                if image is None or (depth == 16 and colorspace != 'Gray') or \
+                        not self._save_pillow(image, info, (colorspace, depth, compression), partial_file):
+                    op = ['convert', tiff_file + '[0]', '-alpha', 'off', '-colorspace', colorspace,
+                          '-type', MasterProfile.image_types[(colorspace, depth)], '-depth', str(depth),
+                          '-compress', MasterProfile.compressions[compression][1], 'TIFF:' + partial_file]
+                    if not AsyncRunner.get().call(op, logger=self.logger, timeout=600):
+                        self.logger.warning("Unable to convert {}, the master is left as it is".format(tiff_file))
+                        return False
+                os.replace(partial_file, tiff_file)
+            return True
+        finally:
+            if image is not None:
+                image.close()
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+
+    @staticmethod
+    def _matches(info, target):
+        (colorspace, depth, compression) = target
+        return info.colorspace == colorspace and info.depth == depth and info.compression == compression
+
+    def _open(self, tiff_file):
+        """Decode a page with Pillow, None if it can't."""
+        try:
+            image = Image.open(tiff_file)
+            image.load()
+            return image
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            self.logger.debug("Pillow can't decode {} ({}), using convert".format(tiff_file, e))
+            return None
+
+    def _save_pillow(self, image, info, target, partial_file):
+        """Convert a decoded page and write it, returns False if Pillow can't."""
+        (colorspace, depth, compression) = target
+        if colorspace == 'CMYK':
+            converted = image if image.mode == 'CMYK' else Derivatives.output_colorspace(image).convert('CMYK')
+        else:
+            converted = Derivatives.output_colorspace(image)
+            if colorspace == 'Gray' and depth == 16 and image.mode in ['I;16', 'I;16B']:
+                converted = image
+            elif colorspace == 'Gray':
+                converted = converted.convert('L')
+                if depth == 1:
+                    converted = converted.convert('1', dither=Image.NONE)
+                elif depth == 16:
+                    converted = converted.convert('I').point(lambda value: value * 257).convert('I;16')
+            else:
+                converted = converted.convert('RGB')
+        try:
+            converted.save(partial_file, format='TIFF', compression=MasterProfile.compressions[compression][0],
+                           dpi=(info.x_resolution, info.y_resolution))
+        except (OSError, ValueError) as e:
+            self.logger.debug("Pillow can't write {} ({}), using convert".format(partial_file, e))
+            return False
+        return True
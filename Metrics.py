@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+
+import contextlib
+import contextvars
+import json
+import os
+import os.path
+import resource
+import socket
+import threading
+import time
+
+
+class Metrics(object):
+    """Record the wall time, CPU time, peak memory, status and bytes written of every external call and in-process step.
+
+    Records are tagged with the book, page and stage they were made for and appended to a JSON-lines file, every
+    process (ie. pool workers) appends to the same file. At the end of a run the records are summarised into a
+    Prometheus textfile-collector file. Without a metrics file nothing is recorded.
+    """
+
+    """The Metrics of the current process, used by the static Derivatives.do_system_call."""
+    active = None
+    """The book, page and stage the current work is for."""
+    _tags = contextvars.ContextVar('metrics_tags', default={})
+
+    def __init__(self, metrics_file, run_id, logger):
+        """Set up the recorder.
+
+        Keyword arguments
+        metrics_file -- The JSON-lines file to append to, or None to disable metrics
+        run_id -- Identifies the records of this run in the file
+        logger -- The logger
+        """
+        self.metrics_file = metrics_file
+        self.run_id = run_id
+        self.logger = logger
+        self.host = socket.gethostname()
+        self._fp = None
+        self._fp_pid = None
+        self._fp_lock = threading.Lock()
+
+    def enabled(self):
+        return self.metrics_file is not None
+
+    def install(self):
+        """Make this the recorder used by do_system_call in this process."""
+        Metrics.active = self
+
+    @staticmethod
+    @contextlib.contextmanager
+    def tags(**tags):
+        """Tag all the records made inside the with block, ie. tags(book=book_dir, page=3) or tags(stage='JP2.jp2')."""
+        token = Metrics._tags.set(dict(Metrics._tags.get(), **tags))
+        try:
+            yield
+        finally:
+            Metrics._tags.reset(token)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def step(name, output_file=None):
+        """Time an in-process step (ie. building a PDF or copying a file) with the active recorder.
+
+        Keyword arguments
+        name -- The name of the step
+        output_file -- The file the step writes, its size is recorded as the bytes written
+        """
+        recorder = Metrics.active
+        if recorder is None or not recorder.enabled():
+            yield
+            return
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        status = 0
+        try:
+            yield
+        except BaseException:
+            status = 1
+            raise
+        finally:
+            written = None
+            if output_file is not None and os.path.exists(output_file):
+                written = os.path.getsize(output_file)
+            recorder.record('step', name, time.perf_counter() - start_wall, time.thread_time() - start_cpu, 0.0,
+                            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, status, written)
+
+    def record_call(self, ops, wall, rusage, returncode):
+        """Record an external call.
+
+        Keyword arguments
+        ops -- The executable and arguments
+        wall -- The wall time in seconds
+        rusage -- The resource usage of the child from os.wait4
+        returncode -- The exit status, -9 if it was killed after a timeout
+        """
+        if not self.enabled():
+            return
+        if rusage is None:
+            self.record('call', os.path.basename(ops[0]), wall, None, None, None, returncode, None)
+        else:
+            # ru_oublock is counted in 512 byte blocks.
+            self.record('call', os.path.basename(ops[0]), wall, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                        returncode, rusage.ru_oublock * 512)
+
+    def record(self, kind, name, wall, cpu_user, cpu_system, max_rss_kb, status, bytes_written):
+        """Append a record to the metrics file."""
+        record = {'run': self.run_id, 'time': time.time(), 'host': self.host, 'pid': os.getpid(), 'kind': kind,
+                  'name': name, 'wall': wall, 'cpu_user': cpu_user, 'cpu_system': cpu_system,
+                  'max_rss_kb': max_rss_kb, 'status': status, 'bytes_written': bytes_written}
+        record.update(Metrics._tags.get())
+        with self._fp_lock:
+            if self._fp is None or self._fp_pid != os.getpid():
+                # Line buffered append, each record is a single write so processes don't interleave.
+                self._fp = open(self.metrics_file, 'a', buffering=1, encoding='utf-8')
+                self._fp_pid = os.getpid()
+            self._fp.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def summarise(self):
+        """Total the records of this run (or of every run if run_id is None) by stage and name.
+
+        Returns a dict of (kind, stage, name) to a dict of totals.
+        """
+        totals = dict()
+        if not self.enabled() or not os.path.exists(self.metrics_file):
+            return totals
+        with open(self.metrics_file, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partial line from a killed process.
+                    continue
+                if self.run_id is not None and record.get('run') != self.run_id:
+                    continue
+                key = (record['kind'], record.get('stage') or '', record['name'])
+                total = totals.setdefault(key, {'count': 0, 'failures': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_kb': 0,
+                                                'bytes_written': 0})
+                total['count'] += 1
+                if record['status'] != 0:
+                    total['failures'] += 1
+                total['wall'] += record['wall']
+                total['cpu'] += (record['cpu_user'] or 0) + (record['cpu_system'] or 0)
+                total['max_rss_kb'] = max(total['max_rss_kb'], record['max_rss_kb'] or 0)
+                total['bytes_written'] += record['bytes_written'] or 0
+        return totals
+
+    def write_prometheus(self, prom_file):
+        """Write the summary of this run for the Prometheus node exporter textfile collector.
+
+        Keyword arguments
+        prom_file -- The .prom file to write, it is replaced atomically so the collector never reads half of it
+        """
+        metrics = [
+            ('count', 'calls_total', 'counter', 'Number of calls or steps.', 1),
+            ('failures', 'failures_total', 'counter', 'Number of calls or steps that failed.', 1),
+            ('wall', 'wall_seconds_total', 'counter', 'Wall time spent.', 1),
+            ('cpu', 'cpu_seconds_total', 'counter', 'User and system CPU time spent.', 1),
+            ('max_rss_kb', 'max_rss_bytes', 'gauge', 'Largest peak resident memory of a single call.', 1024),
+            ('bytes_written', 'written_bytes_total', 'counter', 'Bytes written.', 1),
+        ]
+        totals = self.summarise()
+        lines = list()
+        for (field, suffix, metric_type, help_text, scale) in metrics:
+            name = 'multipage2book_stage_' + suffix
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for ((kind, stage, tool), total) in sorted(totals.items()):
+                lines.append('{}{{kind="{}",stage="{}",name="{}",host="{}"}} {}'.format(
+                    name, kind, Metrics._escape(stage), Metrics._escape(tool), Metrics._escape(self.host),
+                    total[field] * scale))
+        partial_file = prom_file + '.partial.{}'.format(os.getpid())
+        with open(partial_file, 'w', encoding='utf-8') as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(partial_file, prom_file)
+        self.logger.debug("Wrote metrics summary to {}".format(prom_file))
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+
+import argparse
+import logging
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import PyPDF2
+from PIL import Image
+
+from Derivatives import Derivatives
+from Manifest import Manifest
+from DerivativeCache import DerivativeCache
+from ImageInfo import ImageInfo, TiffReader
+from MasterProfile import MasterProfile
+from Scratch import Scratch
+
+
+class PageSplitter(object):
+    """Split a multi-page source file into its page directories in one pass."""
+
+    """Ghostscript pdfwrite arguments that leave out the dates and IDs, so a page split again has the same bytes"""
+    reproducible_args = ['-dOmitInfoDate', '-dOmitID', '-dOmitXMP']
+
+    def __init__(self, options, logger, manifest=None, cache=None, scratch=None):
+        self.logger = logger
+        self.options = options
+        if manifest is None:
+            manifest = Manifest(None, options, logger)
+        self.manifest = manifest
+        if cache is None:
+            cache = DerivativeCache(None, 0, logger)
+        self.cache = cache
+        if scratch is None:
+            scratch = Scratch(None, 0, logger)
+        self.scratch = scratch
+        self.master_profile = MasterProfile(options, logger)
+
+    def _tiff_reader(self, tiff_file):
+        """Get the TiffReader the probe of the file walked its IFD chain with, so counting and bursting share it."""
+        info = ImageInfo.probe(tiff_file, logger=self.logger)
+        if info is not None and info.reader is not None:
+            return info.reader
+        return TiffReader(tiff_file)
+
+    def rasterize_pdf(self, pdf, pages, threads=None):
+        """Render the OBJ.tiff of every page of a PDF with one Ghostscript call.
+
+        By default pages are rendered at 125% of --resolution and resized to 75% with a single mogrify, like get_tiff
+        does one page at a time. With --raster-direct they are rendered straight at --resolution with anti-aliasing
+        instead. Pages that already exist are skipped unless --overwrite is set, anything that could not be rendered
+        is left for get_tiff.
+
+        Keyword arguments
+        pdf -- The full path to the PDF file
+        pages -- list of tuples of the page in the source file and the directory to save it to
+        threads -- Ghostscript rendering threads, defaults to --jobs
+        """
+        needed = list()
+        for (page, out_dir) in pages:
+            output_file = os.path.join(out_dir, 'OBJ.tiff')
+            params = self.tiff_params(page)
+            if self.manifest.needs_output(output_file, input_file=pdf, params=params):
+                if self.cache.fetch(output_file, [pdf], params):
+                    self.manifest.output_done(output_file)
+                else:
+                    needed.append((page, output_file))
+        if len(needed) == 0:
+            self.logger.debug("All pages of {} are already rasterized".format(pdf))
+            return
+        with self.scratch.staged(os.path.dirname(os.path.dirname(needed[0][1])), []) as work_dir:
+            self._rasterize_pages(pdf, needed, work_dir,
+                                  threads if threads is not None else getattr(self.options, 'jobs', 1))
+
+    def tiff_params(self, page):
+        """The settings of an OBJ.tiff rendered from a page of a PDF, whether rasterize_pdf or get_tiff made it."""
+        return {'page': page, 'resolution': self.options.resolution,
+                'direct': self.options.rasterize == 'document' and self.options.raster_direct,
+                'master': self.master_profile.settings()}
+
+    def tiff_page_params(self, page):
+        """The settings of an OBJ.tiff from a page of a multi-page Tiff, whether burst_tiff or get_tiff_page made it."""
+        return {'page': page, 'master': self.master_profile.settings()}
+
+    def _rasterize_pages(self, pdf, needed, work_dir, threads):
+        """Render the pages into a directory of this call's own under work_dir, then publish each as its OBJ.tiff."""
+        first_page = min([page for (page, output_file) in needed])
+        last_page = max([page for (page, output_file) in needed])
+        # Other jobs and nodes render other pages of the book at the same time.
+        raster_dir = tempfile.mkdtemp(prefix='.raster.', dir=work_dir)
+        try:
+            if self.options.raster_direct:
+                resolution = self.options.resolution
+            else:
+                # Increase density by 25%, then resize to only 75%
+                resolution = int(self.options.resolution * 1.25)
+            self.logger.debug("Rasterizing pages {} to {} of {} at {}".format(first_page, last_page, pdf, resolution))
+            op = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE={}'.format(self.master_profile.gs_device()),
+                  '-r{}'.format(resolution),
+                  '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
+                  '-dNumRenderingThreads={}'.format(max(1, threads)),
+                  '-sOutputFile={}'.format(os.path.join(raster_dir, '%d.tiff')),
+                  '-dFirstPage={}'.format(str(first_page)), '-dLastPage={}'.format(str(last_page))]
+            if self.options.password:
+                op.append('-sPDFPassword={}'.format(self.options.password))
+            op.append(pdf)
+            timeout = max(60, 30 * (last_page - first_page + 1))
+            if not Derivatives.do_system_call(op, logger=self.logger, timeout=timeout):
+                self.logger.warning("Unable to rasterize {} in one pass, falling back to one page at a time".format(
+                    pdf))
+                return
+            # Ghostscript numbers the output from 1 for the first page it writes.
+            rendered = [(os.path.join(raster_dir, '{}.tiff'.format(page - first_page + 1)), output_file)
+                        for (page, output_file) in needed]
+            rendered = [(raster_file, output_file) for (raster_file, output_file) in rendered
+                        if os.path.exists(raster_file)]
+            if not self.options.raster_direct and len(rendered) > 0:
+                op = ['mogrify', '-resize', '75%'] + [raster_file for (raster_file, output_file) in rendered]
+                if not Derivatives.do_system_call(op, logger=self.logger, timeout=timeout):
+                    self.logger.warning("Unable to resize the rasterized pages of {}, falling back to one page at a "
+                                        "time".format(pdf))
+                    return
+            pages = dict([(output_file, page) for (page, output_file) in needed])
+            for (raster_file, output_file) in rendered:
+                self.master_profile.conform(raster_file)
+                self.scratch.publish(raster_file, output_file)
+                self.cache.store(output_file, [pdf], self.tiff_params(pages[output_file]))
+                self.manifest.output_done(output_file)
+        finally:
+            shutil.rmtree(raster_dir, ignore_errors=True)
+
+    def count_pages(self, input_file):
+        """Count the pages of a PDF or multi-page Tiff from its headers.
+
+        Keyword arguments
+        input_file -- The full path to the PDF or Tiff
+
+        Returns the number of pages or None if the file could not be read.
+        """
+        info = ImageInfo.probe(input_file, password=self.options.password, logger=self.logger)
+        return info.frames if info is not None else None
+
+    def burst_tiff(self, tiff_file, pages):
+        """Write the OBJ.tiff of every page of a multi-page Tiff in one go.
+
+        Pages are copied with their compressed data as-is where possible, otherwise decoded once with Pillow. Pages
+        that already exist are skipped unless --overwrite is set, anything that could not be written is left for
+        get_tiff_page.
+
+        Keyword arguments
+        tiff_file -- The full path to the Tiff
+        pages -- list of tuples of the page in the source file and the directory to save it to
+        """
+        needed = list()
+        for (page, out_dir) in pages:
+            output_file = os.path.join(out_dir, 'OBJ.tiff')
+            params = self.tiff_page_params(page)
+            if self.manifest.needs_output(output_file, input_file=tiff_file, params=params):
+                if self.cache.fetch(output_file, [tiff_file], params):
+                    self.manifest.output_done(output_file)
+                else:
+                    needed.append((page, output_file))
+        if len(needed) == 0:
+            self.logger.debug("All pages of {} are already split".format(tiff_file))
+            return
+        self.logger.debug("Bursting {} pages from {}".format(len(needed), tiff_file))
+        leftover = list()
+        try:
+            reader = self._tiff_reader(tiff_file)
+        except (ValueError, struct.error, OSError) as e:
+            self.logger.debug("Unable to copy pages of {} as-is: {}".format(tiff_file, repr(e)))
+            reader = None
+        for (page, output_file) in needed:
+            try:
+                if reader is None:
+                    raise ValueError("No reader")
+                with self.scratch.staged(os.path.dirname(output_file), ['OBJ.tiff']) as work_dir:
+                    partial_file = os.path.join(work_dir, 'OBJ.tiff.partial')
+                    reader.write_page(page - 1, partial_file)
+                    self.master_profile.conform(partial_file)
+                    os.replace(partial_file, os.path.join(work_dir, 'OBJ.tiff'))
+                self.cache.store(output_file, [tiff_file], self.tiff_page_params(page))
+                self.manifest.output_done(output_file)
+            except (ValueError, struct.error, IndexError, OSError) as e:
+                self.logger.debug("Unable to copy page {} of {} as-is: {}".format(page, tiff_file, repr(e)))
+                leftover.append((page, output_file))
+        if len(leftover) > 0:
+            self._burst_tiff_pillow(tiff_file, leftover)
+
+    def _burst_tiff_pillow(self, tiff_file, needed):
+        """Decode the pages with Pillow and save them with their original compression."""
+        try:
+            with Image.open(tiff_file) as im:
+                for (page, output_file) in needed:
+                    im.seek(page - 1)
+                    save_args = {'compression': im.info.get('compression', 'raw')}
+                    if 'dpi' in im.info:
+                        save_args['dpi'] = im.info['dpi']
+                    with self.scratch.staged(os.path.dirname(output_file), ['OBJ.tiff']) as work_dir:
+                        partial_file = os.path.join(work_dir, 'OBJ.tiff.partial')
+                        im.save(partial_file, format='TIFF', **save_args)
+                        self.master_profile.conform(partial_file)
+                        os.replace(partial_file, os.path.join(work_dir, 'OBJ.tiff'))
+                    self.cache.store(output_file, [tiff_file], self.tiff_page_params(page))
+                    self.manifest.output_done(output_file)
+        except Exception as e:
+            self.logger.warning("Unable to burst {} with Pillow, falling back to one page at a time: {}".format(
+                tiff_file, repr(e)))
+
+    def split_pdf(self, pdf, pages):
+        """Write the single page PDF.pdf files for a multi-page PDF, opening the source only once.
+
+        Pages that already exist are skipped unless --overwrite is set. If the splitting fails the missing pages are
+        left for get_pdf_page to generate one at a time.
+
+        Keyword arguments
+        pdf -- The full path to the PDF file
+        pages -- list of tuples of the page in the source file and the directory to save it to
+        """
+        needed = list()
+        for (page, out_dir) in pages:
+            output_file = os.path.join(out_dir, 'PDF.pdf')
+            if self.manifest.needs_output(output_file, input_file=pdf, params={'page': page}):
+                needed.append((page, output_file))
+        if len(needed) == 0:
+            self.logger.debug("All pages of {} are already split".format(pdf))
+            return
+        self.logger.debug("Splitting {} pages from {} with {}".format(len(needed), pdf, self.options.pdf_split))
+        if self.options.pdf_split == 'pypdf2':
+            self._split_pdf_pypdf2(pdf, needed)
+        elif self.options.pdf_split == 'gs':
+            self._split_pdf_gs(pdf, needed)
+
+    def _split_pdf_pypdf2(self, pdf, needed):
+        """Split the pages with PyPDF2, copying each page and its resources without re-rendering."""
+        try:
+            with open(pdf, 'rb') as fp:
+                reader = PyPDF2.PdfFileReader(fp, strict=False)
+                if reader.isEncrypted and not reader.decrypt(self.options.password):
+                    self.logger.error("Unable to decrypt {} with the supplied password".format(pdf))
+                    return
+                for (page, output_file) in needed:
+                    writer = PyPDF2.PdfFileWriter()
+                    writer.addPage(reader.getPage(page - 1))
+                    with self.scratch.staged(os.path.dirname(output_file), ['PDF.pdf']) as work_dir:
+                        partial_file = os.path.join(work_dir, 'PDF.pdf.partial')
+                        with open(partial_file, 'wb') as out_fp:
+                            writer.write(out_fp)
+                        os.replace(partial_file, os.path.join(work_dir, 'PDF.pdf'))
+                    self.manifest.output_done(output_file)
+        except Exception as e:
+            self.logger.warning("Unable to split {} with PyPDF2, falling back to one page at a time: {}".format(
+                pdf, repr(e)))
+
+    def _split_pdf_gs(self, pdf, needed):
+        """Split the pages with a single Ghostscript call writing one file per page."""
+        first_page = min([page for (page, output_file) in needed])
+        last_page = max([page for (page, output_file) in needed])
+        with self.scratch.staged(os.path.dirname(os.path.dirname(needed[0][1])), []) as work_dir:
+            # Other jobs and nodes split other pages of the book at the same time.
+            split_dir = tempfile.mkdtemp(prefix='.split.', dir=work_dir)
+            try:
+                self._split_pages_gs(pdf, needed, split_dir, first_page, last_page)
+            finally:
+                shutil.rmtree(split_dir, ignore_errors=True)
+
+    def _split_pages_gs(self, pdf, needed, split_dir, first_page, last_page):
+        """Split the pages into split_dir, then publish each as its PDF.pdf."""
+        op = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.3',
+              '-dAutoRotatePages=/None'] + PageSplitter.reproducible_args + [
+              '-sOutputFile={}'.format(os.path.join(split_dir, '%d.pdf')),
+              '-dFirstPage={}'.format(str(first_page)), '-dLastPage={}'.format(str(last_page))]
+        if self.options.password:
+            op.append('-sPDFPassword={}'.format(self.options.password))
+        op.append(pdf)
+        if not Derivatives.do_system_call(op, logger=self.logger, timeout=max(60, 10 * (last_page - first_page + 1))):
+            self.logger.warning("Unable to split {} in one pass, falling back to one page at a time".format(pdf))
+            return
+        for (page, output_file) in needed:
+            # Ghostscript numbers the output from 1 for the first page it writes.
+            split_file = os.path.join(split_dir, '{}.pdf'.format(page - first_page + 1))
+            if os.path.exists(split_file):
+                self.scratch.publish(split_file, output_file)
+                self.manifest.output_done(output_file)
+
+
+def time_rasterize(pdf, resolution, jobs, logger):
+    """Time the per-page rasterization against the one pass modes on a PDF, prints the results.
+
+    Keyword arguments
+    pdf -- The full path to the PDF file
+    resolution -- The target resolution
+    jobs -- Number of rendering threads for the one pass modes
+    logger -- The logger
+    """
+    work_dir = os.path.join(os.getcwd(), 'rasterize_timing')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.mkdir(work_dir)
+    options = argparse.Namespace(overwrite=True, password='', pdf_split='gs', resolution=resolution,
+                                 rasterize='document', raster_direct=False, jobs=jobs, master_colorspace='auto',
+                                 master_depth='auto', master_compression='auto')
+    splitter = PageSplitter(options, logger)
+    count = splitter.count_pages(pdf)
+    try:
+        for mode in ['page', 'document', 'direct']:
+            mode_dir = os.path.join(work_dir, mode)
+            os.mkdir(mode_dir)
+            pages = list()
+            for page in range(1, count + 1):
+                os.mkdir(os.path.join(mode_dir, str(page)))
+                pages.append((page, os.path.join(mode_dir, str(page))))
+            start_time = time.perf_counter()
+            if mode == 'page':
+                # What get_tiff does for each page after splitting.
+                splitter.split_pdf(pdf, pages)
+                for (page, out_dir) in pages:
+                    op = ['convert', '-density', str(int(resolution * 1.25)), os.path.join(out_dir, 'PDF.pdf'),
+                          '-alpha', 'Off', '-resize', '75%'] + splitter.master_profile.convert_args() + \
+                         [os.path.join(out_dir, 'OBJ.tiff')]
+                    Derivatives.do_system_call(op, logger=logger)
+                    splitter.master_profile.conform(os.path.join(out_dir, 'OBJ.tiff'))
+            else:
+                options.raster_direct = (mode == 'direct')
+                splitter.rasterize_pdf(pdf, pages)
+            elapsed = time.perf_counter() - start_time
+            done = len([p for (p, out_dir) in pages if os.path.exists(os.path.join(out_dir, 'OBJ.tiff'))])
+            print("{:10} {:8.2f}s {:6.2f}s/page ({} of {} pages)".format(mode, elapsed, elapsed / max(1, count), done,
+                                                                          count))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the per-page and one pass rasterization of a PDF.")
+    parser.add_argument('pdf', help="The PDF to rasterize.")
+    parser.add_argument('--resolution', dest="resolution", type=int, default=300,
+                        help="Resolution of the source material, used when generating Tiff. Defaults to 300.")
+    parser.add_argument('--jobs', dest="jobs", type=int, default=1,
+                        help="Number of Ghostscript rendering threads for the one pass modes. Defaults to 1.")
+    args = parser.parse_args()
+    if not os.path.exists(args.pdf):
+        parser.error("File {} does not exist".format(args.pdf))
+    internal_logger = logging.getLogger('multipage2book_splitter')
+    internal_logger.addHandler(logging.StreamHandler(sys.stderr))
+    internal_logger.setLevel(logging.WARNING)
+    time_rasterize(os.path.realpath(args.pdf), args.resolution, args.jobs, internal_logger)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+
+import json
+import os
+import os.path
+
+import PyPDF2
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+
+class PdfAssembler(object):
+    """Merge the page PDF.pdf files of a book into the book PDF.pdf in page order, without re-rendering them.
+
+    The objects of each page (its content streams, images and fonts) are copied into the book PDF as they are and
+    written out before the next page is read, so only one page is held in memory however long the book is. Pages can
+    be added as they finish: each page that continues the page order is appended to PDF.pdf.partial and recorded,
+    with the offsets of its objects, in PDF.pdf.partial.json. Finishing (in this or any later process) picks up from
+    there, appends the rest, writes the page tree and cross-reference table and renames the result to PDF.pdf.
+    """
+
+    header = b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n'
+    """Object numbers of the catalog and the page tree, the objects of the pages follow"""
+    catalog_id = 1
+    pages_id = 2
+    first_id = 3
+    """Attributes a page inherits from the page tree nodes above it when it doesn't have its own"""
+    inheritable = ['/Resources', '/MediaBox', '/CropBox', '/Rotate']
+
+    def __init__(self, book_dir, logger):
+        """Set up the assembler of a book.
+
+        Keyword arguments
+        book_dir -- The book directory, the pages are its numbered directories
+        logger -- The logger
+        """
+        self.book_dir = book_dir
+        self.output_file = os.path.join(book_dir, 'PDF.pdf')
+        self.partial_file = self.output_file + '.partial'
+        self.state_file = self.partial_file + '.json'
+        self.logger = logger
+        """Pages marked finished with page_done"""
+        self._ready = set()
+        """The pages appended so far, None until read from the state file"""
+        self._entries = None
+        """The page numbers of the book when the state file was read"""
+        self._pages = None
+
+    def pages(self):
+        """The page numbers of the book, in order."""
+        return sorted([int(name) for name in os.listdir(self.book_dir)
+                       if name.isdigit() and os.path.isdir(os.path.join(self.book_dir, name))])
+
+    def page_pdf(self, page):
+        return os.path.join(self.book_dir, str(page), 'PDF.pdf')
+
+    def page_done(self, page):
+        """Mark a page finished, appending it and the finished pages after it if it is the next in order."""
+        self._ready.add(page)
+        self._append(self._ready)
+
+    def finish(self):
+        """Append the remaining pages and publish PDF.pdf.
+
+        Returns False if none of the pages has a PDF.pdf, then nothing is written.
+        """
+        entries = self._append(None)
+        kids = [kid for entry in entries for kid in entry['kids']]
+        if len(kids) == 0:
+            self._reset(start=False)
+            return False
+        self.logger.debug("Writing the page tree of the {} pages of {}".format(len(kids), self.output_file))
+        offsets = [offset for entry in entries for offset in entry['offsets']]
+        with open(self.partial_file, 'r+b') as fp:
+            fp.seek(0, os.SEEK_END)
+            pages_offset = fp.tell()
+            fp.write(b'%d 0 obj\n<< /Type /Pages /Kids [ ' % PdfAssembler.pages_id)
+            fp.write(b' '.join([b'%d 0 R' % kid for kid in kids]))
+            fp.write(b' ] /Count %d >>\nendobj\n' % len(kids))
+            catalog_offset = fp.tell()
+            fp.write(b'%d 0 obj\n<< /Type /Catalog /Pages %d 0 R >>\nendobj\n' % (PdfAssembler.catalog_id,
+                                                                                  PdfAssembler.pages_id))
+            xref_offset = fp.tell()
+            size = PdfAssembler.first_id + len(offsets)
+            fp.write(b'xref\n0 %d\n0000000000 65535 f \n' % size)
+            for offset in [catalog_offset, pages_offset] + offsets:
+                fp.write(b'%010d 00000 n \n' % offset)
+            fp.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+                size, PdfAssembler.catalog_id, xref_offset))
+        os.replace(self.partial_file, self.output_file)
+        os.remove(self.state_file)
+        self._entries = None
+        return True
+
+    def _fingerprint(self, page):
+        """The size and modification time of a page's PDF.pdf, None if it has none."""
+        try:
+            stat = os.stat(self.page_pdf(page))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _load(self):
+        """The pages already appended, from the state file of an earlier call if there is one.
+
+        The partial file is cut back to the end of the last page recorded. If a page has changed since it was appended
+        the book is started again.
+        """
+        if self._entries is not None:
+            return self._entries
+        self._pages = self.pages()
+        entries = list()
+        if os.path.exists(self.state_file) and os.path.exists(self.partial_file):
+            with open(self.state_file, 'r') as fp:
+                for line in fp:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Cut short while it was being written, the page after it is appended again.
+                        break
+            pages = self._pages
+            size = entries[-1]['size'] if len(entries) > 0 else len(PdfAssembler.header)
+            if [entry['page'] for entry in entries] != pages[:len(entries)] or \
+                    any([entry['pdf'] != self._fingerprint(entry['page']) for entry in entries]) or \
+                    os.path.getsize(self.partial_file) < size:
+                self.logger.debug("The pages of {} have changed, starting it again".format(self.partial_file))
+                entries = None
+            else:
+                self.logger.debug("Continuing {} after {} pages".format(self.partial_file, len(entries)))
+                with open(self.partial_file, 'r+b') as fp:
+                    fp.truncate(size)
+                with open(self.state_file, 'w') as fp:
+                    fp.writelines([json.dumps(entry) + '\n' for entry in entries])
+        else:
+            entries = None
+        if entries is None:
+            self._reset()
+            entries = list()
+        self._entries = entries
+        return entries
+
+    def _reset(self, start=True):
+        """Throw away anything appended, and start a new partial file unless start is False."""
+        for stale_file in [self.partial_file, self.state_file]:
+            if os.path.exists(stale_file):
+                os.remove(stale_file)
+        if start:
+            with open(self.partial_file, 'wb') as fp:
+                fp.write(PdfAssembler.header)
+            open(self.state_file, 'w').close()
+
+    def _append(self, ready):
+        """Append the pages after those already appended, in order, stopping at the first that isn't in ready.
+
+        Keyword arguments
+        ready -- set of the finished page numbers, or None to append every page
+
+        Returns the list of the pages appended, as recorded in the state file.
+        """
+        entries = self._load()
+        # The page directories are all made before any page is processed, only look again when finishing.
+        pages = self.pages() if ready is None else self._pages
+        next_id = PdfAssembler.first_id + sum([len(entry['offsets']) for entry in entries])
+        try:
+            with open(self.partial_file, 'r+b') as fp, open(self.state_file, 'a') as state_fp:
+                fp.seek(0, os.SEEK_END)
+                for page in pages[len(entries):]:
+                    if ready is not None and page not in ready:
+                        break
+                    entry = self._copy_page(fp, page, next_id)
+                    fp.flush()
+                    state_fp.write(json.dumps(entry) + '\n')
+                    state_fp.flush()
+                    entries.append(entry)
+                    next_id += len(entry['offsets'])
+        except BaseException:
+            # Anything written after the last page recorded is cut off by the next _load.
+            self._entries = None
+            raise
+        return entries
+
+    def _copy_page(self, fp, page, first_id):
+        """Write the objects of a page's PDF.pdf to the book, numbered from first_id.
+
+        Returns the record of the page for the state file.
+        """
+        entry = {'page': page, 'pdf': self._fingerprint(page), 'kids': list(), 'offsets': list()}
+        if entry['pdf'] is None:
+            self.logger.debug("Page {} of {} has no PDF.pdf".format(page, self.book_dir))
+            entry['size'] = fp.tell()
+            return entry
+        self.logger.debug("Appending page {} to {}".format(page, self.partial_file))
+        numbers = dict()
+        pending = list()
+
+        def number(reference):
+            key = (reference.idnum, reference.generation)
+            if key not in numbers:
+                numbers[key] = first_id + len(numbers)
+                pending.append((numbers[key], reference))
+            return numbers[key]
+
+        offsets = dict()
+        with open(self.page_pdf(page), 'rb') as pdf_fp:
+            reader = PyPDF2.PdfFileReader(pdf_fp, strict=False)
+            for page_object in reader.pages:
+                kid = first_id + len(numbers)
+                reference = page_object.indirectRef
+                # Anything pointing back at the page (ie. annotations) gets the page's new number.
+                numbers[('page', kid) if reference is None else (reference.idnum, reference.generation)] = kid
+                entry['kids'].append(kid)
+                if '/Parent' in page_object:
+                    PdfAssembler._inherit(page_object)
+                    del page_object['/Parent']
+                PdfAssembler._renumber(page_object, number)
+                dict.__setitem__(page_object, NameObject('/Parent'), IndirectObject(PdfAssembler.pages_id, 0, None))
+                offsets[kid] = PdfAssembler._write_object(fp, kid, page_object)
+                while len(pending) > 0:
+                    (object_id, reference) = pending.pop(0)
+                    offsets[object_id] = PdfAssembler._write_object(
+                        fp, object_id, PdfAssembler._renumber(reference.getObject(), number))
+        entry['offsets'] = [offsets[object_id] for object_id in range(first_id, first_id + len(numbers))]
+        entry['size'] = fp.tell()
+        return entry
+
+    @staticmethod
+    def _inherit(page_object):
+        """Copy the attributes a page inherits from its page tree onto the page, before it leaves that tree."""
+        node = page_object
+        seen = list()
+        while '/Parent' in node:
+            node = node['/Parent']
+            if not isinstance(node, DictionaryObject) or id(node) in seen:
+                break
+            seen.append(id(node))
+            for key in PdfAssembler.inheritable:
+                if key not in page_object and key in node:
+                    # The value as it is, an indirect one is copied with the rest of the page's objects.
+                    dict.__setitem__(page_object, NameObject(key), dict.__getitem__(node, key))
+
+    @staticmethod
+    def _renumber(obj, number):
+        """Point the references of an object (and the objects directly inside it) at their numbers in the book."""
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is None:
+                # Already renumbered, an object reached a second time.
+                return obj
+            return IndirectObject(number(obj), 0, None)
+        if isinstance(obj, DictionaryObject):
+            # dict methods, DictionaryObject's own would follow the references.
+            for (key, value) in list(dict.items(obj)):
+                if key == '/Length' and isinstance(obj, StreamObject):
+                    # Written from the data by the stream itself.
+                    continue
+                dict.__setitem__(obj, key, PdfAssembler._renumber(value, number))
+        elif isinstance(obj, ArrayObject):
+            for (index, value) in enumerate(obj):
+                list.__setitem__(obj, index, PdfAssembler._renumber(value, number))
+        return obj
+
+    @staticmethod
+    def _write_object(fp, object_id, obj):
+        """Write an object, with its stream data as it is, returns its offset."""
+        offset = fp.tell()
+        fp.write(b'%d 0 obj\n' % object_id)
+        obj.writeToStream(fp, None)
+        fp.write(b'\nendobj\n')
+        return offset
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+
+import asyncio
+import contextlib
+import math
+import multiprocessing
+import os
+import os.path
+import time
+
+
+class ResourceBudget(object):
+    """Admit external programs against a host wide memory and thread budget.
+
+    Each call is given a cost, the memory and threads it is expected to use, estimated from the dimensions and bit
+    depth of the image it works on. A call waits until its cost fits in what is left of the budget, and no new calls
+    start while the host's available memory is below a floor. The budget is kept in shared memory so the worker
+    processes of a run all draw from the same one. The tools are told to stay within their cost, with ImageMagick's
+    -limit settings, OMP_THREAD_LIMIT for tesseract, -num_threads for kdu_compress and -threads for opj_compress.
+    """
+
+    """Memory a call needs when nothing is known about its image, in bytes"""
+    default_memory = {'convert': 536870912, 'mogrify': 536870912, 'tesseract': 536870912, 'gs': 268435456,
+                      'kdu_compress': 268435456, 'opj_compress': 536870912}
+    """Memory of calls to programs not listed above"""
+    default_other_memory = 67108864
+    """Threads each call is allowed"""
+    threads_per_call = 1
+    """Seconds between checks while waiting to be admitted"""
+    poll_interval = 0.2
+    """Seconds a call waits before it holds back smaller calls so it can get in"""
+    starve_after = 10
+    """Positions in the shared ledger"""
+    _used_memory = 0
+    _used_threads = 1
+    _running = 2
+    _reserved_memory = 3
+    _reserved_threads = 4
+    _reserved_ticket = 5
+    _next_ticket = 6
+    _reserved_at = 7
+
+    def __init__(self, memory, threads, min_free, logger):
+        """Set up the budget, create it before starting the worker processes so they share it.
+
+        Keyword arguments
+        memory -- Bytes of memory the calls may use in total
+        threads -- Threads the calls may use in total
+        min_free -- Bytes of available memory below which no more calls are started
+        logger -- The logger
+        """
+        self.memory = memory
+        self.threads = threads
+        self.min_free = min_free
+        self.logger = logger
+        self._lock = multiprocessing.Lock()
+        self._ledger = multiprocessing.RawArray('q', 8)
+        self._meminfo = (0, None)
+
+    @staticmethod
+    def estimate(tool, width, height, depth):
+        """Estimate the memory and threads a program needs for an image.
+
+        Keyword arguments
+        tool -- The program name, ie. convert
+        width -- The image width in pixels
+        height -- The image height in pixels
+        depth -- The bits per sample of the image
+        Returns a dict of memory (in bytes) and threads.
+        """
+        pixels = width * height
+        sample_bytes = max(1, int(math.ceil(depth / 8.0)))
+        if tool in ['convert', 'mogrify']:
+            # ImageMagick holds the whole image in its pixel cache, 4 channels of 16 bit quantums.
+            memory = pixels * 8 * 1.25 + 67108864
+        elif tool == 'tesseract':
+            # Leptonica loads the image at up to 32bpp, then keeps greyscale and binary copies.
+            memory = pixels * (4 + 3 * sample_bytes) + 134217728
+        elif tool == 'kdu_compress':
+            # Kakadu streams the image, only a band of lines for the code blocks is in memory.
+            memory = width * 4 * sample_bytes * 512 + 67108864
+        elif tool == 'opj_compress':
+            # OpenJPEG holds every sample as a 32 bit integer, and the code blocks it has encoded.
+            memory = pixels * 3 * 4 * 2 + 67108864
+        else:
+            memory = ResourceBudget.default_memory.get(tool, ResourceBudget.default_other_memory)
+        return {'memory': int(memory), 'threads': ResourceBudget.threads_per_call}
+
+    @staticmethod
+    def default_cost(tool):
+        """The cost of a call when nothing is known about its image."""
+        return {'memory': ResourceBudget.default_memory.get(tool, ResourceBudget.default_other_memory),
+                'threads': ResourceBudget.threads_per_call}
+
+    @staticmethod
+    def apply(ops, cost):
+        """Add the settings that keep a program within its cost.
+
+        Returns the new list of arguments and the environment to run it with.
+        """
+        tool = os.path.basename(ops[0])
+        env = dict(os.environ, OMP_THREAD_LIMIT=str(cost['threads']))
+        if tool in ['convert', 'mogrify']:
+            # Past the memory limit ImageMagick falls back to a memory mapped and then a disk pixel cache.
+            ops = [ops[0], '-limit', 'memory', str(cost['memory']), '-limit', 'map', str(cost['memory'] * 2),
+                   '-limit', 'thread', str(cost['threads'])] + ops[1:]
+        elif tool == 'kdu_compress':
+            ops = ops + ['-num_threads', str(cost['threads'])]
+        elif tool == 'opj_compress':
+            ops = ops + ['-threads', str(cost['threads'])]
+        return ops, env
+
+    def available_memory(self):
+        """MemAvailable from /proc/meminfo, read at most once a second. None where there is no /proc."""
+        (read_at, available) = self._meminfo
+        if time.monotonic() - read_at >= 1:
+            available = None
+            try:
+                with open('/proc/meminfo', 'r') as fp:
+                    for line in fp:
+                        if line.startswith('MemAvailable:'):
+                            available = int(line.split()[1]) * 1024
+                            break
+            except OSError:
+                pass
+            self._meminfo = (time.monotonic(), available)
+        return available
+
+    def _try_admit(self, cost, ticket, waited, available):
+        """Take the cost from the budget if it fits, call with the lock held.
+
+        Returns True if admitted.
+        """
+        ledger = self._ledger
+        now = int(time.time() * 1000)
+        if ledger[ResourceBudget._reserved_ticket] == ticket:
+            ledger[ResourceBudget._reserved_at] = now
+        elif ledger[ResourceBudget._reserved_ticket] != 0 and \
+                now - ledger[ResourceBudget._reserved_at] > ResourceBudget.poll_interval * 10000:
+            # The call holding the reservation stopped checking in, its process is gone.
+            ledger[ResourceBudget._reserved_ticket] = 0
+        reserved = ledger[ResourceBudget._reserved_ticket] not in [0, ticket]
+        memory = ledger[ResourceBudget._used_memory] + cost['memory']
+        threads = ledger[ResourceBudget._used_threads] + cost['threads']
+        if reserved:
+            # Another call has waited too long, leave room for it.
+            memory += ledger[ResourceBudget._reserved_memory]
+            threads += ledger[ResourceBudget._reserved_threads]
+        if ledger[ResourceBudget._running] == 0:
+            # With nothing of ours running a call is admitted even if it is bigger than the whole budget or memory
+            # is short, as long as it isn't jumping ahead of a reservation.
+            fits = not reserved
+        else:
+            fits = memory <= self.memory and threads <= self.threads and \
+                (available is None or available >= self.min_free)
+        if not fits:
+            if waited >= ResourceBudget.starve_after and ledger[ResourceBudget._reserved_ticket] == 0:
+                ledger[ResourceBudget._reserved_ticket] = ticket
+                ledger[ResourceBudget._reserved_memory] = cost['memory']
+                ledger[ResourceBudget._reserved_threads] = cost['threads']
+                ledger[ResourceBudget._reserved_at] = now
+            return False
+        if ledger[ResourceBudget._reserved_ticket] == ticket:
+            ledger[ResourceBudget._reserved_ticket] = 0
+            ledger[ResourceBudget._reserved_memory] = 0
+            ledger[ResourceBudget._reserved_threads] = 0
+        ledger[ResourceBudget._used_memory] += cost['memory']
+        ledger[ResourceBudget._used_threads] += cost['threads']
+        ledger[ResourceBudget._running] += 1
+        return True
+
+    def _release(self, cost):
+        with self._lock:
+            self._ledger[ResourceBudget._used_memory] -= cost['memory']
+            self._ledger[ResourceBudget._used_threads] -= cost['threads']
+            self._ledger[ResourceBudget._running] -= 1
+
+    @contextlib.asynccontextmanager
+    async def admitted(self, cost):
+        """Wait on the event loop until the cost fits in the budget, and give it back after the with block."""
+        with self._lock:
+            self._ledger[ResourceBudget._next_ticket] += 1
+            ticket = self._ledger[ResourceBudget._next_ticket]
+        started = time.monotonic()
+        logged = False
+        try:
+            while True:
+                available = self.available_memory()
+                with self._lock:
+                    if self._try_admit(cost, ticket, time.monotonic() - started, available):
+                        break
+                if not logged:
+                    self.logger.debug("Waiting for {}MB of memory and {} threads from the resource budget".format(
+                        cost['memory'] // 1048576, cost['threads']))
+                    logged = True
+                await asyncio.sleep(ResourceBudget.poll_interval)
+        except BaseException:
+            # Cancelled while waiting, don't leave our reservation holding back everyone else.
+            with self._lock:
+                if self._ledger[ResourceBudget._reserved_ticket] == ticket:
+                    self._ledger[ResourceBudget._reserved_ticket] = 0
+            raise
+        try:
+            yield
+        finally:
+            self._release(cost)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+
+import contextlib
+import errno
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+
+class Scratch(object):
+    """Produce files on local disk or tmpfs and publish them into the output tree once they are complete.
+
+    Each step works in a directory of its own under the run's scratch root, so the many small writes of tesseract,
+    convert and the JP2 encoder stay off the (network) output filesystem. When the step finishes its files are moved
+    into the page directory, with a rename where the scratch root is on the same filesystem and otherwise with a
+    single copy to a partial file that is then renamed, so nothing in the output tree is ever half written. If the step
+    fails (or quits) its directory is removed and nothing is published. Without a scratch root, or once the root holds
+    --scratch-size, files are written in place as before.
+    """
+
+    """Prefix of the run directories made under --scratch-dir, followed by the process id of the run"""
+    root_prefix = 'multipage2book-'
+    """Bytes that must stay free on the scratch filesystem for a step to be staged there"""
+    min_free = 268435456
+    """Seconds between walks of the scratch root, in between the steps of this process are counted"""
+    rescan_interval = 10
+    """Bytes a step is taken to stage until steps have been measured"""
+    default_step_size = 33554432
+
+    def __init__(self, scratch_root, max_size, logger):
+        """Set up the staging area.
+
+        Keyword arguments
+        scratch_root -- The run's directory under --scratch-dir (see create_root), or None to write in place
+        max_size -- The most bytes the run may have staged at once, past this steps write in place
+        logger -- The logger
+        """
+        self.scratch_root = scratch_root
+        self.max_size = max_size
+        self.logger = logger
+        self._lock = threading.Lock()
+        # The bytes found by the last walk of the root, when it was and how many walks there have been.
+        self._walked = 0
+        self._walked_at = None
+        self._walks = 0
+        # Bytes staged by the steps of this process since the last walk, and the running average size of a step.
+        self._since_walk = 0
+        self._step_size = Scratch.default_step_size
+
+    def enabled(self):
+        return self.scratch_root is not None
+
+    @staticmethod
+    def create_root(scratch_dir):
+        """Make the directory of this run under --scratch-dir, removing any left by runs that were killed.
+
+        Returns the path of the new directory.
+        """
+        os.makedirs(scratch_dir, exist_ok=True)
+        Scratch.remove_stale(scratch_dir)
+        return tempfile.mkdtemp(prefix='{}{}-'.format(Scratch.root_prefix, os.getpid()), dir=scratch_dir)
+
+    @staticmethod
+    def remove_root(scratch_root):
+        """Remove the directory of a run and anything still staged in it."""
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+    @staticmethod
+    def remove_stale(scratch_dir):
+        """Remove the run directories of processes that are no longer running on this host."""
+        pattern = re.compile(r'^' + re.escape(Scratch.root_prefix) + r'(\d+)-')
+        for name in os.listdir(scratch_dir):
+            match = pattern.match(name)
+            if match is None:
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+            except ProcessLookupError:
+                Scratch.remove_root(os.path.join(scratch_dir, name))
+            except OSError:
+                # Running, as another user.
+                pass
+
+    def usage(self):
+        """Bytes currently staged under the run's root, by all of its processes.
+
+        The root is only walked every rescan_interval seconds. In between, the steps this process starts are added to
+        the last walk at the average size of a step and taken off again when they finish.
+        """
+        with self._lock:
+            if self._walked_at is None or time.monotonic() - self._walked_at >= Scratch.rescan_interval:
+                self._walked = Scratch._size(self.scratch_root)
+                self._walked_at = time.monotonic()
+                self._walks += 1
+                self._since_walk = 0
+            return max(0, self._walked + self._since_walk)
+
+    def _step_started(self):
+        """Count a step that is being staged, returns what _step_finished needs to take it off again."""
+        with self._lock:
+            self._since_walk += self._step_size
+            return (self._walks, self._step_size)
+
+    def _step_finished(self, step, size):
+        """Take a finished step off the count, size is what it staged."""
+        (walks, estimate) = step
+        with self._lock:
+            if walks == self._walks:
+                self._since_walk -= estimate
+            else:
+                # Walked while it was staged, the walk counted its files.
+                self._walked = max(0, self._walked - size)
+            if size > 0:
+                self._step_size = (self._step_size * 3 + size) // 4
+
+    @staticmethod
+    def _size(directory):
+        """Bytes of the files under a directory."""
+        total = 0
+        for (path, dirs, files) in os.walk(directory):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(path, name))
+                except OSError:
+                    # Published or removed while walking.
+                    pass
+        return total
+
+    def has_room(self):
+        """Whether another step can be staged within --scratch-size and the free space of the scratch filesystem."""
+        used = self.usage()
+        if used >= self.max_size:
+            self.logger.debug("{}MB is staged in {}, writing in place".format(used // 1048576, self.scratch_root))
+            return False
+        if shutil.disk_usage(self.scratch_root).free < Scratch.min_free:
+            self.logger.debug("{} is nearly full, writing in place".format(self.scratch_root))
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def staged(self, out_dir, names):
+        """Give a directory to write files in, and publish them into out_dir when the with block completes.
+
+        Keyword arguments
+        out_dir -- The page (or book) directory the files belong in
+        names -- The names of the files to publish, any other files written are thrown away. Names that weren't
+                 written are skipped.
+        Yields the directory to write in, out_dir itself when not staging.
+        """
+        if not self.enabled() or not self.has_room():
+            yield out_dir
+            return
+        step = self._step_started()
+        size = 0
+        work_dir = tempfile.mkdtemp(dir=self.scratch_root)
+        try:
+            yield work_dir
+            size = Scratch._size(work_dir)
+            for name in names:
+                work_file = os.path.join(work_dir, name)
+                if os.path.exists(work_file):
+                    self.publish(work_file, os.path.join(out_dir, name))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self._step_finished(step, size)
+
+    def publish(self, work_file, output_file):
+        """Move a finished file into place, by rename or a single copy that only appears under its name once whole."""
+        self.logger.debug("Publishing {}".format(output_file))
+        try:
+            os.replace(work_file, output_file)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        partial_file = output_file + '.partial.{}'.format(os.getpid())
+        try:
+            shutil.copyfile(work_file, partial_file)
+            os.replace(partial_file, output_file)
+        finally:
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+        os.remove(work_file)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+
+import threading
+
+from PIL import Image
+
+from Metrics import Metrics
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+class TesseractEngine(object):
+    """OCR pages with the tesseract library through tesserocr, instead of starting a tesseract process for each one.
+
+    Loading the traineddata of --language is paid once per thread (so once per worker process) rather than once per
+    page. Pages are handed over as in-memory images and written by tesseract's own renderers, the same ones the
+    command line program uses, so the files are the same as from the command line.
+    """
+
+    """Configs tesserocr can render, and the variable that turns each on. It has no ALTO renderer."""
+    renderers = {'hocr': 'tessedit_create_hocr', 'txt': 'tessedit_create_txt', 'tsv': 'tessedit_create_tsv',
+                 'pdf': 'tessedit_create_pdf'}
+
+    def __init__(self, language, logger):
+        """Set up the engine, the tesseract API is only initialised when a thread first uses it.
+
+        Keyword arguments
+        language -- The tesseract language(s), ie. eng or eng+fra
+        logger -- The logger
+        """
+        self.language = language
+        self.logger = logger
+        self._local = threading.local()
+
+    @staticmethod
+    def available():
+        """Whether tesserocr is installed."""
+        return tesserocr is not None
+
+    def _api(self):
+        """The initialised API of the current thread."""
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            self.logger.debug("Loading tesseract {} for {}".format(tesserocr.tesseract_version().split()[1],
+                                                                   self.language))
+            with Metrics.step('tesserocr-init'):
+                api = tesserocr.PyTessBaseAPI(lang=self.language)
+            self._local.api = api
+        return api
+
+    @staticmethod
+    def can_render(configs):
+        return all([config in TesseractEngine.renderers for config in configs])
+
+    def process(self, image_file, output_stub, configs, timeout=600):
+        """OCR an image, writing an output_stub file for each config like the tesseract command line.
+
+        Keyword arguments
+        image_file -- The image to OCR
+        output_stub -- The output file name without extension
+        configs -- The outputs to write, ie. ['hocr', 'txt']
+        timeout -- Seconds to allow the recognition
+        Returns True if it succeeded.
+        """
+        api = self._api()
+        for (config, variable) in TesseractEngine.renderers.items():
+            api.SetVariable(variable, 'T' if config in configs else 'F')
+        with Metrics.step('tesserocr'):
+            with Image.open(image_file) as image:
+                image.load()
+                # The file name only ends up in the title of the HOCR page, as it does from the command line.
+                return api.ProcessPage(output_stub, image, 0, image_file, None, timeout * 1000)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+
+import ctypes
+import ctypes.util
+import os
+import os.path
+import re
+import select
+import struct
+import time
+
+
+class Watcher(object):
+    """Watch a directory for new PDFs/Tiffs and report them once they have stopped changing.
+
+    New files are noticed with inotify where it is available, otherwise by listing the directory every interval. Either
+    way a file is only ready once its size and modification time have not changed for the settle time, so files that
+    are still being copied in are left alone.
+    """
+
+    """Regex - Match files we can process"""
+    valid_extensions = re.compile(r'.*\.(pdf|tiff?)$', re.IGNORECASE)
+
+    """inotify events that mean a file appeared or changed"""
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    """inotify queue overflowed, events were lost"""
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    """Size of the struct inotify_event header"""
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, watch_dir, settle, interval, logger):
+        """Set up the watcher.
+
+        Keyword arguments
+        watch_dir -- The directory to watch, it is not recursed into
+        settle -- Seconds a file must stay the same size and modification time before it is ready
+        interval -- Seconds between directory listings when polling
+        logger -- The logger
+        """
+        self.watch_dir = watch_dir
+        self.settle = settle
+        self.interval = interval
+        self.logger = logger
+        """Files not yet ready, path to (size, mtime_ns, time they were last seen to change)"""
+        self.pending = dict()
+        """Files already handed out by poll, they are ignored until forgotten"""
+        self.handed_out = set()
+        self._fd = None
+        self._start_inotify()
+        # Anything already in the directory when we start.
+        self._scan()
+
+    def using_inotify(self):
+        return self._fd is not None
+
+    def _start_inotify(self):
+        """Start an inotify watch, leaving us polling if that isn't possible."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(Watcher.IN_NONBLOCK | Watcher.IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            mask = Watcher.IN_MODIFY | Watcher.IN_ATTRIB | Watcher.IN_CLOSE_WRITE | Watcher.IN_MOVED_TO | \
+                Watcher.IN_CREATE
+            if libc.inotify_add_watch(fd, os.fsencode(self.watch_dir), mask) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, os.strerror(errno))
+        except (OSError, AttributeError, TypeError) as e:
+            # No inotify (not Linux) or no watches left, ie. fs.inotify.max_user_watches.
+            self.logger.warning("inotify is not available ({}), polling {} every {}s".format(
+                e, self.watch_dir, self.interval))
+            return
+        self._fd = fd
+        self.logger.debug("Watching {} with inotify".format(self.watch_dir))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _scan(self):
+        """List the directory for new files."""
+        for entry in os.scandir(self.watch_dir):
+            self._seen(entry.path)
+
+    def _seen(self, path):
+        """Start tracking a file if it is one we process."""
+        name = os.path.basename(path)
+        if name.startswith('.') or not Watcher.valid_extensions.match(name) or path in self.handed_out:
+            # Dot files are partial uploads (ie. rsync, scp), they get renamed when done.
+            return
+        if path not in self.pending and os.path.isfile(path):
+            self.logger.debug("Noticed {}".format(path))
+            self.pending[path] = (None, None, time.monotonic())
+
+    def _read_events(self, timeout):
+        """Wait up to timeout seconds for inotify events and track the files they are for."""
+        (readable, writable, errors) = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        position = 0
+        while position + Watcher.event_header.size <= len(data):
+            (wd, mask, cookie, length) = Watcher.event_header.unpack_from(data, position)
+            position += Watcher.event_header.size
+            name = os.fsdecode(data[position:position + length].rstrip(b'\0'))
+            position += length
+            if mask & Watcher.IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, rescanning {}".format(self.watch_dir))
+                self._scan()
+            elif name != '':
+                self._seen(os.path.join(self.watch_dir, name))
+
+    def poll(self):
+        """Wait for files to become ready.
+
+        Returns the list of ready files, sorted by name. It may be empty, so call it in a loop.
+        """
+        timeout = min(self.interval, self.settle) if len(self.pending) > 0 else self.interval
+        if self._fd is not None:
+            self._read_events(timeout)
+        else:
+            time.sleep(timeout)
+            self._scan()
+        ready = list()
+        now = time.monotonic()
+        for (path, (size, mtime, changed)) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Removed or renamed before it settled.
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - changed >= self.settle and time.time() - stat.st_mtime >= self.settle:
+                ready.append(path)
+        for path in ready:
+            del self.pending[path]
+            self.handed_out.add(path)
+        return sorted(ready)
+
+    def forget(self, path):
+        """Stop ignoring a file handed out by poll, once it has been moved aside."""
+        self.handed_out.discard(path)
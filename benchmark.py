@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Offline benchmark of multipage2book
+
+Builds synthetic PDFs, Tiffs and HOCR, runs them through multipage2book.py and saves pages/sec and per-stage timings
+as JSON so runs can be compared. Where tesseract or kdu_compress are not installed (or with --stub) they are replaced
+by stub programs that write plausible output and take a calibrated time per megapixel.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import os.path
+import platform
+import random
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.lib.utils import ImageReader
+
+from hocrpdf import HocrPdf
+from Metrics import Metrics
+from ImageInfo import ImageInfo, PdfPageCounter
+from Jp2Encoder import Jp2Encoder
+from PageSplitter import PageSplitter
+
+"""The directory of this script, multipage2book.py is run from here"""
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+"""The synthetic books, sizes are in pixels at 300 dpi"""
+scenarios = [
+    {'name': 'pdf-rgb-jpeg', 'format': 'pdf', 'pages': 10, 'width': 2550, 'height': 3300, 'mode': 'RGB',
+     'compression': 'jpeg'},
+    {'name': 'pdf-gray-flate', 'format': 'pdf', 'pages': 10, 'width': 2550, 'height': 3300, 'mode': 'L',
+     'compression': 'flate'},
+    {'name': 'pdf-long', 'format': 'pdf', 'pages': 50, 'width': 1275, 'height': 1650, 'mode': 'RGB',
+     'compression': 'jpeg'},
+    {'name': 'tiff-rgb-lzw', 'format': 'tiff', 'pages': 10, 'width': 2550, 'height': 3300, 'mode': 'RGB',
+     'compression': 'tiff_lzw'},
+    {'name': 'tiff-gray-deflate', 'format': 'tiff', 'pages': 10, 'width': 2550, 'height': 3300, 'mode': 'L',
+     'compression': 'tiff_adobe_deflate'},
+    {'name': 'tiff-bw-group4', 'format': 'tiff', 'pages': 10, 'width': 2550, 'height': 3300, 'mode': '1',
+     'compression': 'group4'},
+    {'name': 'tiff-cmyk-raw', 'format': 'tiff', 'pages': 5, 'width': 2550, 'height': 3300, 'mode': 'CMYK',
+     'compression': 'raw'},
+]
+
+"""Programs the pipeline can't run without, these are never stubbed"""
+required_tools = ['gs', 'convert', 'identify']
+
+"""Programs that are stubbed when they are not installed"""
+stub_tools = ['tesseract', 'kdu_compress']
+
+"""Seconds per megapixel the stubs take, roughly tesseract and kdu_compress on a 300 dpi page"""
+default_rates = {'tesseract': 0.8, 'kdu_compress': 0.12}
+
+"""The stub program, filled in with the python interpreter, this directory, the tool name and its rate"""
+stub_template = '''#!{python}
+import sys
+sys.path.insert(0, {script_dir!r})
+from benchmark import run_stub
+sys.exit(run_stub({tool!r}, {rate!r}, sys.argv[1:]))
+'''
+
+
+def page_layout(width, height, seed=0):
+    """The lines of words on a synthetic page, the same for the image and its HOCR.
+
+    Keyword arguments
+    width -- The page width in pixels
+    height -- The page height in pixels
+    seed -- Varies the layout between pages
+
+    Returns a list of lines, each line is a list of (x0, y0, x1, y1, word) tuples.
+    """
+    rng = random.Random("{}x{}:{}".format(width, height, seed))
+    margin = width // 10
+    line_height = max(8, height // 60)
+    lines = list()
+    y = margin
+    while y + line_height < height - margin:
+        words = list()
+        x = margin
+        while True:
+            word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+            word_width = len(word) * line_height // 2
+            if x + word_width > width - margin:
+                break
+            words.append((x, y, x + word_width, y + line_height, word))
+            x += word_width + line_height // 2
+        if len(words) > 0:
+            lines.append(words)
+        y += line_height * 2
+    return lines
+
+
+def make_page_image(width, height, mode, seed=0):
+    """Draw a synthetic page, dark word blocks on a slightly uneven background like a scan."""
+    rng = random.Random(seed)
+    image = Image.new('L', (width, height), 235)
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height, 16):
+        # Banding so the background doesn't compress to nothing.
+        draw.rectangle([0, y, width, y + 7], fill=rng.randint(225, 245))
+    for line in page_layout(width, height, seed):
+        for (x0, y0, x1, y1, word) in line:
+            draw.rectangle([x0, y0, x1, y1], fill=rng.randint(10, 60))
+    if mode == '1':
+        return image.point(lambda v: 255 if v > 128 else 0, '1')
+    return image.convert(mode)
+
+
+def make_hocr(width, height, seed=0):
+    """HOCR matching the words of make_page_image."""
+    lines = list()
+    for (line_number, line) in enumerate(page_layout(width, height, seed)):
+        words = ''.join(
+            "<span class='ocrx_word' id='word_1_{0}_{1}' title='bbox {2} {3} {4} {5}; x_wconf 90'>{6}</span> ".format(
+                line_number, word_number, x0, y0, x1, y1, word)
+            for (word_number, (x0, y0, x1, y1, word)) in enumerate(line))
+        lines.append("<span class='ocr_line' id='line_1_{0}' title='bbox {1} {2} {3} {4}; baseline 0 -3'>{5}</span>".format(
+            line_number, line[0][0], line[0][1], line[-1][2], line[-1][3], words))
+    return ("<?xml version='1.0' encoding='UTF-8'?>\n<html xmlns='http://www.w3.org/1999/xhtml'><head>"
+            "<title></title></head><body><div class='ocr_page' id='page_1' title='bbox 0 0 {} {}'>"
+            "<p class='ocr_par'>{}</p></div></body></html>\n").format(width, height, "\n".join(lines))
+
+
+def make_tiff(filename, scenario):
+    """Write a multi-page Tiff for a scenario."""
+    images = [make_page_image(scenario['width'], scenario['height'], scenario['mode'], seed=page)
+              for page in range(scenario['pages'])]
+    images[0].save(filename, save_all=True, append_images=images[1:], compression=scenario['compression'],
+                   dpi=(300, 300))
+
+
+def make_pdf(filename, scenario):
+    """Write a multi-page PDF for a scenario, each page is a scanned image."""
+    points = (scenario['width'] * 72.0 / 300, scenario['height'] * 72.0 / 300)
+    pdf = Canvas(filename, pagesize=points, pageCompression=1)
+    work_dir = os.path.dirname(filename)
+    for page in range(scenario['pages']):
+        image = make_page_image(scenario['width'], scenario['height'], scenario['mode'], seed=page)
+        if scenario['compression'] == 'jpeg':
+            # A file path makes reportlab embed the JPEG as-is (DCTDecode), like most scanned PDFs.
+            jpeg_file = os.path.join(work_dir, 'page.jpg')
+            image.save(jpeg_file, quality=80, dpi=(300, 300))
+            pdf.drawImage(jpeg_file, 0, 0, width=points[0], height=points[1])
+        else:
+            pdf.drawImage(ImageReader(image), 0, 0, width=points[0], height=points[1])
+        pdf.showPage()
+    pdf.save()
+    if os.path.exists(os.path.join(work_dir, 'page.jpg')):
+        os.remove(os.path.join(work_dir, 'page.jpg'))
+
+
+def run_stub(tool, rate, args):
+    """Act like tesseract or kdu_compress, writing plausible output and taking rate seconds per megapixel.
+
+    Keyword arguments
+    tool -- 'tesseract' or 'kdu_compress'
+    rate -- Seconds per megapixel of the input image
+    args -- The command line arguments
+
+    Returns the exit status.
+    """
+    start_time = time.perf_counter()
+    if len(args) < 2:
+        # Version checks, ie. tesseract -v
+        print("{} (benchmark stub)".format(tool))
+        return 0
+    if tool == 'tesseract':
+        image_file = args[0]
+        output_stub = args[1]
+        configs = [arg for arg in args[2:] if arg in ['hocr', 'txt', 'pdf', 'tsv', 'alto']]
+        if len(configs) == 0:
+            configs = ['txt']
+    else:
+        image_file = args[args.index('-i') + 1]
+        output_file = args[args.index('-o') + 1]
+    image = Image.open(image_file)
+    (width, height) = image.size
+    if tool == 'tesseract':
+        for config in configs:
+            if config == 'hocr':
+                with open(output_stub + '.hocr', 'w') as fp:
+                    fp.write(make_hocr(width, height))
+            elif config == 'txt':
+                with open(output_stub + '.txt', 'w') as fp:
+                    fp.write("\n".join(" ".join(word[4] for word in line) for line in page_layout(width, height)))
+            else:
+                # Only the file's existence matters to the pipeline, tesseract saves ALTO as .xml.
+                open(output_stub + ('.xml' if config == 'alto' else '.' + config), 'w').close()
+    else:
+        image.convert('L' if image.mode in ['1', 'L'] else 'RGB').save(output_file, 'JPEG2000', quality_mode='rates',
+                                                                       quality_layers=[20])
+    remaining = rate * width * height / 1000000.0 - (time.perf_counter() - start_time)
+    if remaining > 0:
+        time.sleep(remaining)
+    return 0
+
+
+def write_stubs(bin_dir, tools, rates):
+    """Write the stub programs to a directory that goes first in the PATH."""
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in tools:
+        stub_file = os.path.join(bin_dir, tool)
+        with open(stub_file, 'w') as fp:
+            fp.write(stub_template.format(python=sys.executable, script_dir=script_dir, tool=tool,
+                                          rate=rates[tool]))
+        os.chmod(stub_file, os.stat(stub_file).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def time_in_process(work_dir, scale, repeat, logger):
+    """Time the steps that run inside multipage2book, these don't need any external programs.
+
+    The pages are scaled like those of the scenarios, so the timings compare.
+
+    Returns a dict of step name to the best time in seconds.
+    """
+    results = dict()
+    scenario = {'pages': 10, 'width': int(2550 * scale), 'height': int(3300 * scale), 'mode': 'RGB',
+                'compression': 'jpeg'}
+    pdf_file = os.path.join(work_dir, 'in_process.pdf')
+    make_pdf(pdf_file, scenario)
+    tiff_file = os.path.join(work_dir, 'in_process.tiff')
+    make_tiff(tiff_file, dict(scenario, compression='tiff_lzw'))
+    image_file = os.path.join(work_dir, 'in_process.jp2')
+    make_page_image(scenario['width'], scenario['height'], 'RGB').save(image_file, 'JPEG2000',
+                                                                       quality_mode='rates', quality_layers=[20])
+    hocr_file = os.path.join(work_dir, 'in_process.html')
+    with open(hocr_file, 'w') as fp:
+        fp.write(make_hocr(scenario['width'], scenario['height']))
+    options = argparse.Namespace(overwrite=True, password='', pdf_split='pypdf2', tiff_split='burst', jobs=1,
+                                 master_colorspace='auto', master_depth='auto', master_compression='auto')
+    splitter = PageSplitter(options, logger)
+
+    def split_pdf():
+        pages = make_page_dirs(os.path.join(work_dir, 'split'), scenario['pages'])
+        splitter.split_pdf(pdf_file, pages)
+
+    def burst_tiff():
+        pages = make_page_dirs(os.path.join(work_dir, 'burst'), scenario['pages'])
+        splitter.burst_tiff(tiff_file, pages)
+
+    steps = [
+        ('count_pdf_pages', lambda: PdfPageCounter(pdf_file).count()),
+        ('split_pdf_pypdf2', split_pdf),
+        ('burst_tiff', burst_tiff),
+        ('hocrpdf', lambda: HocrPdf().create_pdf(image_file=image_file, hocr_file=hocr_file,
+                                                 pdf_filename=os.path.join(work_dir, 'hocrpdf.pdf'))),
+    ]
+    for (name, step) in steps:
+        timings = list()
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            step()
+            timings.append(time.perf_counter() - start_time)
+        results[name] = {'best': min(timings), 'runs': timings}
+        print("  {:20} {:8.3f}s".format(name, min(timings)))
+    return results
+
+
+def time_jp2_encoders(work_dir, scale, repeat, threads, stubbed, logger):
+    """Encode the same masters with every JP2 encoder backend that can run here, with both profiles.
+
+    Stubbed programs are skipped, they don't encode anything.
+    Returns a dict of backend to a dict of '<master>-<profile>' to the best time in seconds and the output size.
+    """
+    results = dict()
+    masters = list()
+    for mode in ['RGB', 'L']:
+        master_file = os.path.join(work_dir, 'master-{}.tiff'.format(mode.lower()))
+        make_page_image(int(2550 * scale), int(3300 * scale), mode).save(master_file, dpi=(300, 300))
+        masters.append((mode.lower(), master_file, ImageInfo.probe(master_file, logger=logger)))
+    for name in sorted(Jp2Encoder.backends.keys()):
+        encoder = Jp2Encoder.create(name, logger)
+        if not encoder.available() or (encoder.program is not None and
+                                       (encoder.program in stubbed or shutil.which(encoder.program) is None)):
+            print("  {:20} not available".format(name))
+            continue
+        results[name] = dict()
+        for (master, master_file, info) in masters:
+            for lossless in [False, True]:
+                key = "{}-{}".format(master, 'lossless' if lossless else 'lossy')
+                output_file = os.path.join(work_dir, "{}-{}.jp2".format(name, key))
+                timings = list()
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    encoded = encoder.encode(master_file, output_file, info, lossless, threads=threads)
+                    timings.append(time.perf_counter() - start_time)
+                    if not encoded:
+                        break
+                if not encoded:
+                    results[name][key] = {'error': 'encoding failed'}
+                    print("  {:20} {:16} failed".format(name, key))
+                    continue
+                results[name][key] = {'best': min(timings), 'runs': timings, 'size': os.path.getsize(output_file)}
+                print("  {:20} {:16} {:8.3f}s {:10d} bytes".format(name, key, min(timings),
+                                                                   os.path.getsize(output_file)))
+    return results
+
+
+def make_page_dirs(the_dir, pages):
+    """A fresh set of page directories as (page, directory) tuples."""
+    if os.path.exists(the_dir):
+        shutil.rmtree(the_dir)
+    page_dirs = list()
+    for page in range(1, pages + 1):
+        os.makedirs(os.path.join(the_dir, str(page)))
+        page_dirs.append((page, os.path.join(the_dir, str(page))))
+    return page_dirs
+
+
+def run_scenario(scenario, work_dir, env, args):
+    """Build a scenario's book, run it through multipage2book.py and total its metrics by stage.
+
+    Returns the result dict for the JSON file.
+    """
+    source_dir = os.path.join(work_dir, scenario['name'])
+    os.makedirs(source_dir, exist_ok=True)
+    source_file = os.path.join(source_dir, 'book.' + scenario['format'])
+    if scenario['format'] == 'pdf':
+        make_pdf(source_file, scenario)
+    else:
+        make_tiff(source_file, scenario)
+    result = dict(scenario, source_size=os.path.getsize(source_file), runs=list())
+    for run in range(args.repeat):
+        output_dir = os.path.join(source_dir, 'output')
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        metrics_file = os.path.join(source_dir, 'metrics.jsonl')
+        if os.path.exists(metrics_file):
+            os.remove(metrics_file)
+        op = [sys.executable, os.path.join(script_dir, 'multipage2book.py'), source_file, '--output-dir', output_dir,
+              '--metrics', metrics_file, '--jobs', str(args.jobs)] + shlex.split(args.extra)
+        start_time = time.perf_counter()
+        process = subprocess.run(op, env=env, cwd=source_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+        wall = time.perf_counter() - start_time
+        if process.returncode != 0:
+            result['error'] = process.stdout[-2000:]
+            print("  {:20} failed, see {}".format(scenario['name'], os.path.join(source_dir, 'multipage2book.log')))
+            return result
+        stages = dict()
+        for ((kind, stage, name), total) in Metrics(metrics_file, None, logging.getLogger()).summarise().items():
+            stages["{}:{}".format(stage, name)] = total
+        result['runs'].append({'wall': wall, 'pages_per_sec': scenario['pages'] / wall, 'stages': stages})
+    best = min(result['runs'], key=lambda r: r['wall'])
+    result['wall'] = best['wall']
+    result['pages_per_sec'] = best['pages_per_sec']
+    result['stages'] = best['stages']
+    print("  {:20} {:8.2f}s {:7.2f} pages/sec".format(scenario['name'], best['wall'], best['pages_per_sec']))
+    return result
+
+
+def compare(old_file, results):
+    """Print the change in pages/sec and in-process step times against an earlier results file."""
+    with open(old_file, 'r') as fp:
+        old = json.load(fp)
+    print("Compared to {} ({}):".format(old_file, old.get('date')))
+    for (name, result) in results['scenarios'].items():
+        before = old.get('scenarios', dict()).get(name)
+        if before is None or 'pages_per_sec' not in before or 'pages_per_sec' not in result:
+            continue
+        print("  {:20} {:7.2f} -> {:7.2f} pages/sec ({:+.1f}%)".format(
+            name, before['pages_per_sec'], result['pages_per_sec'],
+            (result['pages_per_sec'] / before['pages_per_sec'] - 1) * 100))
+    for (name, result) in results['in_process'].items():
+        before = old.get('in_process', dict()).get(name)
+        if before is None:
+            continue
+        print("  {:20} {:8.3f}s -> {:8.3f}s ({:+.1f}%)".format(name, before['best'], result['best'],
+                                                               (result['best'] / before['best'] - 1) * 100))
+    for (name, backend) in results['jp2_encoders'].items():
+        for (key, result) in backend.items():
+            before = old.get('jp2_encoders', dict()).get(name, dict()).get(key)
+            if before is None or 'best' not in before or 'best' not in result:
+                continue
+            print("  {:20} {:8.3f}s -> {:8.3f}s ({:+.1f}%), {} -> {} bytes".format(
+                "{} {}".format(name, key), before['best'], result['best'], (result['best'] / before['best'] - 1) * 100,
+                before['size'], result['size']))
+
+
+def tool_version(tool):
+    """First line of a tool's version output, for the results file."""
+    for flag in ['-version', '--version', '-v']:
+        try:
+            process = subprocess.run([tool, flag], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     universal_newlines=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        if process.returncode == 0 and process.stdout.strip() != '':
+            return process.stdout.strip().splitlines()[0]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark multipage2book against synthetic PDFs and Tiffs, stubbing missing OCR/JP2 programs.')
+    parser.add_argument('--output', dest="output", default='benchmark.json',
+                        help='JSON file to save the results to. Defaults to benchmark.json')
+    parser.add_argument('--compare', dest="compare", default=None,
+                        help='An earlier results file to compare against.')
+    parser.add_argument('--scenario', dest="scenarios", action='append', default=None,
+                        choices=[s['name'] for s in scenarios],
+                        help='Only run this scenario, can be given more than once. Defaults to all of them.')
+    parser.add_argument('--scale', dest="scale", type=float, default=1.0,
+                        help='Multiply the page sizes by this, ie. 0.25 for a quick run. Defaults to 1.')
+    parser.add_argument('--repeat', dest="repeat", type=int, default=1,
+                        help='Run each scenario this many times and keep the fastest. Defaults to 1.')
+    parser.add_argument('--jobs', dest="jobs", type=int, default=1,
+                        help='Passed to multipage2book.py. Defaults to 1.')
+    parser.add_argument('--extra', dest="extra", default='',
+                        help='Extra arguments for multipage2book.py, ie. --extra="--rasterize=document"')
+    parser.add_argument('--stub', dest="stub", action='store_true', default=False,
+                        help='Stub tesseract and kdu_compress even if they are installed, so results from different '
+                             'hosts are comparable.')
+    parser.add_argument('--tesseract-rate', dest="tesseract_rate", type=float, default=default_rates['tesseract'],
+                        help='Seconds per megapixel the tesseract stub takes. Defaults to {}.'.format(
+                            default_rates['tesseract']))
+    parser.add_argument('--kdu-rate', dest="kdu_rate", type=float, default=default_rates['kdu_compress'],
+                        help='Seconds per megapixel the kdu_compress stub takes. Defaults to {}.'.format(
+                            default_rates['kdu_compress']))
+    parser.add_argument('--jp2-threads', dest="jp2_threads", type=int, default=None,
+                        help='Threads each JP2 encoder backend is given when they are compared. Defaults to what '
+                             'each does on its own.')
+    parser.add_argument('--work-dir', dest="work_dir", default=None,
+                        help='Directory to build the books in, it is kept afterwards. Defaults to a temporary '
+                             'directory that is removed.')
+    args = parser.parse_args()
+    if args.repeat < 1 or args.jobs < 1 or args.scale <= 0:
+        parser.error("--repeat, --jobs and --scale must be positive.")
+    if args.jp2_threads is not None and args.jp2_threads < 1:
+        parser.error("--jp2-threads must be at least 1.")
+
+    logger = logging.getLogger('multipage2book_benchmark')
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.WARNING)
+
+    if args.work_dir is not None:
+        work_dir = os.path.abspath(args.work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='multipage2book_benchmark_')
+    try:
+        stubbed = [tool for tool in stub_tools if args.stub or shutil.which(tool) is None]
+        write_stubs(os.path.join(work_dir, 'bin'), stubbed,
+                    {'tesseract': args.tesseract_rate, 'kdu_compress': args.kdu_rate})
+        env = dict(os.environ, PATH=os.path.join(work_dir, 'bin') + os.pathsep + os.environ.get('PATH', ''))
+        tools = dict()
+        for tool in required_tools + stub_tools:
+            if tool in stubbed:
+                tools[tool] = 'stub {} s/MP'.format(args.tesseract_rate if tool == 'tesseract' else args.kdu_rate)
+            else:
+                tools[tool] = tool_version(tool) if shutil.which(tool) is not None else None
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=script_dir, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+        except OSError:
+            commit = None
+        results = {'date': datetime.datetime.now().isoformat(), 'commit': commit, 'host': platform.node(),
+                   'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                   'tools': tools, 'jobs': args.jobs, 'extra': args.extra, 'scale': args.scale,
+                   'in_process': dict(), 'jp2_encoders': dict(), 'scenarios': dict()}
+
+        print("In-process steps:")
+        in_process_dir = os.path.join(work_dir, 'in_process')
+        os.makedirs(in_process_dir, exist_ok=True)
+        results['in_process'] = time_in_process(in_process_dir, args.scale, args.repeat, logger)
+
+        print("JP2 encoders:")
+        jp2_dir = os.path.join(work_dir, 'jp2_encoders')
+        os.makedirs(jp2_dir, exist_ok=True)
+        results['jp2_encoders'] = time_jp2_encoders(jp2_dir, args.scale, args.repeat, args.jp2_threads, stubbed,
+                                                    logger)
+
+        missing = [tool for tool in required_tools if tools[tool] is None]
+        if len(missing) > 0:
+            print("Skipping the pipeline, {} not installed.".format(", ".join(missing)))
+            results['skipped'] = "{} not installed".format(", ".join(missing))
+        else:
+            print("Pipeline (tools: {}):".format(", ".join("{}={}".format(k, v) for (k, v) in tools.items())))
+            for scenario in scenarios:
+                if args.scenarios is not None and scenario['name'] not in args.scenarios:
+                    continue
+                scenario = dict(scenario, width=int(scenario['width'] * args.scale),
+                                height=int(scenario['height'] * args.scale))
+                results['scenarios'][scenario['name']] = run_scenario(scenario, work_dir, env, args)
+
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print("Saved results to {}".format(args.output))
+        if args.compare is not None:
+            compare(args.compare, results)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
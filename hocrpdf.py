@@ -22,13 +22,16 @@
 from __future__ import print_function
 import argparse
 import base64
+import hashlib
 import io
 import os.path
 import re
 import zlib
 import math
 
-from reportlab.pdfbase import pdfmetrics
+import reportlab
+from reportlab import rl_config
+from reportlab.pdfbase import pdfdoc, pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.utils import ImageReader
@@ -37,6 +40,46 @@ import xml.etree.ElementTree as ET
 from PIL import Image
 
 
+# Embed images as binary, not ASCII85 which makes the copied JPEG streams a quarter larger.
+rl_config.useA85 = 0
+
+
+class PassThroughImage(pdfdoc.PDFImageXObject):
+    """An image XObject of the bytes of a JPEG 2000 file as they are, the PDF viewer decodes them.
+
+    Only the headers of the file are read, the pixels are never decoded or compressed again. reportlab has no public
+    way to embed a JPEG 2000, so this is only used with the reportlab versions it was checked against (see
+    HocrPdf.can_pass_through), others get the image decoded and compressed by reportlab instead. JPEGs need none of
+    this, reportlab's own ImageReader embeds them as they are.
+    """
+
+    def __init__(self, image_file, image):
+        """Take the size from the headers and the bytes of the file.
+
+        Keyword arguments
+        image_file -- The JPEG 2000 file
+        image -- The file opened by Pillow, which has only read its headers
+        """
+        self.name = hashlib.md5(os.path.abspath(image_file).encode('utf-8')).hexdigest()
+        self.width, self.height = image.size
+        self.mode = image.mode
+        self.mask = None
+        with open(image_file, 'rb') as fp:
+            self.streamContent = fp.read()
+
+    def format(self, document):
+        # A JPEG 2000 brings its own colour space and bit depth, which may be 16 bits.
+        stream = pdfdoc.PDFStream(content=self.streamContent)
+        stream.dictionary["Type"] = pdfdoc.PDFName("XObject")
+        stream.dictionary["Subtype"] = pdfdoc.PDFName("Image")
+        stream.dictionary["Width"] = self.width
+        stream.dictionary["Height"] = self.height
+        stream.dictionary["Filter"] = pdfdoc.PDFArray([pdfdoc.PDFName('JPXDecode')])
+        if self.mode in ['LA', 'RGBA']:
+            stream.dictionary["SMaskInData"] = 1
+        return stream.format(document)
+
+
 class HocrPdf:
 
     dpi = 300
@@ -51,6 +94,11 @@ class HocrPdf:
 
     pattern2 = re.compile('baseline((\s+[\d.\-]+){2})')
 
+    pattern3 = re.compile('scan_res\s+(\d+)\s+(\d+)')
+
+    """Major versions of reportlab whose Canvas internals draw_passthrough_image was checked against"""
+    passthrough_versions = [3, 4, 5]
+
     def __init__(self):
         pdfmetrics.findFontAndRegister('Courier')
         #self.load_invisible_font()
@@ -65,34 +113,103 @@ class HocrPdf:
         return self.debug
 
     def create_pdf(self, image_file, hocr_file, pdf_filename, dpi=300):
-        """Create a PDF from an image and HOCR"""
-        im = Image.open(image_file)
-        w, h = im.size
-        if dpi != 300:
-            self.set_dpi(dpi)
-        try:
-            self.dpi = int(im.info['dpi'][0])
-        except KeyError:
-            pass
-        self.width = self.dpi_to_point(w)
-        self.height = self.dpi_to_point(h)
-        image_wrapper = ImageReader(im)
+        """Create a PDF from an image and HOCR
+
+        A JPEG (or, with a reportlab that allows it, a JPEG 2000) image is embedded as it is, only its headers are
+        read. The page is the size of the image the HOCR was made from, so a smaller image (ie. JPG.jpg) is scaled up
+        to fill it. Its resolution is then the scan_res of the HOCR, or dpi if it has none.
+        """
         with open(hocr_file, 'r') as hocr_fp:
             hocr_data = hocr_fp.read()
-        pdf_data = self.process_pdf(image_wrapper, hocr_data, pdf_filename)
+        # Pillow only reads the headers until the pixels are asked for.
+        with Image.open(image_file) as im:
+            scan_res = self.get_scan_res(hocr_data)
+            if scan_res is not None:
+                self.set_dpi(scan_res)
+            elif dpi != 300:
+                self.set_dpi(dpi)
+            (w, h) = self.get_page_size(hocr_data)
+            if (w, h) == (0, 0) or (w, h) == im.size:
+                # The image is the one that was OCRed, its resolution is the page's.
+                (w, h) = im.size
+                try:
+                    self.dpi = int(im.info['dpi'][0])
+                except KeyError:
+                    pass
+            self.width = self.dpi_to_point(w)
+            self.height = self.dpi_to_point(h)
+            if im.format == 'JPEG2000' and self.can_pass_through():
+                image_data = PassThroughImage(image_file, im)
+            else:
+                # reportlab embeds a JPEG file as it is and decodes anything else.
+                image_data = ImageReader(image_file)
+            pdf_data = self.process_pdf(image_data, hocr_data, pdf_filename)
         with open(pdf_filename, 'wb') as pdf_fp:
             pdf_fp.write(pdf_data)
 
     def process_pdf(self, image_data, hocr_data, pdf_filename):
         """Utility function if you'd rather get the PDF data back instead of save it automatically."""
-        pdf = Canvas(pdf_filename, pageCompression=1)
+        if isinstance(image_data, PassThroughImage):
+            # JPXDecode is PDF 1.5.
+            pdf = Canvas(pdf_filename, pageCompression=1, pdfVersion=(1, 5))
+        else:
+            pdf = Canvas(pdf_filename, pageCompression=1)
         pdf.setCreator('hocr-tools')
         pdf.setPageSize((self.width, self.height))
-        pdf.drawImage(image_data, 0, 0, width=self.width, height=self.height)
+        if isinstance(image_data, PassThroughImage):
+            self.draw_passthrough_image(pdf, image_data)
+        else:
+            pdf.drawImage(image_data, 0, 0, width=self.width, height=self.height)
         pdf = self.add_text_layer(pdf, hocr_data)
         pdf_data = pdf.getpdfdata()
         return pdf_data
 
+    @staticmethod
+    def can_pass_through():
+        """Whether this reportlab has the Canvas internals draw_passthrough_image uses."""
+        try:
+            major = int(reportlab.Version.split('.')[0])
+        except ValueError:
+            return False
+        return major in HocrPdf.passthrough_versions and \
+            all(hasattr(Canvas, name) for name in ['_setXObjects', 'saveState', 'restoreState']) and \
+            all(hasattr(pdfdoc.PDFDocument, name) for name in ['getXObjectName', 'Reference', 'addForm'])
+
+    def draw_passthrough_image(self, pdf, image):
+        """Register a PassThroughImage with the canvas and draw it over the page, as Canvas.drawImage does."""
+        pdf._currentPageHasImages = 1
+        reg_name = pdf._doc.getXObjectName(image.name)
+        if pdf._doc.idToObject.get(reg_name, None) is None:
+            pdf._setXObjects(image)
+            pdf._doc.Reference(image, reg_name)
+            pdf._doc.addForm(image.name, image)
+        pdf.saveState()
+        pdf.scale(self.width, self.height)
+        pdf._code.append("/%s Do" % reg_name)
+        pdf.restoreState()
+        pdf._formsinuse.append(image.name)
+
+    @staticmethod
+    def get_page_size(hocrdata):
+        """The size in pixels of the image the HOCR was made from, (0, 0) if it doesn't say."""
+        hocr = ET.fromstring(hocrdata)
+        for page in hocr.findall('.//*[@class="ocr_page"]'):
+            match = HocrPdf.pattern1.search(page.attrib.get('title', ''))
+            if match is not None:
+                box = [int(i) for i in match.group(1).split()]
+                return (box[2] - box[0], box[3] - box[1])
+        return (0, 0)
+
+    @staticmethod
+    def get_scan_res(hocrdata):
+        """The horizontal resolution of the image the HOCR was made from, None if it doesn't say."""
+        hocr = ET.fromstring(hocrdata)
+        for page in hocr.findall('.//*[@class="ocr_page"]'):
+            match = HocrPdf.pattern3.search(page.attrib.get('title', ''))
+            if match is not None and int(match.group(1)) > 0:
+                return int(match.group(1))
+        return None
+
     def add_text_layer(self, pdf, hocrdata):
         """Draw an invisible text layer for OCR data"""
         font_name = "Courier"
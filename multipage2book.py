@@ -9,16 +9,34 @@ Copyright (c) 2016 University of Manitoba Libraries. All rights reserved.
 import sys
 import os
 import argparse
+import collections
+import math
 import re
 import logging
 import logging.config
 import subprocess
 import time
-import PyPDF2
+import traceback
+import concurrent.futures
 import shutil
+import signal
+import socket
 
 from Derivatives import Derivatives
 from MODSSpreader import MODSSpreader
+from PageSplitter import PageSplitter
+from Manifest import Manifest
+from DerivativeCache import DerivativeCache
+from Metrics import Metrics
+from Watcher import Watcher
+from Leases import Leases
+from AsyncRunner import AsyncRunner
+from ResourceBudget import ResourceBudget
+from TesseractEngine import TesseractEngine
+from Jp2Encoder import Jp2Encoder
+from MasterProfile import MasterProfile
+from Scratch import Scratch
+from PdfAssembler import PdfAssembler
 
 """logger placeholder"""
 logger = None
@@ -29,6 +47,33 @@ derivative_gen = None
 """MODS spreader"""
 spreader = None
 
+"""Source file page splitter"""
+splitter = None
+
+"""Run manifest of generated files"""
+manifest = None
+
+"""Derivative cache shared across runs"""
+cache = None
+
+"""Local staging area the files of each step are written in before they are published, see --scratch-dir"""
+scratch = None
+
+"""Per-stage metrics recorder"""
+metrics = None
+
+"""Memory and thread budget shared by the external programs of all processes, None without --memory-budget"""
+budget = None
+
+"""Page worker pool, only used with --jobs greater than 1"""
+page_pool = None
+
+"""Most pages a pool task splits out of a source file, so the first pages are processed while the rest are split"""
+split_range_pages = 25
+
+"""Set by a signal to stop --watch once the current books are done"""
+stopping = False
+
 """External programs needed for this to operate"""
 required_programs = [
     {'exec': 'gs', 'check_var': '--help'},
@@ -36,21 +81,23 @@ required_programs = [
     {'exec': 'identify', 'check_var': '-version'}
 ]
 
+"""External programs for rasterizing whole PDFs."""
+rasterize_programs = [
+    {'exec': 'mogrify', 'check_var': '-version'}
+]
+
 """External programs needed for creating derivatives."""
 hocr_programs = [
     {'exec': 'tesseract', 'check_var': '-v'},
 ]
 
-"""External programs for Jpeg2000 derivatives."""
-jp2_programs = [
-    {'exec': 'kdu_compress', 'check_var': '-version'}
-]
+"""External programs for Jpeg2000 derivatives, by --jp2-encoder."""
+jp2_programs = dict([(backend.name, [{'exec': backend.program, 'check_var': backend.check_var}])
+                     for backend in Jp2Encoder.backends.values() if backend.program is not None])
 
 """Options dictionary placeholder, generated by ArgumentParser"""
 options = None
 
-"""Regex - Count pages from parsed PDF."""
-rxcountpages = re.compile(rb"/Type\s*/Page([^s]|$)", re.MULTILINE | re.DOTALL)
 """Regex - Match HTML tags"""
 htmlmatch = re.compile(r'<[^>]+>', re.MULTILINE | re.DOTALL)
 """Regex - Match blank lines/characters"""
@@ -71,14 +118,13 @@ def preprocess_file(input_file):
     sanitized_book_name = re.sub(r'[\s\',\-]+', '_', original_book_name.rstrip())
     book_dir = None
     if options.output_dir != '.':
-        if options.output_dir[0:1] == '/' and os.path.exists(options.output_dir):
+        if options.output_dir[0:1] == '/':
             book_dir = os.path.join(options.output_dir, sanitized_book_name + '_dir')
-        elif options.output_dir[0:1] != '/' and os.path.exists(os.path.join(os.getcwd(), options.output_dir)):
+        else:
             book_dir = os.path.join(os.getcwd(), options.output_dir, sanitized_book_name + '_dir')
-    try:
-        if book_dir is not None:
-            logger.debug("Output directory was set to {}".format(book_dir))
-    except UnboundLocalError:
+    if book_dir is not None:
+        logger.debug("Output directory was set to {}".format(book_dir))
+    else:
         # not set, so use old default
         book_dir = os.path.join(os.path.dirname(input_file), sanitized_book_name + '_dir')
     return book_dir, sanitized_book_name, book_number, original_book_name
@@ -90,87 +136,469 @@ def process_file(input_file):
     Keyword arguments
     pdf -- The full path to the input file
     """
+    if options.jobs > 1:
+        # Through the pool's queue, so pages are processed while the rest of the file is split.
+        check_book_results(schedule_books([[input_file]]))
+        return
+    (book_dir, page_tasks) = prepare_file(input_file)
+    results = run_pages(page_tasks, assembler=get_assembler(input_file, book_dir))
+    check_page_results(input_file, results)
+    finish_book(input_file, book_dir)
+
+
+def prepare_file(input_file, boost=None, split=True):
+    """Create the book directory, copy the MODS and work out the page tasks for a source file.
+
+    Keyword arguments
+    input_file -- The full path to the input file
+    boost -- The number to add to each page number, by default with --merge this is the existing page directories.
+    split -- Split the pages out of the source file now, otherwise call split_pages later.
+
+    Returns the book directory and the list of page tasks for process_page.
+    """
     logger.info("Processing {}".format(input_file))
     (book_dir, book_name, book_number, unparsed_book_name) = preprocess_file(input_file)
-    mods_file = None
-    if not os.path.exists(book_dir):
-        os.mkdir(book_dir)
-    if options.mods_dir is not None:
-        tmpfiles = [
-            os.path.join(options.mods_dir, book_name + "." + options.mods_extension),
-            os.path.join(options.mods_dir, unparsed_book_name + "." + options.mods_extension)
-        ]
-        logger.debug("We have a MODS directory to use {}".format(options.mods_dir))
-        for tmpfile in tmpfiles:
-            logger.debug("Look for file {}".format(tmpfile))
-            if os.path.exists(tmpfile) and os.path.isfile(tmpfile):
-                logger.debug("Found file {} and it is a file.".format(tmpfile))
+    with Metrics.tags(book=book_dir, page=0):
+        mods_file = None
+        # Other nodes may be creating these too with --distributed.
+        os.makedirs(book_dir, exist_ok=True)
+        if options.mods_dir is not None:
+            source_mods = find_mods_file(book_name, unparsed_book_name)
+            if source_mods is not None:
                 mods_file = os.path.join(book_dir, 'MODS.xml')
                 logger.debug("copy file to {} and set that as mods_file".format(mods_file))
-                shutil.copyfile(tmpfile, mods_file)
+                with Metrics.tags(stage='MODS.xml'), Metrics.step('copy', mods_file):
+                    partial_file = mods_file + '.partial.{}'.format(os.getpid())
+                    shutil.copyfile(source_mods, partial_file)
+                    os.replace(partial_file, mods_file)
                 logger.debug("Setting up MODS spreader")
-                break
-        if mods_file is None:
-            logger.error("Missing MODS file for {}".format(input_file))
-
-    pages = count_pages(input_file)
-    logger.debug("counted {} pages in {}".format(pages, input_file))
-    if options.merge and book_number is not None:
-        boost = count_subdirectories(book_dir)
-        logger.debug("There are already {} directories, boosting page count.".format(boost))
-    for p in list(range(1, pages + 1)):
-        if options.merge and book_number is not None:
+            else:
+                logger.error("Missing MODS file for {}".format(input_file))
+
+        with Metrics.tags(stage='count'):
+            pages = count_pages(input_file)
+        logger.debug("counted {} pages in {}".format(pages, input_file))
+        if boost is None:
+            boost = 0
+            if options.merge and book_number is not None:
+                boost = count_subdirectories(book_dir)
+                logger.debug("There are already {} directories, boosting page count.".format(boost))
+        # Page numbers are assigned here, before anything is dispatched, so they don't depend on completion order.
+        page_tasks = list()
+        for p in list(range(1, pages + 1)):
             page_number = p + boost
-        else:
-            page_number = p
+            out_dir = os.path.join(book_dir, str(page_number))
+            if not os.path.exists(out_dir):
+                logger.debug("Creating directory for page {} in {}".format(page_number, book_dir))
+                os.makedirs(out_dir, exist_ok=True)
+            page_tasks.append((input_file, book_dir, mods_file, p, page_number))
+        if split:
+            split_pages(input_file, page_tasks)
+    return book_dir, page_tasks
+
+
+def split_pages(input_file, page_tasks, threads=None):
+    """Split some or all of the pages out of a source file in one pass, when the options allow it.
+
+    Keyword arguments
+    input_file -- The full path to the input file
+    page_tasks -- The page tasks for that file from prepare_file
+    threads -- Ghostscript rendering threads for --rasterize=document, defaults to --jobs
+    """
+    if len(page_tasks) == 0:
+        return
+    book_dir = page_tasks[0][1]
+    page_dirs = [(task[3], os.path.join(book_dir, str(task[4]))) for task in page_tasks]
+    with Metrics.tags(book=book_dir, page=0):
+        if is_pdf.match(input_file) and options.pdf_split != 'page':
+            # Split all the pages in one pass, anything missing afterwards is done page by page in get_pdf_page.
+            with Metrics.tags(stage='PDF.pdf'):
+                splitter.split_pdf(input_file, page_dirs)
+        if is_pdf.match(input_file) and not options.skip_derivatives and options.rasterize == 'document':
+            # Render every page in one pass, anything missing afterwards is done page by page in get_tiff.
+            with Metrics.tags(stage='OBJ.tiff'):
+                splitter.rasterize_pdf(input_file, page_dirs, threads=threads)
+        elif not is_pdf.match(input_file) and options.tiff_split == 'burst':
+            # Write every page in one pass, anything missing afterwards is done page by page in get_tiff_page.
+            with Metrics.tags(stage='OBJ.tiff'), Metrics.step('burst'):
+                splitter.burst_tiff(input_file, page_dirs)
+
+
+def split_pages_task(input_file, page_tasks):
+    """Wrapper around split_pages for the worker pool, returns any error instead of raising it.
+
+    Several of these run at once, so each renders with one thread.
+    """
+    try:
+        split_pages(input_file, page_tasks, threads=1)
+    except (Exception, SystemExit) as e:
+        logger.error("Splitting pages {} to {} of {} failed: {}".format(page_tasks[0][3], page_tasks[-1][3], input_file,
+                                                                     repr(e)))
+        return traceback.format_exc()
+    return None
+
+
+def splits_in_one_pass(input_file):
+    """Whether split_pages does anything for a source file with the options given."""
+    if is_pdf.match(input_file):
+        return options.pdf_split != 'page' or (not options.skip_derivatives and options.rasterize == 'document')
+    return options.tiff_split == 'burst'
+
+
+def split_ranges(page_tasks):
+    """Cut the page tasks of a book into the ranges split out of their source file by one pool task each.
+
+    There are about as many ranges of a file as --jobs, of at most split_range_pages pages.
+
+    Returns a list of tuples of the page tasks and whether they are split first, the pages of source files that
+    aren't split in one pass are in a range of their own that isn't.
+    """
+    input_files = list()
+    for task in page_tasks:
+        if task[0] not in input_files:
+            input_files.append(task[0])
+    ranges = list()
+    for input_file in input_files:
+        tasks = [task for task in page_tasks if task[0] == input_file]
+        if not splits_in_one_pass(input_file):
+            ranges.append((tasks, False))
+            continue
+        size = max(1, min(split_range_pages, math.ceil(len(tasks) / options.jobs)))
+        ranges.extend([(tasks[start:start + size], True) for start in range(0, len(tasks), size)])
+    return ranges
+
+
+def find_mods_file(book_name, unparsed_book_name):
+    """Find the MODS file for a book in the --mods-dir
+
+    Keyword arguments
+    book_name -- The sanitized book name
+    unparsed_book_name -- The book name as it is in the filename
+
+    Returns the path to the MODS file or None
+    """
+    tmpfiles = [
+        os.path.join(options.mods_dir, book_name + "." + options.mods_extension),
+        os.path.join(options.mods_dir, unparsed_book_name + "." + options.mods_extension)
+    ]
+    logger.debug("We have a MODS directory to use {}".format(options.mods_dir))
+    for tmpfile in tmpfiles:
+        logger.debug("Look for file {}".format(tmpfile))
+        if os.path.exists(tmpfile) and os.path.isfile(tmpfile):
+            logger.debug("Found file {} and it is a file.".format(tmpfile))
+            return tmpfile
+    return None
+
+
+def finish_book(input_file, book_dir):
+    """Generate the book level derivatives once all the pages are done.
+
+    Keyword arguments
+    input_file -- The full path to the (last) source file of the book
+    book_dir -- The book directory
+    """
+    with Metrics.tags(book=book_dir, page=0):
+        if not options.skip_derivatives:
+            derivative_gen.do_book_derivatives(input_file, book_dir)
+        if is_pdf.match(input_file):
+            # Copy the original PDF to the top-level book directory.
+            with Metrics.tags(stage='PDF.pdf'), Metrics.step('copy', os.path.join(book_dir, 'PDF.pdf')):
+                shutil.copyfile(input_file, os.path.join(book_dir, 'PDF.pdf'))
+
+
+def finish_book_task(input_file, book_dir):
+    """Wrapper around finish_book for the worker pool, returns any error instead of raising it."""
+    try:
+        finish_book(input_file, book_dir)
+    except (Exception, SystemExit) as e:
+        logger.error("Finishing book {} failed: {}".format(book_dir, repr(e)))
+        return traceback.format_exc()
+    return None
+
+
+def process_page(input_file, book_dir, mods_file, p, page_number):
+    """Run the full pipeline for a single page, this is what gets sent to the worker pool.
+
+    Keyword arguments
+    input_file -- The full path to the source PDF/Tiff
+    book_dir -- The book directory
+    mods_file -- The book level MODS file or None
+    p -- The page in the source file
+    page_number -- The page directory to write to (includes any --merge boost)
+
+    Returns a dict with the page number, elapsed time and any error that occurred.
+    """
+    start_time = time.perf_counter()
+    result = {'input_file': input_file, 'source_page': p, 'page': page_number, 'error': None}
+    try:
         logger.info("Processing page {}".format(str(page_number)))
         out_dir = os.path.join(book_dir, str(page_number))
-        if not os.path.exists(os.path.join(book_dir, str(page_number))):
-            logger.debug("Creating directory for page {} in {}".format(page_number, book_dir))
-            os.mkdir(os.path.join(book_dir, out_dir))
-        if is_pdf.match(input_file):
-            new_pdf = get_pdf_page(input_file, p, out_dir)
+        with Metrics.tags(book=book_dir, page=page_number):
+            if is_pdf.match(input_file):
+                with Metrics.tags(stage='PDF.pdf'):
+                    new_pdf = get_pdf_page(input_file, p, out_dir)
+                if not options.skip_derivatives:
+                    with Metrics.tags(stage='OBJ.tiff'):
+                        tiff_file = get_tiff(input_file, p, new_pdf, out_dir)
+            else:
+                with Metrics.tags(stage='OBJ.tiff'):
+                    tiff_file = get_tiff_page(input_file, p, out_dir)
             if not options.skip_derivatives:
-                tiff_file = get_tiff(new_pdf, out_dir)
+                derivative_gen.do_page_derivatives(tiff_file, out_dir, input_file=input_file)
+
+            if mods_file is not None:
+                logger.debug("We have a mods_file.")
+                # Copy mods file and insert
+                with Metrics.tags(stage='MODS.xml'), Metrics.step('modsspreader', os.path.join(out_dir, 'MODS.xml')):
+                    spreader.make_page_mods(filename=mods_file, output_dir=out_dir, page=p)
+    except (Exception, SystemExit) as e:
+        # quit() is used throughout to abort on failure, catch it so the parent can decide what to do.
+        logger.error("Page {} of {} failed: {}".format(page_number, input_file, repr(e)))
+        result['error'] = traceback.format_exc()
+    result['elapsed'] = time.perf_counter() - start_time
+    return result
+
+
+def run_pages(page_tasks, assembler=None, abandon=None):
+    """Run the page pipelines, in the worker pool if --jobs is more than 1.
+
+    Keyword arguments
+    page_tasks -- list of argument tuples for process_page
+    assembler -- The PdfAssembler of the book to add each page to as it finishes, or None
+    abandon -- Function returning True once the pages not yet started should be dropped, or None
+
+    Returns the list of page results sorted by page number, without any dropped pages.
+    """
+    results = list()
+    if options.jobs > 1:
+        pool = get_page_pool()
+        futures = dict()
+        broken = False
+        for task in page_tasks:
+            try:
+                futures[pool.submit(process_page, *task)] = task
+            except concurrent.futures.BrokenExecutor as e:
+                broken = True
+                results.append(lost_page(task, e))
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except concurrent.futures.BrokenExecutor as e:
+                broken = True
+                result = lost_page(futures[future], e)
+            logger.debug("Page {} finished in {:.2f}s".format(result['page'], result['elapsed']))
+            results.append(result)
+            assemble_page(assembler, result)
+            if abandon is not None and abandon():
+                for other in futures:
+                    other.cancel()
+        if broken:
+            reset_page_pool(pool)
+    else:
+        for task in page_tasks:
+            if abandon is not None and abandon():
+                break
+            result = process_page(*task)
+            results.append(result)
+            assemble_page(assembler, result)
+            if result['error'] is not None:
+                # Serially we stop at the first problem, like we always have.
+                break
+    return sorted(results, key=lambda x: x['page'])
+
+
+def get_assembler(input_file, book_dir):
+    """The PdfAssembler that merges the page PDFs of a book as they finish, None if the book PDF isn't merged.
+
+    Keyword arguments
+    input_file -- The full path to a source file of the book
+    book_dir -- The book directory
+    """
+    if options.skip_derivatives or is_pdf.match(input_file):
+        # The book PDF of a PDF is the original.
+        return None
+    return PdfAssembler(book_dir, logger)
+
+
+def assemble_page(assembler, result):
+    """Add a finished page to the book PDF, anything that goes wrong is left for finish_book to do again.
+
+    Keyword arguments
+    assembler -- The PdfAssembler of the book, or None
+    result -- The result of the page from process_page
+    """
+    if assembler is None or result['error'] is not None:
+        return
+    with Metrics.tags(book=assembler.book_dir, page=result['page'], stage='PDF.pdf'), Metrics.step('pdf-assemble'):
+        try:
+            assembler.page_done(result['page'])
+        except Exception as e:
+            logger.warning("Unable to add page {} to the PDF of {}, it is added when the book is finished: {}".format(
+                result['page'], assembler.book_dir, repr(e)))
+
+
+def check_page_results(input_file, results):
+    """Report any failed pages and stop, the book level derivatives need every page.
+
+    Keyword arguments
+    input_file -- The source file the pages came from
+    results -- The list of results from run_pages
+    """
+    mesg = report_page_failures(input_file, results)
+    if mesg is not None:
+        print("ERROR: " + mesg)
+        quit(1)
+
+
+def report_page_failures(input_file, results):
+    """Log the errors of any failed pages.
+
+    Keyword arguments
+    input_file -- The source file (or book) the pages came from
+    results -- The list of page results
+
+    Returns a summary message or None if all pages succeeded.
+    """
+    failed = [r for r in results if r['error'] is not None]
+    if len(failed) == 0:
+        return None
+    for result in failed:
+        logger.error("Page {} (source page {} of {}) failed:\n{}".format(result['page'], result['source_page'],
+                                                                         result['input_file'], result['error']))
+    return "{} page(s) of {} failed: {}".format(len(failed), input_file,
+                                                ", ".join([str(r['page']) for r in sorted(failed,
+                                                                                          key=lambda x: x['page'])]))
+
+
+def get_page_pool():
+    """Get the worker pool, creating it on first use."""
+    global page_pool
+    if page_pool is None:
+        logger.debug("Starting worker pool with {} {}s".format(options.jobs, options.executor))
+        if options.executor == 'thread':
+            # Everything is already set up in this process, the external programs run on its AsyncRunner.
+            page_pool = concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs,
+                                                              thread_name_prefix='page-worker')
         else:
-            tiff_file = get_tiff_page(input_file, p, out_dir)
-        if not options.skip_derivatives:
-            derivative_gen.do_page_derivatives(tiff_file, out_dir, input_file=input_file)
+            page_pool = concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs, initializer=init_worker,
+                                                               initargs=(options, budget))
+    return page_pool
+
+
+def reset_page_pool(broken_pool):
+    """Throw away a worker pool that broke (ie. a worker was killed for memory), get_page_pool then starts a new one.
+
+    Keyword arguments
+    broken_pool -- The pool that broke, nothing is done if it was already replaced
+    """
+    global page_pool
+    if page_pool is not None and page_pool is broken_pool:
+        logger.error("A worker process died, starting a new worker pool")
+        page_pool.shutdown(wait=False)
+        page_pool = None
+
+
+def lost_page(task, error):
+    """The result of a page whose worker process died, as process_page would have returned it.
+
+    Keyword arguments
+    task -- The argument tuple of the page for process_page
+    error -- The BrokenExecutor raised for it
+    """
+    (input_file, book_dir, mods_file, p, page_number) = task
+    logger.error("Page {} of {} was lost, the worker process running it died".format(page_number, input_file))
+    return {'input_file': input_file, 'source_page': p, 'page': page_number, 'elapsed': 0.0,
+            'error': "The worker process running it died: {}".format(repr(error))}
+
+
+def shutdown_page_pool():
+    """Stop the worker pool if we started one."""
+    global page_pool
+    if page_pool is not None:
+        page_pool.shutdown(wait=True)
+        page_pool = None
+
+
+def init_worker(args, host_budget):
+    """Set up the module globals in a worker process.
+
+    Keyword arguments
+    args -- the ArgumentParser object from the parent
+    host_budget -- the parent's ResourceBudget, or None
+    """
+    global options, derivative_gen, spreader, splitter, manifest, cache, scratch, metrics, budget
+    options = args
+    budget = host_budget
+    if logger is None:
+        # Not forked from the parent, so append to its log instead of truncating it.
+        setup_log(mode='a')
+    if options.watch:
+        # Signals go to the whole process group (or service), let the parent finish the current books.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    metrics = Metrics(options.metrics_file, options.metrics_run, logger)
+    metrics.install()
+    AsyncRunner.configure(limits=options.tool_limits, budget=budget)
+    manifest = get_manifest()
+    cache = DerivativeCache(options.cache_dir, options.cache_size * 1048576, logger)
+    scratch = Scratch(options.scratch_root, options.scratch_size * 1048576, logger)
+    derivative_gen = Derivatives(options, logger, manifest=manifest, cache=cache, scratch=scratch)
+    spreader = MODSSpreader(logger=logger)
+    splitter = PageSplitter(options, logger, manifest=manifest, cache=cache, scratch=scratch)
 
-        if mods_file is not None:
-            logger.debug("We have a mods_file.")
-            # Copy mods file and insert
-            spreader.make_page_mods(filename=mods_file, output_dir=os.path.join(book_dir, out_dir), page=p)
-    if not options.skip_derivatives:
-        derivative_gen.do_book_derivatives(input_file, book_dir)
-    if is_pdf.match(input_file):
-        # Copy the original PDF to the top-level book directory.
-        shutil.copyfile(input_file, os.path.join(book_dir, 'PDF.pdf'))
 
+def get_manifest_file():
+    """The manifest database lives at the top of the output directory, None if disabled with --no-manifest.
 
-def get_tiff(new_pdf, out_dir):
+    With --distributed each node keeps its own, SQLite's locking can't be trusted over NFS.
+    """
+    if options.no_manifest:
+        return None
+    if options.distributed:
+        return os.path.join(os.path.abspath(options.output_dir), 'multipage2book.{}.sqlite'.format(options.node_id))
+    return os.path.join(os.path.abspath(options.output_dir), 'multipage2book.sqlite')
+
+
+def get_manifest():
+    """Open the manifest of this run.
+
+    With --distributed a file this node never recorded may have been left half written by a node that died, so it is
+    generated again rather than trusted. The chunks finished by other nodes are skipped by their leases.
+    """
+    return Manifest(get_manifest_file(), options, logger, adopt=not options.distributed)
+
+
+def get_tiff(pdf, page, new_pdf, out_dir):
     """Produce a single page Tiff from a single page PDF
 
+    The Tiff is recorded against the page of the source PDF, the bytes of the page PDF differ on every split.
+
     Keyword arguments
-    new_pdf -- The full path to the PDF file
+    pdf -- The full path to the source PDF file
+    page -- The page of the source PDF
+    new_pdf -- The full path to the single page PDF file
     out_dir -- The directory to save the single page Tiff to
     """
     resolution = options.resolution
     # Increase density by 25%, then resize to only 75%
     altered_resolution = int(resolution * 1.25)
     output_file = os.path.join(out_dir, 'OBJ.tiff')
-    if os.path.exists(output_file) and os.path.isfile(output_file) and options.overwrite:
-        # Delete the file if it exists AND we set --overwrite
-        os.remove(output_file)
-        logger.debug("{} exists and we are deleting it.".format(output_file))
-
-    if not os.path.exists(output_file):
-        # Only run if the file doesn't exist.
-        logger.debug("Generating Tiff from PDF")
-        op = ['convert', '-density', str(altered_resolution), new_pdf, '-alpha', 'Off', '-resize', '75%', '-colorspace',
-              'CMYK', output_file]
-        if not Derivatives.do_system_call(op, logger=logger):
-            quit()
+    params = splitter.tiff_params(page)
+    if manifest.needs_output(output_file, input_file=pdf, params=params):
+        # Only run if the file doesn't exist (or is incomplete/stale).
+        if not cache.fetch(output_file, [pdf], params):
+            logger.debug("Generating Tiff from PDF")
+            with scratch.staged(out_dir, ['OBJ.tiff']) as work_dir:
+                work_file = os.path.join(work_dir, 'OBJ.tiff')
+                op = ['convert', '-density', str(altered_resolution), new_pdf, '-alpha', 'Off', '-resize', '75%'] + \
+                    splitter.master_profile.convert_args() + [work_file]
+                if not Derivatives.do_system_call(op, logger=logger):
+                    quit()
+                splitter.master_profile.conform(work_file)
+            cache.store(output_file, [pdf], params)
+        manifest.output_done(output_file)
     return output_file
 
 
@@ -184,14 +612,18 @@ def get_tiff_page(tiff_file, page_num, out_dir):
     """
     output_file = os.path.join(out_dir, 'OBJ.tiff')
     adjusted_page = page_num - 1
-    if os.path.exists(output_file) and os.path.isfile(output_file) and options.overwrite:
-        os.remove(output_file)
-        logger.debug("{} exists and we are deleting it.".format(output_file))
-    if not os.path.exists(output_file):
-        logger.debug("Getting Tiff from multi-page Tiff")
-        op = ['convert', '{0}[{1}]'.format(tiff_file, str(adjusted_page)), output_file]
-        if not Derivatives.do_system_call(op, logger=logger):
-            quit()
+    params = splitter.tiff_page_params(page_num)
+    if manifest.needs_output(output_file, input_file=tiff_file, params=params):
+        if not cache.fetch(output_file, [tiff_file], params):
+            logger.debug("Getting Tiff from multi-page Tiff")
+            with scratch.staged(out_dir, ['OBJ.tiff']) as work_dir:
+                work_file = os.path.join(work_dir, 'OBJ.tiff')
+                op = ['convert', '{0}[{1}]'.format(tiff_file, str(adjusted_page)), work_file]
+                if not Derivatives.do_system_call(op, logger=logger):
+                    quit()
+                splitter.master_profile.conform(work_file)
+            cache.store(output_file, [tiff_file], params)
+        manifest.output_done(output_file)
     return output_file
 
 
@@ -206,20 +638,19 @@ def get_pdf_page(pdf, page, out_dir):
     Returns the path to the new PDF file
     """
     output_file = os.path.join(out_dir, 'PDF.pdf')
-    if os.path.exists(output_file) and os.path.isfile(output_file) and options.overwrite:
-        # Delete the file if it exists AND we set --overwrite
-        os.remove(output_file)
-        logger.debug("{} exists and we are deleting it.".format(output_file))
-
-    if not os.path.exists(output_file):
-        # Only run if the file doesn't exist.
+    if manifest.needs_output(output_file, input_file=pdf, params={'page': page}):
+        # Only run if the file doesn't exist (or is incomplete/stale).
         logger.debug("Generating PDF for page {}".format(str(page)))
         op = ['gs', '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.3',
-              '-dAutoRotatePages=/None',
+              '-dAutoRotatePages=/None'] + PageSplitter.reproducible_args + [
               '-sOutputFile={}'.format(output_file),
-              '-dFirstPage={}'.format(str(page)), '-dLastPage={}'.format(str(page)), pdf]
+              '-dFirstPage={}'.format(str(page)), '-dLastPage={}'.format(str(page))]
+        if options.password:
+            op.append('-sPDFPassword={}'.format(options.password))
+        op.append(pdf)
         if not Derivatives.do_system_call(op, logger=logger):
             quit()
+        manifest.output_done(output_file)
     return output_file
 
 
@@ -229,21 +660,11 @@ def count_pages(input_file):
     Keyword arguments
     input_file -- the full path to the input file
     """
-    count = 0
-    if is_pdf.match(input_file):
-        with open(input_file, 'rb') as fp:
-            count += len(rxcountpages.findall(fp.read()))
-        if count == 0:
-            pdf_read = PyPDF2.PdfFileReader(input_file)
-            count = pdf_read.getNumPages()
-            pdf_read = None
-    else:
-        ops = [
-            'identify', '-strip', '-ping', '-format', "%n\\n", input_file
-        ]
-        results = Derivatives.do_system_call(ops, logger=logger, return_result=True, fail_on_error=False)
-        count = int(results.rstrip().split('\n').pop())
-
+    count = splitter.count_pages(input_file)
+    if count is None:
+        logger.error("Unable to count the pages of {}".format(input_file))
+        print("Unable to count the pages of {}".format(input_file))
+        quit(1)
     return count
 
 
@@ -261,8 +682,62 @@ def parse_dir(the_dir):
     Keyword arguments
     the_dir -- The full path to the directory to operate on
     """
+    if options.distributed:
+        # Other nodes create the book directories of --merge groups, so they can't be required to be empty.
+        check_book_results(distribute_books(find_books(the_dir, check_empty=False)))
+        return
+    books = find_books(the_dir)
+    if options.jobs > 1:
+        check_book_results(schedule_books(books))
+    else:
+        for book_files in books:
+            for input_file in book_files:
+                # Process all books together in sequence
+                process_file(input_file)
+
+
+def check_book_results(failures):
+    """Report any failed books and stop.
+
+    Keyword arguments
+    failures -- list of (book files, message) from schedule_books or distribute_books
+    """
+    if len(failures) > 0:
+        for (book_files, mesg) in failures:
+            print("ERROR: " + mesg)
+        quit(1)
+
+
+def prepare_book(book_files, split=True):
+    """Prepare all the source files of a book, numbering the pages of --merge groups in file order.
+
+    Keyword arguments
+    book_files -- list of the source files of the book from find_books
+    split -- Split the pages out of the source files now
+
+    Returns the book directory and the list of page tasks for process_page.
+    """
+    boost = 0
+    page_tasks = list()
+    for input_file in book_files:
+        (book_dir, tasks) = prepare_file(input_file, boost=boost, split=split)
+        boost += len(tasks)
+        page_tasks.extend(tasks)
+    return book_dir, page_tasks
+
+
+def find_books(the_dir, check_empty=True):
+    """Find the books in a directory, with --merge the numbered files of a book are grouped together.
+
+    Keyword arguments
+    the_dir -- The full path to the directory to operate on
+    check_empty -- Stop if the book directory of a --merge group already has pages
+
+    Returns a list of books, each book is a list of the full paths to its source files in order.
+    """
     files = [f for f in os.listdir(the_dir) if valid_extensions.search(f)]
     processed = list()
+    books = list()
     counter = 0
     for f in files:
         if f in processed:
@@ -270,29 +745,425 @@ def parse_dir(the_dir):
         if options.limit is not None and counter >= options.limit:
             # We have hit the limit
             logger.warning("Hit the --limit of {}, stopping".format(options.limit))
-            return
+            break
         counter += 1
         book_name = os.path.splitext(os.path.split(f)[1])[0]
         if options.merge and re.search(r'\d+$', book_name) is not None:
             (book_name, book_number, junk) = re.split(r'(\d+)$', book_name)
-            other_books = [re.split(r'(\d+)(\.)', f) for f in os.listdir(the_dir) if re.match(r'' + book_name + '\d+\.', f)]
+            other_books = [re.split(r'(\d+)(\.)', f) for f in os.listdir(the_dir)
+                           if re.match(re.escape(book_name) + r'\d+\.', f) and valid_extensions.search(f)]
             other_books = sorted(other_books, key=lambda x: int(x[1]))
             other_books = [''.join(f) for f in other_books]
             for fx in other_books:
                 processed.append(fx)
             # Before we start make sure the target directory is empty
-            (book_dir, name, number) = preprocess_file(other_books[0])
-            if count_subdirectories(book_dir) > 0:
+            (book_dir, name, number, unparsed_name) = preprocess_file(os.path.join(the_dir, other_books[0]))
+            if check_empty and count_subdirectories(book_dir) > 0:
                 mesg = "We are attempting to merge {} files into {} and there are already existing subdirectories. " \
                        "This must be an empty directory".format(len(other_books), book_dir)
                 logger.error(mesg)
                 print("ERROR: " + mesg)
                 quit()
-            for same_books in other_books:
-                # Process all books together in sequence
-                process_file(os.path.join(the_dir, same_books))
+            books.append([os.path.join(the_dir, same_books) for same_books in other_books])
         else:
-            process_file(os.path.join(the_dir, f))
+            books.append([os.path.join(the_dir, f)])
+    return books
+
+
+def schedule_books(books):
+    """Process the pages of all books through one bounded queue on the worker pool.
+
+    The largest books are started first, the pages of --merge groups are numbered in file order before anything is
+    sent out and each book is finished as soon as its last page is done. The source files are split (and with
+    --rasterize=document rendered) by pool tasks too, a range of pages at a time, and the pages of a range are queued
+    as soon as it is split.
+
+    Keyword arguments
+    books -- list of books from find_books
+
+    Returns a list of (book files, message) for the books that failed.
+    """
+    plans = list()
+    failures = list()
+    for book_files in books:
+        try:
+            (book_dir, page_tasks) = prepare_book(book_files, split=False)
+        except (Exception, SystemExit) as e:
+            logger.error("Preparing {} failed:\n{}".format(book_files[0], traceback.format_exc()))
+            failures.append((book_files, "Preparing {} failed: {}".format(book_files[0], repr(e))))
+            continue
+        plans.append({'book_dir': book_dir, 'files': book_files, 'input_file': book_files[-1], 'tasks': page_tasks,
+                      'remaining': len(page_tasks), 'results': list(),
+                      'assembler': get_assembler(book_files[-1], book_dir)})
+    plans = sorted(plans, key=lambda x: len(x['tasks']), reverse=True)
+    ready = collections.deque()
+    splits = collections.deque()
+    for plan in plans:
+        for (tasks, split) in split_ranges(plan['tasks']):
+            if split:
+                splits.append((plan, tasks))
+            else:
+                ready.extend([(plan, task) for task in tasks])
+    logger.info("Scheduling {} pages from {} books, {} ranges to split first, on {} workers".format(
+        sum([len(plan['tasks']) for plan in plans]), len(plans), len(splits), options.jobs))
+
+    max_in_flight = options.jobs * 2
+    in_flight = dict()
+    splitting = 0
+
+    def submit(kind, plan, work, function, *args):
+        pool = get_page_pool()
+        try:
+            future = pool.submit(function, *args)
+        except concurrent.futures.BrokenExecutor:
+            reset_page_pool(pool)
+            pool = get_page_pool()
+            future = pool.submit(function, *args)
+        in_flight[future] = (kind, plan, work, pool)
+
+    for plan in plans:
+        if plan['remaining'] == 0:
+            submit('book', plan, None, finish_book_task, plan['input_file'], plan['book_dir'])
+    while len(ready) > 0 or len(splits) > 0 or len(in_flight) > 0:
+        while len(in_flight) < max_in_flight:
+            if len(splits) > 0 and len(ready) < max_in_flight and splitting < options.jobs:
+                # Keep enough pages split ahead to fill the pool.
+                (plan, tasks) = splits.popleft()
+                submit('split', plan, tasks, split_pages_task, tasks[0][0], tasks)
+                splitting += 1
+            elif len(ready) > 0:
+                (plan, task) = ready.popleft()
+                submit('page', plan, task, process_page, *task)
+            else:
+                break
+        done, not_done = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        finished = list()
+        broken = dict()
+        for future in done:
+            (kind, plan, work, pool) = in_flight.pop(future)
+            try:
+                finished.append((kind, plan, work, future.result()))
+            except concurrent.futures.BrokenExecutor as e:
+                broken[pool] = e
+                finished.append((kind, plan, work, e))
+        for (pool, error) in broken.items():
+            # Everything else sent to a broken pool is lost with it.
+            for (future, (kind, plan, work, future_pool)) in list(in_flight.items()):
+                if future_pool is pool:
+                    del in_flight[future]
+                    finished.append((kind, plan, work, error))
+            reset_page_pool(pool)
+        for (kind, plan, work, result) in finished:
+            if isinstance(result, concurrent.futures.BrokenExecutor):
+                if kind == 'page':
+                    result = lost_page(work, result)
+                else:
+                    result = "The worker process running it died: {}".format(repr(result))
+            if kind == 'split':
+                splitting -= 1
+                if result is not None:
+                    logger.warning("Splitting pages {} to {} of {} failed, they are made one at a time:\n{}".format(
+                        work[0][4], work[-1][4], plan['book_dir'], result))
+                ready.extend([(plan, task) for task in work])
+            elif kind == 'page':
+                logger.debug("Page {} of {} finished in {:.2f}s".format(result['page'], plan['book_dir'],
+                                                                       result['elapsed']))
+                plan['results'].append(result)
+                plan['remaining'] -= 1
+                assemble_page(plan['assembler'], result)
+                if plan['remaining'] == 0:
+                    mesg = report_page_failures(plan['book_dir'], plan['results'])
+                    if mesg is None:
+                        logger.info("All pages of {} done, finishing book".format(plan['book_dir']))
+                        submit('book', plan, None, finish_book_task, plan['input_file'], plan['book_dir'])
+                    else:
+                        failures.append((plan['files'], mesg))
+            elif result is not None:
+                logger.error("Finishing book {} failed:\n{}".format(plan['book_dir'], result))
+                failures.append((plan['files'], "Finishing book {} failed".format(plan['book_dir'])))
+    return failures
+
+
+def distribute_books(books):
+    """Share the books with other nodes running with --distributed on the same output directory.
+
+    Books are cut into chunks of --chunk-pages pages, each node claims chunks through lease files in the output
+    directory and processes them with its own --jobs. Once every chunk of a book is done, one node claims and finishes
+    the book. This returns once every book is finished or has failed, on whichever node did the work.
+
+    Keyword arguments
+    books -- list of books from find_books
+
+    Returns a list of (book files, message) for the books that failed.
+    """
+    leases = Leases(os.path.join(os.path.abspath(options.output_dir), '.leases'), options.node_id, options.lease_ttl,
+                    logger, overwrite=options.overwrite, run_id=options.run_id)
+    leases.start()
+    plans = list()
+    failures = list()
+    try:
+        for book_files in books:
+            try:
+                # Pages are numbered from the source files, not from what other nodes have already created.
+                (book_dir, page_tasks) = prepare_book(book_files, split=False)
+            except (Exception, SystemExit) as e:
+                logger.error("Preparing {} failed:\n{}".format(book_files[0], traceback.format_exc()))
+                failures.append((book_files, "Preparing {} failed: {}".format(book_files[0], repr(e))))
+                continue
+            name = os.path.basename(book_dir)
+            chunks = list()
+            for start in range(0, len(page_tasks), options.chunk_pages):
+                tasks = page_tasks[start:start + options.chunk_pages]
+                chunks.append(("{}.pages-{}-{}".format(name, tasks[0][4], tasks[-1][4]), tasks))
+            fingerprint = source_fingerprint(book_files)
+            done = len([chunk_name for (chunk_name, tasks) in chunks if leases.is_done(chunk_name, fingerprint)])
+            if done > 0:
+                logger.info("{} of the {} chunks of {} are already done, delete their .done files in {} to redo "
+                            "them".format(done, len(chunks), book_dir, leases.lease_dir))
+            plans.append({'book_dir': book_dir, 'files': book_files, 'input_file': book_files[-1], 'name': name,
+                          'chunks': chunks, 'fingerprint': fingerprint})
+        remaining = plans
+        while len(remaining) > 0:
+            worked = False
+            for plan in remaining:
+                fingerprint = plan['fingerprint']
+                for (name, tasks) in plan['chunks']:
+                    if leases.is_done(name, fingerprint) or leases.failure(name) is not None or \
+                            not leases.claim(name):
+                        continue
+                    worked = True
+                    run_chunk(leases, name, tasks, fingerprint)
+                if all([leases.is_done(name, fingerprint) for (name, tasks) in plan['chunks']]):
+                    name = plan['name'] + '.finish'
+                    if not leases.is_done(name, fingerprint) and leases.failure(name) is None and leases.claim(name):
+                        worked = True
+                        # Another node may have finished it between our check and claim.
+                        if not leases.is_done(name, fingerprint):
+                            logger.info("All pages of {} done, finishing book".format(plan['book_dir']))
+                            error = finish_book_task(plan['input_file'], plan['book_dir'])
+                            if name in leases.lost:
+                                logger.error("Lost the lease on {} while finishing it".format(plan['book_dir']))
+                            elif error is None:
+                                leases.mark_done(name, fingerprint)
+                            else:
+                                leases.mark_failed(name, "Finishing book {} failed".format(plan['book_dir']))
+                        leases.release(name)
+            still_remaining = list()
+            for plan in remaining:
+                mesgs = [leases.failure(name) for (name, tasks) in plan['chunks']] + \
+                        [leases.failure(plan['name'] + '.finish')]
+                mesgs = [mesg for mesg in mesgs if mesg is not None]
+                if len(mesgs) > 0:
+                    failures.append((plan['files'], "; ".join(mesgs)))
+                elif not leases.is_done(plan['name'] + '.finish', plan['fingerprint']):
+                    still_remaining.append(plan)
+            remaining = still_remaining
+            if len(remaining) > 0 and not worked:
+                # Everything left is claimed by other nodes, wait for them to finish or die.
+                logger.debug("Waiting on other nodes for {} book(s)".format(len(remaining)))
+                time.sleep(leases.heartbeat_interval)
+    finally:
+        leases.stop()
+    return failures
+
+
+def source_fingerprint(book_files):
+    """Identify the source files of a book as they are now, so work done on a file since replaced isn't skipped."""
+    stats = [(os.path.basename(input_file), os.stat(input_file)) for input_file in book_files]
+    return ";".join(["{}:{}:{}".format(name, stat.st_size, stat.st_mtime_ns) for (name, stat) in stats])
+
+
+def run_chunk(leases, name, tasks, fingerprint):
+    """Process a claimed chunk of pages and record how it went.
+
+    Keyword arguments
+    leases -- The Leases
+    name -- The name of the chunk's lease
+    tasks -- The page tasks of the chunk
+    fingerprint -- The source_fingerprint of the chunk's book
+    """
+    logger.info("Claimed {} ({} pages)".format(name, len(tasks)))
+    try:
+        for input_file in sorted(set([task[0] for task in tasks])):
+            split_pages(input_file, [task for task in tasks if task[0] == input_file])
+        # Once another node has taken the chunk over, leave the pages not started yet to it.
+        results = run_pages(tasks, abandon=lambda: name in leases.lost)
+        mesg = report_page_failures(name, results)
+    except (Exception, SystemExit) as e:
+        logger.error("Processing {} failed:\n{}".format(name, traceback.format_exc()))
+        mesg = "Processing {} failed: {}".format(name, repr(e))
+    if name in leases.lost:
+        # Another node thought we were dead and has taken it over, leave the marking to them.
+        logger.error("Lost the lease on {} while processing it".format(name))
+    elif mesg is None:
+        leases.mark_done(name, fingerprint)
+    else:
+        leases.mark_failed(name, mesg)
+    leases.release(name)
+
+
+def watch_dir(the_dir):
+    """Process PDFs/Tiffs as they are dropped into a directory, until stopped with SIGTERM or Ctrl-C.
+
+    Everything is set up once and the worker pool is kept between books. Each file is processed once it has stopped
+    changing for --watch-settle seconds and is then moved to the --watch-done-dir or --watch-failed-dir.
+
+    Keyword arguments
+    the_dir -- The full path to the directory to watch
+    """
+    for move_dir in [options.watch_done_dir, options.watch_failed_dir]:
+        if not os.path.exists(move_dir):
+            os.makedirs(move_dir)
+    derivative_gen.warm_up()
+
+    def stop(signum, frame):
+        global stopping
+        logger.info("Received signal {}, stopping after the current books".format(signum))
+        print("Stopping after the current books")
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    watcher = Watcher(the_dir, options.watch_settle, options.watch_interval, logger)
+    print("Watching {}{}".format(the_dir, "" if watcher.using_inotify() else " (polling)"))
+    try:
+        while not stopping:
+            ready = watcher.poll()
+            if len(ready) == 0:
+                continue
+            logger.info("Processing {} new file(s): {}".format(len(ready), ", ".join(ready)))
+            books = [[input_file] for input_file in ready]
+            if options.jobs > 1:
+                failures = schedule_books(books)
+            else:
+                failures = list()
+                for book_files in books:
+                    try:
+                        process_file(book_files[0])
+                    except (Exception, SystemExit) as e:
+                        logger.error("Processing {} failed:\n{}".format(book_files[0], traceback.format_exc()))
+                        failures.append((book_files, "Processing {} failed: {}".format(book_files[0], repr(e))))
+            failed_files = [f for (book_files, mesg) in failures for f in book_files]
+            for (book_files, mesg) in failures:
+                print("ERROR: " + mesg)
+            for input_file in ready:
+                move_aside(input_file, options.watch_failed_dir if input_file in failed_files else
+                           options.watch_done_dir)
+                watcher.forget(input_file)
+            if options.metrics_prom is not None:
+                metrics.write_prometheus(options.metrics_prom)
+    finally:
+        watcher.close()
+
+
+def move_aside(input_file, move_dir):
+    """Move a processed source file out of the watched directory, without replacing an earlier file of that name."""
+    destination = os.path.join(move_dir, os.path.basename(input_file))
+    if os.path.exists(destination):
+        (name, extension) = os.path.splitext(os.path.basename(input_file))
+        destination = os.path.join(move_dir, "{}.{}{}".format(name, time.strftime('%Y%m%d%H%M%S'), extension))
+    logger.debug("Moving {} to {}".format(input_file, destination))
+    shutil.move(input_file, destination)
+
+
+def page_stages(input_file):
+    """The files generated in each page directory for a source file, in the order they are made."""
+    stages = list()
+    if is_pdf.match(input_file):
+        stages.append('PDF.pdf')
+    stages.append('OBJ.tiff')
+    if not options.skip_derivatives:
+        if not options.skip_hocr_ocr:
+            stages.extend(['HOCR.html', 'OCR.txt'])
+            stages.extend([Derivatives.ocr_extra_files[config] for config in options.ocr_extra if config != 'pdf'])
+        if not options.skip_jp2:
+            stages.append('JP2.jp2')
+        stages.extend(['JPG.jpg', 'TN.jpg'])
+        if not is_pdf.match(input_file) and not options.skip_hocr_ocr and \
+                (not options.skip_jp2 or options.pdf_image != 'jp2' or 'pdf' in options.ocr_extra):
+            stages.append('PDF.pdf')
+    return stages
+
+
+def plan_run(files):
+    """Work out what a run would do and how long it would take, without writing to the output directory.
+
+    Keyword arguments
+    files -- The file or directory of files to process
+    """
+    if os.path.isdir(files):
+        books = find_books(files, check_empty=False)
+    else:
+        books = [[files]]
+    statistics = dict()
+    for history_file in [get_manifest_file()] + options.plan_history:
+        if history_file is None or not os.path.exists(history_file):
+            continue
+        history = Manifest(history_file, options, logger, read_only=True)
+        for (stage, stat) in history.stage_statistics().items():
+            # Weight the averages of each manifest by how many outputs they have.
+            if stage in statistics:
+                total = statistics[stage]['count'] + stat['count']
+                for field in ['duration', 'size']:
+                    statistics[stage][field] = (statistics[stage][field] * statistics[stage]['count'] +
+                                                (stat[field] or 0) * stat['count']) / total
+                statistics[stage]['count'] = total
+            else:
+                statistics[stage] = dict(stat)
+    totals = {'pages': 0, 'duration': 0.0, 'size': 0.0, 'unknown': set()}
+    for book_files in books:
+        (book_dir, book_name, book_number, unparsed_book_name) = preprocess_file(book_files[0])
+        print("Book: {}".format(book_dir))
+        if options.mods_dir is not None:
+            mods = find_mods_file(book_name, unparsed_book_name)
+            print("  MODS: {}".format(mods if mods is not None else "MISSING"))
+        if options.merge and len(book_files) > 1 and count_subdirectories(book_dir) > 0:
+            print("  WARNING: --merge needs {} to be empty, this book would stop the run".format(book_dir))
+        stage_counts = dict()
+        boost = 0
+        for input_file in book_files:
+            pages = count_pages(input_file)
+            print("  Source: {} ({} pages, pages {} to {})".format(input_file, pages, boost + 1, boost + pages))
+            for page_number in range(boost + 1, boost + pages + 1):
+                out_dir = os.path.join(book_dir, str(page_number))
+                for stage in page_stages(input_file):
+                    counts = stage_counts.setdefault(stage, {'done': 0, 'todo': 0})
+                    if manifest.is_complete(os.path.join(out_dir, stage)):
+                        counts['done'] += 1
+                    else:
+                        counts['todo'] += 1
+            boost += pages
+        totals['pages'] += boost
+        print("  {:<10} {:>6} {:>6} {:>12} {:>12}".format('Stage', 'Skip', 'To do', 'Est. time', 'Est. disk'))
+        for (stage, counts) in stage_counts.items():
+            if stage in statistics:
+                duration = statistics[stage]['duration'] * counts['todo']
+                size = (statistics[stage]['size'] or 0) * counts['todo']
+                totals['duration'] += duration
+                totals['size'] += size
+                estimate = (format_time(duration), format_size(size))
+            else:
+                if counts['todo'] > 0:
+                    totals['unknown'].add(stage)
+                estimate = ('unknown', 'unknown')
+            print("  {:<10} {:>6} {:>6} {:>12} {:>12}".format(stage, counts['done'], counts['todo'], estimate[0],
+                                                             estimate[1]))
+    print("Total: {} books, {} pages".format(len(books), totals['pages']))
+    print("Estimated time: {} with --jobs={} ({} of work)".format(format_time(totals['duration'] / options.jobs),
+                                                                  options.jobs, format_time(totals['duration'])))
+    print("Estimated disk: {}".format(format_size(totals['size'])))
+    if len(totals['unknown']) > 0:
+        print("No earlier timings for: {} (pass earlier manifests with --plan-history)".format(
+            ", ".join(sorted(totals['unknown']))))
+
+
+def format_size(size):
+    """Format bytes"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
 
 
 def set_up(args):
@@ -301,16 +1172,31 @@ def set_up(args):
     Keyword arguments
     args -- the ArgumentParser object
     """
-    global options, derivative_gen, spreader
+    global options, derivative_gen, spreader, splitter, manifest, cache, scratch, metrics, budget
     options = args
     setup_log()
-    derivative_gen = Derivatives(options, logger)
+    metrics = Metrics(options.metrics_file, options.metrics_run, logger)
+    metrics.install()
+    if options.memory_budget is not None:
+        # Made before the worker pool so every worker draws from the same budget.
+        budget = ResourceBudget(options.memory_budget * 1048576, options.thread_budget,
+                                options.min_free_memory * 1048576, logger)
+    AsyncRunner.configure(limits=options.tool_limits, budget=budget)
+    manifest = get_manifest()
+    cache = DerivativeCache(options.cache_dir, options.cache_size * 1048576, logger)
+    scratch = Scratch(options.scratch_root, options.scratch_size * 1048576, logger)
+    derivative_gen = Derivatives(options, logger, manifest=manifest, cache=cache, scratch=scratch)
     spreader = MODSSpreader(logger=logger)
+    splitter = PageSplitter(options, logger, manifest=manifest, cache=cache, scratch=scratch)
     test_programs = required_programs
-    if not options.skip_derivatives and not options.skip_hocr_ocr:
+    if not options.skip_derivatives and not options.skip_hocr_ocr and \
+            (options.ocr_engine == 'cli' or 'alto' in options.ocr_extra):
+        # tesserocr can't write ALTO, that still needs the program.
         test_programs.extend(hocr_programs)
     if not options.skip_derivatives and not options.skip_jp2:
-        test_programs.extend(jp2_programs)
+        test_programs.extend(jp2_programs.get(options.jp2_encoder, []))
+    if not options.skip_derivatives and options.rasterize == 'document' and not options.raster_direct:
+        test_programs.extend(rasterize_programs)
 
     try:
         for prog in test_programs:
@@ -321,15 +1207,39 @@ def set_up(args):
         quit()
 
 
-def setup_log():
-    """Setup logging"""
+def set_up_plan(args):
+    """Set up for --plan, nothing is written to the output directory and missing programs are only reported.
+
+    Keyword arguments
+    args -- the ArgumentParser object
+    """
+    global options, splitter, manifest
+    options = args
+    setup_log()
+    manifest_file = get_manifest_file()
+    if manifest_file is not None and os.path.exists(manifest_file):
+        manifest = Manifest(manifest_file, options, logger, read_only=True)
+    else:
+        manifest = Manifest(None, options, logger)
+    splitter = PageSplitter(options, logger)
+    for prog in required_programs + hocr_programs + jp2_programs.get(options.jp2_encoder, []):
+        if shutil.which(prog.get('exec')) is None:
+            print("Warning: {} is not in the PATH".format(prog.get('exec')))
+
+
+def setup_log(mode='w'):
+    """Setup logging
+
+    Keyword arguments
+    mode -- the mode to open the log file with
+    """
     global logger
     logger = logging.getLogger('multipage2book')
     logger.propogate = False
     # Logging Level 
     eval('logger.setLevel(logging.{})'.format(options.debug_level))
     filename = os.path.join(os.getcwd(), 'multipage2book.log')
-    fh = logging.FileHandler(filename, 'w', 'utf-8')
+    fh = logging.FileHandler(filename, mode, 'utf-8')
     formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
     fh.setFormatter(formatter)
     logger.addHandler(fh)
@@ -357,8 +1267,8 @@ def main():
     parser.add_argument('--resolution', dest="resolution", type=int, default=300,
                         help="Resolution of the source material, used when generating Tiff. Defaults to 300.")
     parser.add_argument('--use-hocr', dest="use_hocr", action='store_true', default=False,
-                        help='Generate OCR by stripping HTML characters from HOCR, otherwise run tesseract a second '
-                             'time. Defaults to use tesseract.')
+                        help='Generate OCR by stripping HTML characters from HOCR, otherwise it is written by the same '
+                             'tesseract run as the HOCR. Defaults to use tesseract.')
     parser.add_argument('--mods-dir', dest="mods_dir", default=None,
                         help='Directory of files with a matching name but with the extension "mods" to be added to '
                              'the books. By default it checks the "files" argument if it is a directory.')
@@ -375,6 +1285,38 @@ def main():
                              'derivatives.')
     parser.add_argument('--skip-hocr-ocr', dest="skip_hocr_ocr", action='store_true', default=False,
                         help='Do not generate OCR/HOCR datastreams, this cannot be used with --skip-derivatives')
+    parser.add_argument('--ocr-extra', dest="ocr_extra", action='append', choices=['alto', 'tsv', 'pdf'], default=[],
+                        help='Also save this output of the tesseract run, "alto" as ALTO.xml, "tsv" as OCR.tsv and '
+                             '"pdf" as the PDF.pdf of pages from Tiffs (instead of building it from the JP2 and HOCR). '
+                             'Can be given more than once.')
+    parser.add_argument('--jpeg-engine', dest="jpeg_engine", choices=['convert', 'pillow'], default='convert',
+                        help='Make the JPG and TN with convert, or in-process with Pillow decoding the Tiff once and '
+                             'making the TN from the JPG. Defaults to convert.')
+    parser.add_argument('--ocr-engine', dest="ocr_engine", choices=['cli', 'tesserocr'], default='cli',
+                        help='Run the tesseract program for each page, or OCR in-process with tesserocr so the '
+                             '--language is only loaded once by each job. Defaults to cli.')
+    parser.add_argument('--jp2-encoder', dest="jp2_encoder", choices=sorted(Jp2Encoder.backends.keys()),
+                        default='kakadu',
+                        help='Encode the JP2 with kdu_compress (kakadu), opj_compress (openjpeg) or in-process with '
+                             'Pillow (pillow). Defaults to kakadu.')
+    parser.add_argument('--jp2-threads', dest="jp2_threads", type=int, default=None,
+                        help='Threads each JP2 encode uses, with --memory-budget this is its share of '
+                             '--thread-budget. Defaults to what the encoder does on its own (kdu_compress uses every '
+                             'CPU, opj_compress and Pillow one), or 1 with --memory-budget.')
+    parser.add_argument('--master-colorspace', dest="master_colorspace", choices=MasterProfile.colorspaces,
+                        default='auto',
+                        help='Colorspace of the OBJ.tiff masters. Defaults to auto, greyscale for pages without colour '
+                             'and sRGB for the rest, which is what the derivatives are made from.')
+    parser.add_argument('--master-depth', dest="master_depth", choices=MasterProfile.depths, default='auto',
+                        help='Bits per sample of the OBJ.tiff masters. Defaults to auto, 1 for pages of only black and '
+                             'white and 8 for the rest.')
+    parser.add_argument('--master-compression', dest="master_compression",
+                        choices=MasterProfile.compression_choices, default='auto',
+                        help='Compression of the OBJ.tiff masters. Defaults to auto, Group4 for 1 bit pages and for '
+                             'the rest that of the source if the --jp2-encoder can read it, otherwise None.')
+    parser.add_argument('--pdf-image', dest="pdf_image", choices=sorted(Derivatives.pdf_images.keys()), default='jp2',
+                        help='The page image to embed in the PDF.pdf of pages from Tiffs, the JP2.jp2 (jp2) or the '
+                             'JPG.jpg (jpg). It is embedded as it is, without decoding it. Defaults to jp2.')
     parser.add_argument('--skip-jp2', dest="skip_jp2", action='store_true', default=False,
                         help='Do not generate JP2 datastreams, this cannot be used with --skip-derivatives')
     parser.add_argument('-l', '--loglevel', dest="debug_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
@@ -382,8 +1324,134 @@ def main():
     parser.add_argument('--limit', dest="limit", default=None, help='Only process the first N pdfs/tiffs found in the'
                                                                     '"files" directory. Does not work with --merge or '
                                                                     'if "files" is not a directory')
+    parser.add_argument('--jobs', dest="jobs", type=int, default=1,
+                        help='Number of pages to process at the same time, each in its own process. Defaults to 1.')
+    parser.add_argument('--executor', dest="executor", choices=['process', 'thread'], default='process',
+                        help='Run the --jobs pages in separate processes, or in threads of this process sharing one '
+                             'set of --tool-limits. Defaults to process.')
+    parser.add_argument('--tool-limits', dest="tool_limits", default='',
+                        help='The number of copies of each program allowed to run at once in a process, ie. '
+                             '"tesseract=8,kdu_compress=4". Defaults to tesseract=8, kdu_compress=4, opj_compress=4, '
+                             'convert=16, identify=16, gs=4, mogrify=4 and 8 for anything else.')
+    parser.add_argument('--memory-budget', dest="memory_budget", type=int, default=None,
+                        help='Megabytes of memory the external programs may use at once across all --jobs. Each '
+                             'call\'s needs are estimated from the size and bit depth of its image and it waits until '
+                             'they fit, the programs are told to keep within them. Disabled by default.')
+    parser.add_argument('--thread-budget', dest="thread_budget", type=int, default=os.cpu_count() or 1,
+                        help='With --memory-budget, the number of threads the external programs may use at once. '
+                             'Defaults to the number of CPUs.')
+    parser.add_argument('--min-free-memory', dest="min_free_memory", type=int, default=1024,
+                        help='With --memory-budget, megabytes of available memory on the host below which no more '
+                             'programs are started. Defaults to 1024.')
+    parser.add_argument('--pdf-split', dest="pdf_split", choices=['gs', 'pypdf2', 'page'], default='gs',
+                        help='How to split PDFs into pages, "gs" uses one Ghostscript call for the whole file, "pypdf2" '
+                             'copies the pages in-process and "page" runs Ghostscript once per page. Defaults to gs.')
+    parser.add_argument('--tiff-split', dest="tiff_split", choices=['burst', 'page'], default='burst',
+                        help='How to split multi-page Tiffs, "burst" writes every page in one pass copying the '
+                             'compressed data as-is where possible and "page" runs convert once per page. Defaults to '
+                             'burst.')
+    parser.add_argument('--rasterize', dest="rasterize", choices=['page', 'document'], default='page',
+                        help='How to make Tiffs from PDFs, "page" runs convert on each page PDF and "document" renders '
+                             'every page with one Ghostscript call. Defaults to page.')
+    parser.add_argument('--raster-direct', dest="raster_direct", action='store_true', default=False,
+                        help='With --rasterize=document, render straight at --resolution instead of at 125%% and then '
+                             'resizing to 75%%.')
+    parser.add_argument('--no-manifest', dest="no_manifest", action='store_true', default=False,
+                        help='Don\'t keep the multipage2book.sqlite manifest in the output directory, any existing file '
+                             'is considered complete.')
+    parser.add_argument('--plan', dest="plan", action='store_true', default=False,
+                        help='Don\'t process anything, report the books, pages and MODS found, which files already exist '
+                             'and estimate the time and disk space needed from the timings of earlier runs.')
+    parser.add_argument('--plan-history', dest="plan_history", action='append', default=[],
+                        help='The multipage2book.sqlite of an earlier run to take timings from for --plan, can be '
+                             'given more than once. The one in --output-dir is always used.')
+    parser.add_argument('--watch', dest="watch", action='store_true', default=False,
+                        help='Keep running and process PDFs/Tiffs as they are added to the "files" directory, moving '
+                             'them aside when done. Stop with Ctrl-C or SIGTERM.')
+    parser.add_argument('--watch-settle', dest="watch_settle", type=float, default=30,
+                        help='With --watch, seconds a file must stop changing before it is processed. Defaults to 30.')
+    parser.add_argument('--watch-interval', dest="watch_interval", type=float, default=10,
+                        help='With --watch, seconds between checks of the directory when inotify is not available. '
+                             'Defaults to 10.')
+    parser.add_argument('--watch-done-dir', dest="watch_done_dir", default=None,
+                        help='With --watch, move processed files here. Defaults to "done" in the "files" directory.')
+    parser.add_argument('--watch-failed-dir', dest="watch_failed_dir", default=None,
+                        help='With --watch, move files that failed here. Defaults to "failed" in the "files" '
+                             'directory.')
+    parser.add_argument('--distributed', dest="distributed", action='store_true', default=False,
+                        help='Share the work with other nodes running with --distributed on the same input and '
+                             '--output-dir, through lease files in the output directory.')
+    parser.add_argument('--node-id', dest="node_id", default=None,
+                        help='With --distributed, the name of this node in the leases. Defaults to the hostname and '
+                             'process id.')
+    parser.add_argument('--run-id', dest="run_id", default=None,
+                        help='With --distributed, the name of this run, the same on every node taking part in it. '
+                             'Finished and failed work is only trusted from the same run, required with --overwrite.')
+    parser.add_argument('--lease-ttl', dest="lease_ttl", type=int, default=300,
+                        help='With --distributed, seconds without a heartbeat before a node is considered dead and '
+                             'its work is taken over. Defaults to 300.')
+    parser.add_argument('--chunk-pages', dest="chunk_pages", type=int, default=50,
+                        help='With --distributed, the number of pages of a book claimed at a time. Defaults to 50.')
+    parser.add_argument('--metrics', dest="metrics_file", default=None,
+                        help='Append the wall time, CPU time, peak memory, exit status and bytes written of every '
+                             'external program and processing step to this JSON-lines file, tagged with the book, '
+                             'page and stage.')
+    parser.add_argument('--metrics-prom', dest="metrics_prom", default=None,
+                        help='At the end of the run write a per-stage summary of the --metrics to this file for the '
+                             'Prometheus node exporter textfile collector.')
+    parser.add_argument('--cache-dir', dest="cache_dir", default=None,
+                        help='Directory of a derivative cache shared between runs, generated files are reused when the '
+                             'same page is processed again with the same settings. Disabled by default.')
+    parser.add_argument('--cache-size', dest="cache_size", type=int, default=51200,
+                        help='Maximum size of the --cache-dir in megabytes, the least recently used files are removed '
+                             'beyond this. Defaults to 51200.')
+    parser.add_argument('--scratch-dir', dest="scratch_dir", default=None,
+                        help='Directory on local disk or tmpfs to write the files of each page in, they are moved into '
+                             'the output directory once complete. Defaults to writing in the output directory.')
+    parser.add_argument('--scratch-size', dest="scratch_size", type=int, default=10240,
+                        help='Maximum size of the files staged in --scratch-dir at once in megabytes, beyond this they '
+                             'are written in the output directory. Defaults to 10240.')
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer.")
+
+    if args.cache_dir is not None:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+
+    if args.scratch_size < 1:
+        parser.error("--scratch-size must be at least 1")
+    if args.scratch_dir is not None:
+        args.scratch_dir = os.path.abspath(args.scratch_dir)
+    # Made once the run starts, and shared by its worker processes.
+    args.scratch_root = None
+
+    if args.memory_budget is not None and (args.memory_budget < 1 or args.thread_budget < 1):
+        parser.error("--memory-budget and --thread-budget must be at least 1")
+
+    if args.ocr_engine == 'tesserocr' and not TesseractEngine.available():
+        parser.error("--ocr-engine=tesserocr needs the tesserocr module, pip install tesserocr")
+
+    if not Jp2Encoder.create(args.jp2_encoder, None).available():
+        parser.error("--jp2-encoder={} needs {}".format(args.jp2_encoder,
+                                                        Jp2Encoder.backends[args.jp2_encoder].requirement))
+    if args.jp2_threads is not None and args.jp2_threads < 1:
+        parser.error("--jp2-threads must be at least 1")
+
+    try:
+        args.tool_limits = AsyncRunner.parse_limits(args.tool_limits)
+    except ValueError:
+        parser.error("--tool-limits must be a list of program=number, ie. tesseract=8,kdu_compress=4")
+
+    if args.metrics_prom is not None and args.metrics_file is None:
+        parser.error("--metrics-prom needs --metrics to summarise.")
+    if args.metrics_file is not None:
+        args.metrics_file = os.path.abspath(args.metrics_file)
+    # Identifies the records of this run when --metrics is appended to across runs.
+    args.metrics_run = "{}-{}".format(int(time.time()), os.getpid())
+    # With --overwrite, files generated since (ie. by the one pass split of a book) are not generated again per page.
+    args.run_started = time.time()
+
     if not args.files[0] == '/':
         # Relative filepath
         args.files = os.path.join(os.getcwd(), args.files)
@@ -406,6 +1474,42 @@ def main():
     if args.merge and args.limit is not None:
         parser.error("--merge and --limit are mutually exclusive options, you can only use one at a time.")
 
+    if args.distributed:
+        if args.watch or args.plan:
+            parser.error("--distributed can't be used with --watch or --plan.")
+        if args.lease_ttl < 10 or args.chunk_pages < 1:
+            parser.error("--lease-ttl must be at least 10 and --chunk-pages must be positive.")
+        if args.node_id is None:
+            args.node_id = "{}-{}".format(socket.gethostname(), os.getpid())
+        args.node_id = re.sub(r'[^\w.-]', '_', args.node_id)
+        if args.overwrite and args.run_id is None:
+            parser.error("--distributed with --overwrite needs a --run-id shared by the nodes of the run.")
+
+    if args.watch:
+        if not os.path.isdir(args.files):
+            parser.error("--watch needs a directory to watch.")
+        if args.merge or args.limit is not None or args.plan:
+            parser.error("--watch can't be used with --merge, --limit or --plan.")
+        if args.watch_settle < 0 or args.watch_interval <= 0:
+            parser.error("--watch-settle and --watch-interval must be positive.")
+        if args.watch_done_dir is None:
+            args.watch_done_dir = os.path.join(args.files, 'done')
+        if args.watch_failed_dir is None:
+            args.watch_failed_dir = os.path.join(args.files, 'failed')
+        args.watch_done_dir = os.path.abspath(args.watch_done_dir)
+        args.watch_failed_dir = os.path.abspath(args.watch_failed_dir)
+
+    if args.plan:
+        if not (os.path.isdir(args.files) or (os.path.isfile(args.files) and valid_extensions.match(args.files))):
+            parser.error("{} could not be resolved to a directory or a PDF file".format(args.files))
+        if args.mods_extension is not None:
+            args.mods_extension = args.mods_extension.lstrip(".")
+        if args.limit is not None:
+            args.limit = int(args.limit)
+        set_up_plan(args)
+        plan_run(args.files)
+        return
+
     if args.merge:
         print("Warning: merge attempts to combine multiple files that start with the same name and end with a digit "
               "before the extension. Files are sorted by the number and require an empty starting directory. If the "
@@ -420,26 +1524,44 @@ def main():
         # Strip leading periods from the extension
         args.mods_extension = args.mods_extension.lstrip(".")
 
-    if os.path.isfile(args.files) and valid_extensions.match(args.files):
-        if args.limit is not None:
-            # limit doesn't work for a single file.
-            parser.error("--limit only works if you specify a directory as the input.")
-        set_up(args)
-        process_file(args.files)
-    elif os.path.isdir(args.files):
-        if args.limit is not None:
-            try:
-                if isinstance(args.limit, str):
-                    args.limit = int(args.limit)
-            except ValueError:
-                parser.error("--limit must be a positive integer.")
-            if isinstance(args.limit, int):
-                if args.limit < 1:
+    if args.scratch_dir is not None:
+        args.scratch_root = Scratch.create_root(args.scratch_dir)
+
+    try:
+        if os.path.isfile(args.files) and valid_extensions.match(args.files):
+            if args.limit is not None:
+                # limit doesn't work for a single file.
+                parser.error("--limit only works if you specify a directory as the input.")
+            set_up(args)
+            if args.distributed:
+                check_book_results(distribute_books([[args.files]]))
+            else:
+                process_file(args.files)
+        elif os.path.isdir(args.files):
+            if args.limit is not None:
+                try:
+                    if isinstance(args.limit, str):
+                        args.limit = int(args.limit)
+                except ValueError:
                     parser.error("--limit must be a positive integer.")
-        set_up(args)
-        parse_dir(args.files)
-    else:
-        parser.error("{} could not be resolved to a directory or a PDF file".format(args.files))
+                if isinstance(args.limit, int):
+                    if args.limit < 1:
+                        parser.error("--limit must be a positive integer.")
+            set_up(args)
+            if args.watch:
+                watch_dir(args.files)
+            else:
+                parse_dir(args.files)
+        else:
+            parser.error("{} could not be resolved to a directory or a PDF file".format(args.files))
+    finally:
+        # Also on failure, a run that died part way is what the metrics are most useful for.
+        shutdown_page_pool()
+        if args.scratch_root is not None:
+            # Anything still staged belongs to a step that failed.
+            Scratch.remove_root(args.scratch_root)
+        if metrics is not None and options.metrics_prom is not None:
+            metrics.write_prometheus(options.metrics_prom)
 
     total_time = time.perf_counter() - start_time
     print("Finished in {}".format(format_time(total_time)))